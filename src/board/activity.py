@@ -0,0 +1,202 @@
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import *
+from .changes import deleting_boards
+from .dashboard import user_boards
+from .pagination import CursorPaginator
+
+"""
+Activity Feeds
+==============
+
+Who did what, on one board or across all of someone's boards. Model signals (and bulk operations, which skip
+them) append an Activity row per event, a few small columns, never updated afterwards. Nothing is copied out to
+each member when something happens, a feed is worked out when it's read: the events for the boards a user is on
+(user_boards(), from BoardMember) newest first, paged by id with a CursorPaginator. That's one range scan of
+ix_activity_board (or the primary key) however many people are on the boards, and the dashboard's "recent
+activity" is its first page.
+
+Who did it is whoever the current request is logged in as (ActivityMiddleware, or acting_as() outside requests),
+falling back to the author of the thing if it has one.
+
+The table is kept bounded by rollup_activity ('manage.py rollup_activity'): events older than
+BOARD_ACTIVITY_RETENTION are counted into ActivityDay, per board, day and kind, and deleted a chunk at a time.
+Daily counts older than BOARD_ACTIVITY_SUMMARY_RETENTION go altogether.
+"""
+
+RETENTION = getattr(settings, 'BOARD_ACTIVITY_RETENTION', timedelta(days=30))
+SUMMARY_RETENTION = getattr(settings, 'BOARD_ACTIVITY_SUMMARY_RETENTION', timedelta(days=365))
+
+# Events in the dashboards recent activity
+WIDGET_SIZE = 10
+
+TEXT_LENGTH = Activity._meta.get_field('text').max_length
+
+# How each kind of event reads in a feed, "<actor> <phrase> <text>"
+PHRASES = {
+    Activity.Verb.CARD_CREATED: 'added the card',
+    Activity.Verb.CARD_MOVED: 'moved the card',
+    Activity.Verb.CARD_ARCHIVED: 'archived the card',
+    Activity.Verb.CARD_DELETED: 'deleted the card',
+    Activity.Verb.COMMENTED: 'commented',
+    Activity.Verb.REACTED: 'reacted to a comment with',
+    Activity.Verb.TASK_ADDED: 'added the task',
+    Activity.Verb.TASK_DONE: 'finished the task',
+    Activity.Verb.ATTACHED: 'attached',
+    Activity.Verb.LIST_CREATED: 'added the list',
+    Activity.Verb.MEMBER_ADDED: 'added the member',
+}
+
+_actor = ContextVar('board_activity_actor', default=None)
+
+@contextmanager
+def acting_as(user):
+    """
+    Events recorded inside the block are done by 'user'.
+    """
+    token = _actor.set(user)
+    try:
+        yield
+    finally:
+        _actor.reset(token)
+
+class ActivityMiddleware:
+    """
+    Records events during a request as done by its user. Goes after AuthenticationMiddleware.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # request.user is lazy, it's only looked at if something gets recorded
+        with acting_as(request.user):
+            return self.get_response(request)
+
+def current_actor_id(default=None):
+    user = _actor.get()
+    if user is not None and user.is_authenticated:
+        return user.id
+    return default
+
+def event(board_id, verb, object_id=None, text='', actor_id=None):
+    """
+    An unsaved Activity, done by the current actor ('actor_id' if there isn't one).
+    """
+    return Activity(board_id=board_id, actor_id=current_actor_id(actor_id), verb=verb, object_id=object_id,
+        text=(text or '')[:TEXT_LENGTH])
+
+def record(board_id, verb, object_id=None, text='', actor_id=None):
+    """
+    Record Activity
+    ---------------
+
+    Appends an event to the boards activity, unless the board is being deleted.
+    """
+    if board_id in deleting_boards():
+        return None
+    activity = event(board_id, verb, object_id, text, actor_id)
+    activity.save()
+    return activity
+
+def activity_page(board_ids, cursor=None, page_size=None):
+    """
+    A page of the events on 'board_ids', newest first. Raises InvalidCursor for a bad cursor.
+    """
+    events = (Activity.objects.filter(board__in=board_ids)
+        .values('id', 'board_id', 'board__title', 'actor_id', 'actor__username', 'verb', 'object_id', 'text',
+            'date_created'))
+    page = CursorPaginator(events, ('-id',), page_size or settings.PAGE_SIZE).page(cursor)
+    page.items = [describe(row) for row in page.items]
+    return page
+
+def describe(row):
+    return {
+        "id": row["id"],
+        "board": row["board_id"],
+        "board_title": row["board__title"],
+        "actor": row["actor_id"],
+        "actor_name": row["actor__username"],
+        "verb": Activity.Verb(row["verb"]).name.lower(),
+        "phrase": PHRASES[row["verb"]],
+        "object": row["object_id"],
+        "text": row["text"],
+        "date": row["date_created"],
+    }
+
+def user_feed(user, cursor=None, page_size=None):
+    """
+    User Feed
+    ---------
+
+    A page of what's happened on every board 'user' owns or is a member of, newest first.
+    """
+    return activity_page(list(user_boards(user)), cursor, page_size)
+
+def recent_activity(user):
+    """
+    The dashboards "recent activity", the first few events of the users feed.
+    """
+    return user_feed(user, page_size=WIDGET_SIZE).items
+
+def daily_activity(board_id):
+    """
+    The boards rolled up days, newest first: [{day, verb, count}, ...]
+    """
+    return [{"day": day, "verb": Activity.Verb(verb).name.lower(), "count": count}
+        for day, verb, count in ActivityDay.objects.filter(board=board_id).order_by('-day', 'verb')
+            .values_list('day', 'verb', 'count')]
+
+def add_days(counts):
+    """
+    Adds {(board id, day, verb): count} onto ActivityDay.
+    """
+    boards = {board_id for board_id, _, _ in counts}
+    days = {day for _, day, _ in counts}
+    existing = {(row.board_id, row.day, row.verb): row for row in ActivityDay.objects.select_for_update()
+        .filter(board__in=boards, day__in=days)}
+
+    for key, count in counts.items():
+        if key in existing:
+            existing[key].count += count
+    ActivityDay.objects.bulk_update([row for key, row in existing.items() if key in counts], ['count'])
+    ActivityDay.objects.bulk_create([ActivityDay(board_id=board_id, day=day, verb=verb, count=count)
+        for (board_id, day, verb), count in counts.items() if (board_id, day, verb) not in existing])
+
+def rollup_activity(before=None, summaries_before=None, chunk_size=1000):
+    """
+    Rollup Activity
+    ---------------
+
+    Counts events older than 'before' (default now - BOARD_ACTIVITY_RETENTION) into daily summaries and deletes
+    them, 'chunk_size' events per transaction, then deletes summaries for days before 'summaries_before' (default
+    today - BOARD_ACTIVITY_SUMMARY_RETENTION). Returns (events rolled up, summaries deleted). Run one at a time.
+    """
+    before = before or timezone.now() - RETENTION
+    summaries_before = summaries_before or timezone.localdate() - SUMMARY_RETENTION
+    rolled = removed = 0
+
+    while True:
+        with transaction.atomic():
+            # Events are appended in id order, so the old ones are at the start of the primary key
+            rows = list(Activity.objects.filter(date_created__lt=before).order_by('id')
+                .values_list('id', 'board_id', 'verb', 'date_created')[:chunk_size])
+            if not rows:
+                break
+            add_days(Counter((board_id, timezone.localdate(date), verb) for _, board_id, verb, date in rows))
+            Activity.objects.filter(id__in=[row[0] for row in rows]).delete()
+        rolled += len(rows)
+
+    while True:
+        ids = list(ActivityDay.objects.filter(day__lt=summaries_before).values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            break
+        removed += ActivityDay.objects.filter(id__in=ids).delete()[0]
+
+    return rolled, removed
@@ -3,9 +3,27 @@ from django.contrib import admin
 # Register your models here.
 
 from .models import *
+from .purge import archive_board
+
+class BoardAdmin(admin.ModelAdmin):
+    """
+    Boards are archived and purged in the background rather than deleted here, deleting a big board (or even showing
+    what it would delete) loads everything on it, see purge.py.
+    """
+    list_display = ('title', 'author', 'is_template', 'archived', 'date_created')
+    list_filter = ('is_template', 'archived')
+    actions = ['archive']
+
+    @admin.action(description="Archive and purge selected boards")
+    def archive(self, request, queryset):
+        archived = sum(archive_board(board_id) for board_id in queryset.values_list('id', flat=True))
+        self.message_user(request, "%s board(s) archived, they'll be purged in the background." % archived)
+
+    def has_delete_permission(self, request, obj=None):
+        return False
 
 admin.site.register(Profile)
-admin.site.register(Board)
+admin.site.register(Board, BoardAdmin)
 admin.site.register(BoardMember)
 
 admin.site.register(List)
@@ -13,6 +31,10 @@ admin.site.register(Card)
 admin.site.register(Comment)
 admin.site.register(Task)
 admin.site.register(Attachment)
+admin.site.register(Upload)
 admin.site.register(Tag)
 admin.site.register(CardTag)
-admin.site.register(Reaction)
\ No newline at end of file
+admin.site.register(Reaction)
+admin.site.register(BoardChange)
+admin.site.register(SearchEntry)
+admin.site.register(Job)
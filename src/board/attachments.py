@@ -0,0 +1,309 @@
+import hashlib
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+
+from .models import *
+from .thumbnails import remove_derivatives, source_digest
+
+"""
+Attachment Uploads and Downloads
+================================
+
+Uploads
+    Big files come in as a series of chunks (PUT with a Content-Range header) against an Upload. Each chunk is
+    streamed from the request straight into a part file on disk a block at a time, so nothing bigger than a block is
+    ever held in memory, and a client that loses its connection can ask how far it got and carry on from there.
+    Completing the upload hashes the part file (SHA-256, checked against the hash the client gave, if any) and links
+    it to a content-addressed name, blobs/ab/abcdef..., unless that content is already stored in which case the part
+    file is just thrown away. The same 200MB spec attached fifty times is stored once. Deduplicating onto a file and
+    removing it both lock its Blob row first, so a file can't be removed just as a new attachment starts sharing it.
+    Hashing and storing happen before that, the lock is only held to check the file is still there and attach it.
+
+Downloads
+    Served as a FileResponse so the WSGI server can hand the file to sendfile(), or with ATTACHMENT_SENDFILE_HEADER
+    set, handed off to the web server entirely (X-Accel-Redirect/X-Sendfile). Single byte ranges (Range/If-Range)
+    are supported so downloads can be resumed and media can seek.
+
+Files (and their thumbnails, unless an avatar is the same picture) are removed from storage once the last attachment
+using them is deleted, see signals.py.
+"""
+
+BLOCK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = getattr(settings, 'ATTACHMENT_MAX_CHUNK_SIZE', 16 * 1024 * 1024)
+MAX_FILE_SIZE = getattr(settings, 'ATTACHMENT_MAX_FILE_SIZE', 1024 * 1024 * 1024)
+
+CONTENT_RANGE = re.compile(r'^bytes (?P<start>\d+)-(?P<end>\d+)/(?P<total>\d+|\*)$')
+RANGE = re.compile(r'^bytes=(?P<start>\d*)-(?P<end>\d*)$')
+
+class UploadError(Exception):
+    """
+    Something wrong with an upload request, 'status' is the HTTP status it should be answered with.
+    """
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def blob_name(sha256):
+    return 'blobs/%s/%s' % (sha256[:2], sha256)
+
+def part_path(upload):
+    return os.path.join(settings.ATTACHMENT_UPLOAD_DIR, '%s.part' % upload.id)
+
+def start_upload(board, card, author, name, size, sha256=''):
+    if size < 0 or size > MAX_FILE_SIZE:
+        raise UploadError("File too large (max %s bytes)" % MAX_FILE_SIZE, 413)
+    if sha256 and not re.match(r'^[0-9a-f]{64}$', sha256):
+        raise UploadError("Invalid sha256")
+
+    upload = Upload.objects.create(board=board, card=card, author=author, name=os.path.basename(name)[:255],
+        size=size, sha256=sha256)
+
+    os.makedirs(settings.ATTACHMENT_UPLOAD_DIR, exist_ok=True)
+    open(part_path(upload), 'wb').close()
+    return upload
+
+def write_chunk(upload_id, content_range, stream):
+    """
+    Writes one chunk, read from 'stream' (the request) a block at a time, at the offset given by the Content-Range
+    header. Chunks have to carry on from where the upload got to, a chunk starting anywhere else is refused with 409
+    (the response says where to carry on from). Returns the upload.
+    """
+    match = CONTENT_RANGE.match(content_range or '')
+    if match is None:
+        raise UploadError("Content-Range header required, 'bytes start-end/total'")
+
+    start, end = int(match['start']), int(match['end'])
+    length = end - start + 1
+    if length < 1 or length > MAX_CHUNK_SIZE:
+        raise UploadError("Chunks must be between 1 and %s bytes" % MAX_CHUNK_SIZE)
+
+    with transaction.atomic():
+        # Row lock so two requests can't write the same upload at once
+        upload = Upload.objects.select_for_update().get(id=upload_id)
+        if start != upload.received:
+            raise UploadError("Expected a chunk starting at %s" % upload.received, 409)
+        if end >= upload.size:
+            raise UploadError("Chunk runs past the end of the file")
+        if match['total'] != '*' and int(match['total']) != upload.size:
+            raise UploadError("Content-Range total doesn't match the upload size of %s bytes" % upload.size, 416)
+
+        written = 0
+        with open(part_path(upload), 'r+b') as part:
+            part.seek(start)
+            while written < length:
+                block = stream.read(min(BLOCK_SIZE, length - written))
+                if not block:
+                    break
+                part.write(block)
+                written += len(block)
+
+            if written != length:
+                # Throw the partial chunk away, the client sends it again
+                part.truncate(start)
+                raise UploadError("Chunk was cut short, expected %s bytes got %s" % (length, written))
+
+        upload.received = end + 1
+        upload.save(update_fields=['received', 'date_modified'])
+
+    return upload
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def complete_upload(upload_id):
+    """
+    Turns a fully received upload into an Attachment, storing the content only if it isn't stored already.
+    Returns (attachment, deduplicated).
+    """
+    upload = Upload.objects.get(id=upload_id)
+    if upload.received != upload.size:
+        raise UploadError("Upload incomplete, %s of %s bytes received" % (upload.received, upload.size), 409)
+
+    # Hashing and storing a big file takes a while, it's done before taking any locks. The part file is kept until
+    # the attachment is committed in case the stored copy is removed in the meantime
+    path = part_path(upload)
+    try:
+        sha256 = file_digest(path)
+    except FileNotFoundError:
+        raise UploadError("Upload Not Found", 404)
+    if upload.sha256 and upload.sha256 != sha256:
+        discard_upload(upload)
+        raise UploadError("Content hash mismatch, the upload has been discarded", 422)
+
+    name = blob_name(sha256)
+    deduplicated = default_storage.exists(name)
+    if not deduplicated:
+        store(path, name)
+
+    with transaction.atomic():
+        upload = Upload.objects.select_for_update().filter(id=upload_id).first()
+        if upload is None:
+            raise UploadError("Upload Not Found", 404)
+
+        # Held until the attachment is committed, release_file takes the same lock before removing the file
+        Blob.objects.select_for_update().get_or_create(sha256=sha256)
+        if not default_storage.exists(name):
+            # Removed by release_file since it was checked, nothing was using it then
+            store(path, name)
+            deduplicated = False
+
+        attachment = Attachment.objects.create(board_id=upload.board_id, card_id=upload.card_id,
+            author_id=upload.author_id, file=name, name=upload.name, size=upload.size, sha256=sha256)
+        upload.delete()
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return attachment, deduplicated
+
+def store(path, name):
+    """
+    Copies a finished part file into storage under 'name', a hard link when storage is the local filesystem. The
+    part file is left where it is.
+    """
+    try:
+        target = default_storage.path(name)
+    except NotImplementedError:
+        with open(path, 'rb') as f:
+            default_storage.save(name, File(f))
+        return
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(path, target)
+    except FileExistsError:
+        # Another upload of the same content got there first
+        pass
+
+def release_file(name):
+    """
+    Deletes a stored file once no attachment refers to it any more.
+    """
+    if not name:
+        return
+    if not name.startswith('blobs/'):
+        if not Attachment.objects.filter(file=name).exists():
+            default_storage.delete(name)
+        return
+
+    digest = os.path.basename(name)
+    with transaction.atomic():
+        # Waits for any upload that is deduplicating onto this content to commit its attachment, see Blob
+        blob = Blob.objects.select_for_update().filter(sha256=digest).first()
+        if Attachment.objects.filter(file=name).exists():
+            return
+        default_storage.delete(name)
+        if blob is not None:
+            blob.delete()
+
+    # Thumbnails are named after the content, an avatar of the same picture still uses them
+    if not avatar_uses(digest):
+        remove_derivatives(digest)
+
+def avatar_uses(digest):
+    """
+    Whether any profiles avatar has the content 'digest'. Avatars from before their hash was kept are hashed (and it
+    kept) the first time this is asked.
+    """
+    for profile in Profile.objects.filter(avatar_sha256='').exclude(avatar='').exclude(avatar=None).only('avatar'):
+        try:
+            sha256 = source_digest(profile.avatar.name)
+        except FileNotFoundError:
+            continue
+        Profile.objects.filter(id=profile.id).update(avatar_sha256=sha256)
+
+    return Profile.objects.filter(avatar_sha256=digest).exists()
+
+def discard_upload(upload):
+    try:
+        os.remove(part_path(upload))
+    except FileNotFoundError:
+        pass
+    upload.delete()
+
+def parse_range(header, size):
+    """
+    (start, end) of a single 'bytes=' range, None to send the whole file, or raises UploadError(416).
+    Multiple ranges aren't supported and get the whole file, which is allowed.
+    """
+    match = RANGE.match(header or '')
+    if match is None or (not match['start'] and not match['end']):
+        return None
+
+    if not match['start']:
+        start, end = max(size - int(match['end']), 0), size - 1
+    else:
+        start = int(match['start'])
+        end = min(int(match['end']), size - 1) if match['end'] else size - 1
+
+    if start >= size or start > end:
+        raise UploadError("Range not satisfiable", 416)
+    return start, end
+
+def read_range(f, start, end):
+    try:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = f.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    finally:
+        f.close()
+
+def content_disposition(filename):
+    # Same as FileResponse does it, non-ASCII names need the RFC 5987 form
+    try:
+        filename.encode('ascii')
+        return 'attachment; filename="%s"' % filename.replace('\\', '\\\\').replace('"', r'\"')
+    except UnicodeEncodeError:
+        return "attachment; filename*=utf-8''%s" % quote(filename)
+
+def serve_attachment(request, attachment):
+    """
+    Download response for an attachment, honouring Range/If-Range.
+    """
+    name = attachment.file.name
+    size = attachment.size or default_storage.size(name)
+    etag = '"%s"' % attachment.sha256 if attachment.sha256 else None
+
+    header = getattr(settings, 'ATTACHMENT_SENDFILE_HEADER', None)
+    if header:
+        # The web server does the sending (and the ranges) itself
+        response = HttpResponse(content_type='application/octet-stream')
+        response[header] = getattr(settings, 'ATTACHMENT_SENDFILE_PREFIX', '') + name
+    else:
+        byte_range = None
+        if_range = request.headers.get('If-Range')
+        if not if_range or (etag and if_range == etag):
+            byte_range = parse_range(request.headers.get('Range'), size)
+
+        f = default_storage.open(name, 'rb')
+        if byte_range is None:
+            response = FileResponse(f, content_type='application/octet-stream')
+            response['Content-Length'] = size
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(read_range(f, start, end), status=206, content_type='application/octet-stream')
+            response['Content-Range'] = 'bytes %s-%s/%s' % (start, end, size)
+            response['Content-Length'] = end - start + 1
+
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = content_disposition(attachment.get_name())
+    if etag:
+        response['ETag'] = etag
+    return response
@@ -0,0 +1,240 @@
+import logging
+import statistics
+import subprocess
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import *
+from .instrumentation import record_queries
+from .search import reindex_cards
+from .sessions import flush_sessions, discard_sessions
+from .workload import SCALES, PASSWORD, generate_workload
+
+"""
+Benchmarks
+==========
+
+Times the main pages against generated workloads (see workload.py) at one or more scales, with Django's test
+client so there's no web server in the way. Each endpoint is requested a number of times and reports latency
+percentiles and how many queries it ran. Everything generated is rolled back afterwards.
+
+Endpoints ending in '_cold' have the cache emptied before every request, the rest are measured warm.
+
+Results are plain JSON so runs can be kept and compared between commits, see compare().
+
+run_session_benchmark() compares session engines instead, logging in and a plain logged in request with each.
+
+The tasks app isn't installed or routed (see todo/urls.py) so it has nothing to measure.
+"""
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+
+def measure(name, scale, request, requests, before=None):
+    timings = []
+    queries = []
+    for _ in range(requests):
+        if before is not None:
+            before()
+        with record_queries() as metrics:
+            start = time.perf_counter()
+            response = request()
+            timings.append((time.perf_counter() - start) * 1000)
+        if response.status_code >= 400:
+            raise RuntimeError('%s responded %s' % (name, response.status_code))
+        queries.append(metrics.queries)
+
+    return {
+        "scale": scale,
+        "endpoint": name,
+        "requests": requests,
+        "p50_ms": round(percentile(timings, 50), 2),
+        "p90_ms": round(percentile(timings, 90), 2),
+        "p99_ms": round(percentile(timings, 99), 2),
+        "mean_ms": round(statistics.mean(timings), 2),
+        "queries": max(queries),
+    }
+
+def endpoints(client, board_id, username):
+    board = reverse('board-main', kwargs={"board_id": board_id})
+    api = reverse('board-api', kwargs={"board_id": board_id})
+    search = reverse('board-search', kwargs={"board_id": board_id})
+    dashboard = reverse('dashboard')
+    login = reverse('login')
+
+    return [
+        ("board_view", lambda: client.get(board), None),
+        ("board_view_cold", lambda: client.get(board), cache.clear),
+        ("board_api", lambda: client.get(api), None),
+        ("dashboard", lambda: client.get(dashboard), None),
+        ("dashboard_cold", lambda: client.get(dashboard), cache.clear),
+        ("board_search", lambda: client.get(search, {"q": 'drill core'}), None),
+        # A fresh client each time, it's the whole password check and new session being measured
+        ("login", lambda: Client().post(login, {"username": username, "password": PASSWORD}), None),
+    ]
+
+def clear_caches():
+    # Sessions can have a cache of their own (they do as shipped, see settings.py)
+    cache.clear()
+    caches[settings.SESSION_CACHE_ALIAS].clear()
+
+def run_scale(scale, requests=50, warmup=5, login_requests=10):
+    """
+    Generates the 'scale' workload, benchmarks every endpoint against one of its boards, then rolls it all back.
+    """
+    results = []
+    with transaction.atomic():
+        # Only the board being measured is searched, so only it needs indexing (most of the time generating goes there)
+        workload = generate_workload(**SCALES[scale], prefix='benchmark-%s' % scale, index=False)
+        board = Board.objects.select_related('author').get(id=workload["boards"][0])
+        reindex_cards(Card.objects.filter(board=board).values_list('id', flat=True))
+
+        client = Client()
+        client.force_login(board.author)
+        cache.clear()
+
+        for name, request, before in endpoints(client, board.id, board.author.username):
+            count = login_requests if name == 'login' else requests
+            for _ in range(warmup if name != 'login' else 0):
+                request()
+            results.append(measure(name, scale, request, count, before))
+
+        transaction.set_rollback(True)
+
+    discard_sessions()
+    clear_caches()
+    return results
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+@contextmanager
+def benchmarking():
+    # Budgets are for catching regressions in tests, here we want the numbers whatever they are. The line logged
+    # for every request would only be noise (and time) too.
+    performance = logging.getLogger('board.performance')
+    level = performance.level
+    performance.setLevel(logging.ERROR)
+    try:
+        with override_settings(ALLOWED_HOSTS=['testserver'], QUERY_BUDGET_RAISE=False):
+            yield
+    finally:
+        performance.setLevel(level)
+
+def run_benchmark(scales=('small', ), requests=50, warmup=5, login_requests=10):
+    """
+    Run Benchmark
+    -------------
+
+        {"commit", "database", "date", "results": [{scale, endpoint, requests, p50_ms, p90_ms, p99_ms, mean_ms,
+         queries}, ...]}
+    """
+    results = []
+    with benchmarking():
+        for scale in scales:
+            results += run_scale(scale, requests, warmup, login_requests)
+
+    return {
+        "commit": current_commit(),
+        "database": connection.vendor,
+        "date": timezone.now().isoformat(),
+        "results": results,
+    }
+
+SESSION_ENGINES = {
+    "db": 'django.contrib.sessions.backends.db',
+    "cached_db": 'django.contrib.sessions.backends.cached_db',
+    "board": 'board.sessions',
+}
+
+def run_session_engine(name, engine, requests=200, warmup=5, login_requests=50):
+    results = []
+    # Passwords are hashed the fast way here, the real hasher takes long enough to hide everything else at login
+    with override_settings(SESSION_ENGINE=engine, PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher']), \
+            transaction.atomic():
+        clear_caches()
+        user = User.objects.create_user('session-benchmark', password=PASSWORD)
+        login = reverse('login')
+        dashboard = reverse('dashboard')
+
+        results.append(measure('login', name, lambda: Client().post(login, {"username": user.username,
+            "password": PASSWORD}), login_requests))
+
+        # The write-behind engine puts off the database writes for those logins, they're part of the cost
+        if engine == SESSION_ENGINES["board"]:
+            with record_queries() as metrics:
+                start = time.perf_counter()
+                flushed = flush_sessions()
+                elapsed = (time.perf_counter() - start) * 1000
+            results.append({"scale": name, "endpoint": 'session_flush', "requests": flushed,
+                "p50_ms": round(elapsed, 2), "p90_ms": round(elapsed, 2), "p99_ms": round(elapsed, 2),
+                "mean_ms": round(elapsed, 2), "queries": metrics.queries})
+
+        client = Client()
+        client.force_login(user)
+        for _ in range(warmup):
+            client.get(dashboard)
+        results.append(measure('request', name, lambda: client.get(dashboard), requests))
+
+        transaction.set_rollback(True)
+
+    discard_sessions()
+    clear_caches()
+    return results
+
+def run_session_benchmark(engines=tuple(SESSION_ENGINES), requests=200, warmup=5, login_requests=50):
+    """
+    Run Session Benchmark
+    ---------------------
+
+    Logs in and makes a logged in request (the dashboard, warm, for someone without boards so it's mostly the
+    session and user) with each session engine, results are in the same shape as run_benchmark() with the engine in
+    place of the scale.
+    """
+    results = []
+    with benchmarking():
+        for name in engines:
+            results += run_session_engine(name, SESSION_ENGINES[name], requests, warmup, login_requests)
+
+    return {
+        "commit": current_commit(),
+        "database": connection.vendor,
+        "date": timezone.now().isoformat(),
+        "results": results,
+    }
+
+def compare(old, new, threshold=1.2):
+    """
+    Lines describing how 'new' differs from 'old' (both run_benchmark results) and whether anything got worse: p50
+    slower by more than 'threshold' times, or more queries. Returns (lines, regressed).
+    """
+    before = {(r["scale"], r["endpoint"]): r for r in old["results"]}
+    lines = []
+    regressed = False
+
+    for result in new["results"]:
+        previous = before.get((result["scale"], result["endpoint"]))
+        if previous is None:
+            continue
+
+        ratio = result["p50_ms"] / previous["p50_ms"] if previous["p50_ms"] else 1
+        worse = ratio > threshold or result["queries"] > previous["queries"]
+        regressed = regressed or worse
+        lines.append('%-8s %-16s p50 %8.2f -> %8.2f ms (x%.2f)  queries %3d -> %3d%s' % (
+            result["scale"], result["endpoint"], previous["p50_ms"], result["p50_ms"], ratio,
+            previous["queries"], result["queries"], '  REGRESSED' if worse else ''))
+
+    return lines, regressed
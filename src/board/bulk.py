@@ -0,0 +1,233 @@
+from bisect import bisect_right, insort
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import *
+from .cache import bump_board_version
+from .ordering import GAP
+from .changes import record_change
+from .search import reindex_cards
+from .counters import recount_cards
+from .tagfilter import invalidate_tag_index
+from . import activity
+
+"""
+Bulk Card Operations
+====================
+
+Applies a batch of card/tag/task operations to one board in a single transaction. Everything the batch refers to
+is loaded up front (one query per model), the operations are applied in memory in order, and the results are
+written back with bulk_update/bulk_create/one DELETE, so the number of queries doesn't depend on the batch size.
+
+Operations (dicts, as posted to the bulk endpoint):
+    {"op": "move",      "card": id, "list": id, "after": card id or null}   "after" left out appends to the list
+    {"op": "archive",   "card": id}
+    {"op": "unarchive", "card": id}
+    {"op": "tag",       "card": id, "tag": id}
+    {"op": "untag",     "card": id, "tag": id}
+    {"op": "task",      "task": id, "done": true/false}
+    {"op": "add_task",  "card": id, "name": "..."}
+
+Each operation gets a result, {"ok": true} or {"ok": false, "error": "..."}. Failed operations are skipped, the
+rest of the batch still goes through. Permissions are the callers business, checked once for the whole batch.
+"""
+
+class OperationError(Exception):
+    pass
+
+class ListOrder:
+    """
+    In-memory (location, id) order of one list, so moves in a batch can be ranked without going back to the DB.
+    """
+    def __init__(self, rows):
+        self.rows = sorted(rows)
+
+    def remove(self, card):
+        self.rows.remove((card.location, card.id))
+
+    def rank_after(self, after):
+        if after is None:
+            low, i = 0, 0
+        else:
+            low = after.location
+            i = bisect_right(self.rows, (low, after.id))
+        if i == len(self.rows):
+            return low + GAP
+        high = self.rows[i][0]
+        return None if high - low < 2 else (low + high) // 2
+
+    def rebalance(self):
+        """
+        Renumbers the list GAP apart, returns the new {card id: location}.
+        """
+        self.rows = [((i + 1) * GAP, pk) for i, (location, pk) in enumerate(self.rows)]
+        return {pk: location for location, pk in self.rows}
+
+    def add(self, card):
+        insort(self.rows, (card.location, card.id))
+
+def apply_operations(board, operations):
+    """
+    Apply Operations
+    ----------------
+
+    Applies 'operations' to 'board' and returns a list of per-operation results in the same order.
+    """
+    card_ids, list_ids, tag_ids, task_ids = set(), set(), set(), set()
+    for op in operations:
+        if not isinstance(op, dict):
+            continue
+        for key, ids in (('card', card_ids), ('after', card_ids), ('list', list_ids), ('tag', tag_ids), ('task', task_ids)):
+            if isinstance(op.get(key), int):
+                ids.add(op[key])
+
+    with transaction.atomic():
+        lists = {l.id: l for l in List.objects.filter(board=board, id__in=list_ids)}
+        tags = set(Tag.objects.filter(board=board, id__in=tag_ids).values_list('id', flat=True))
+        tasks = {t.id: t for t in Task.objects.filter(board=board, id__in=task_ids)}
+        cards = {c.id: c for c in Card.objects.select_for_update().filter(board=board, id__in=card_ids)}
+        card_tags = {(ct.card_id, ct.tag_id): ct for ct in CardTag.objects.filter(board=board, card__in=cards)}
+        # What cards and tasks were before the batch, for the activity feed
+        was_archived = {c.id for c in cards.values() if c.archived}
+        was_done = {t.id for t in tasks.values() if t.done}
+
+        # Every list a card could be moved into or out of, ordered in memory
+        order_ids = set(lists) | {c.list_id for c in cards.values()}
+        rows = {pk: [] for pk in order_ids}
+        for pk, list_id, location in Card.objects.filter(list__in=order_ids).order_by().values_list('id', 'list', 'location'):
+            rows[list_id].append((location, pk))
+        orders = {pk: ListOrder(r) for pk, r in rows.items()}
+
+        dirty_cards, dirty_tasks, new_tasks, new_tags, removed_tags = set(), {}, [], {}, set()
+        moved = set()
+        relocated, reindex, recount = {}, set(), set()
+        results = []
+
+        def get(objects, op, key, name):
+            obj = objects.get(op.get(key)) if isinstance(op.get(key), int) else None
+            if obj is None:
+                raise OperationError("%s not found" % name)
+            return obj
+
+        for op in operations:
+            try:
+                if not isinstance(op, dict):
+                    raise OperationError("Operation must be an object")
+                kind = op.get('op')
+
+                if kind == 'move':
+                    card = get(cards, op, 'card', 'Card')
+                    target = get(lists, op, 'list', 'List')
+                    after = None
+                    if op.get('after') is not None:
+                        after = get(cards, op, 'after', 'Card')
+                        if after.list_id != target.id or after.id == card.id:
+                            raise OperationError("Card to place after isn't in the target list")
+
+                    orders[card.list_id].remove(card)
+                    order = orders[target.id]
+                    if 'after' not in op:
+                        rank = (order.rows[-1][0] if order.rows else 0) + GAP
+                    else:
+                        rank = order.rank_after(after)
+                        if rank is None:
+                            renumbered = order.rebalance()
+                            relocated.update(renumbered)
+                            for pk, location in renumbered.items():
+                                if pk in cards:
+                                    cards[pk].location = location
+                            rank = order.rank_after(after)
+
+                    card.list_id = target.id
+                    card.location = rank
+                    order.add(card)
+                    dirty_cards.add(card.id)
+                    moved.add(card.id)
+
+                elif kind in ('archive', 'unarchive'):
+                    card = get(cards, op, 'card', 'Card')
+                    card.archived = kind == 'archive'
+                    dirty_cards.add(card.id)
+
+                elif kind == 'tag':
+                    card = get(cards, op, 'card', 'Card')
+                    if op.get('tag') not in tags:
+                        raise OperationError("Tag not found")
+                    key = (card.id, op['tag'])
+                    removed_tags.discard(key)
+                    if key not in card_tags:
+                        new_tags[key] = CardTag(board=board, card_id=card.id, tag_id=op['tag'])
+                    reindex.add(card.id)
+
+                elif kind == 'untag':
+                    card = get(cards, op, 'card', 'Card')
+                    if op.get('tag') not in tags:
+                        raise OperationError("Tag not found")
+                    key = (card.id, op.get('tag'))
+                    new_tags.pop(key, None)
+                    if key in card_tags:
+                        removed_tags.add(key)
+                    reindex.add(card.id)
+
+                elif kind == 'task':
+                    task = get(tasks, op, 'task', 'Task')
+                    # Only a real boolean, bool("false") would tick it
+                    if not isinstance(op.get('done'), bool):
+                        raise OperationError("'done' must be true or false")
+                    task.done = op['done']
+                    dirty_tasks[task.id] = task
+                    recount.add(task.card_id)
+
+                elif kind == 'add_task':
+                    card = get(cards, op, 'card', 'Card')
+                    name = op.get('name')
+                    if not isinstance(name, str) or not name or len(name) > Task._meta.get_field('name').max_length:
+                        raise OperationError("Invalid task name")
+                    new_tasks.append(Task(board=board, card=card, name=name))
+                    reindex.add(card.id)
+                    recount.add(card.id)
+
+                else:
+                    raise OperationError("Unknown operation")
+
+                results.append({"ok": True})
+
+            except OperationError as e:
+                results.append({"ok": False, "error": str(e)})
+
+        # Write everything back
+        now = timezone.now()
+        for card in (cards[pk] for pk in dirty_cards):
+            card.date_modified = now
+        Card.objects.bulk_update([cards[pk] for pk in dirty_cards], ['list', 'location', 'archived', 'date_modified'], batch_size=1000)
+
+        # Cards that only got renumbered by a rebalance, without being loaded as part of the batch
+        untouched = [Card(id=pk, location=location) for pk, location in relocated.items() if pk not in dirty_cards]
+        Card.objects.bulk_update(untouched, ['location'], batch_size=1000)
+
+        Task.objects.bulk_update(list(dirty_tasks.values()), ['done'], batch_size=1000)
+        Task.objects.bulk_create(new_tasks, batch_size=1000)
+        CardTag.objects.bulk_create(list(new_tags.values()), batch_size=1000, ignore_conflicts=True)
+        if removed_tags:
+            CardTag.objects.filter(id__in=[card_tags[key].id for key in removed_tags]).delete()
+
+        # bulk_* skip the model signals, so update the search index and counters, invalidate the board (and tell
+        # anyone watching) once for the whole batch, and add its activity in one go
+        reindex_cards(reindex)
+        recount_cards(recount)
+        bump_board_version(board.id)
+        if new_tags:
+            invalidate_tag_index(board.id)
+        record_change(board.id, 'board', 'changed', board.id)
+
+        Verb = Activity.Verb
+        events = [activity.event(board.id, Verb.CARD_MOVED, pk, cards[pk].title) for pk in sorted(moved)]
+        events += [activity.event(board.id, Verb.CARD_ARCHIVED, card.id, card.title)
+            for card in (cards[pk] for pk in sorted(dirty_cards)) if card.archived and card.id not in was_archived]
+        events += [activity.event(board.id, Verb.TASK_DONE, task.card_id, task.name)
+            for task in dirty_tasks.values() if task.done and task.id not in was_done]
+        events += [activity.event(board.id, Verb.TASK_ADDED, task.card_id, task.name) for task in new_tasks]
+        Activity.objects.bulk_create(events)
+
+    return results
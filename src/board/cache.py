@@ -0,0 +1,115 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from .loader import load_board
+from .databases import mark_written, up_to_date
+
+"""
+Board Snapshot Cache
+====================
+
+Boards get read a lot more often than they get written to, so the nested structure built by the loader is kept in
+Django's cache framework. Each board has a version counter, snapshots are stored under the version they were built
+for, and any write to the board (see signals.py) bumps the counter so the old snapshot is simply never looked up
+again and ages out of the cache by itself.
+
+The version is bumped after the writing transaction commits, so a snapshot can never be built from data older than
+the version it's stored under.
+"""
+
+SNAPSHOT_TIMEOUT = getattr(settings, 'BOARD_SNAPSHOT_TIMEOUT', 60 * 60)
+
+def version_key(board_id):
+    return 'board:%s:version' % board_id
+
+def snapshot_key(board_id, version):
+    return 'board:%s:snapshot:%s' % (board_id, version)
+
+def json_key(board_id, version):
+    return 'board:%s:json:%s' % (board_id, version)
+
+def get_version(key):
+    """
+    Returns the current value of a version counter. If the counter has been evicted it is restarted from the clock
+    rather than from 1, otherwise it could land back on a version that still has (old) data cached against it.
+    """
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+def get_versions(keys):
+    """
+    get_version() for a lot of counters at once, in a couple of round trips to the cache. Returns {key: version}.
+    """
+    versions = cache.get_many(keys)
+    missing = {key: time.time_ns() for key in keys if key not in versions}
+    if missing:
+        for key, version in missing.items():
+            cache.add(key, version, timeout=None)
+        # Whatever won the add, or the clock value we tried if the cache has already dropped it again
+        versions.update({**missing, **cache.get_many(list(missing))})
+    return versions
+
+def bump_version(key):
+    """
+    Moves a version counter on, deferred until the current transaction (if any) commits.
+    """
+    def bump():
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, time.time_ns(), timeout=None)
+
+    transaction.on_commit(bump)
+
+def get_board_version(board_id):
+    return get_version(version_key(board_id))
+
+def get_board_versions(board_ids):
+    """
+    {board_id: version} for a lot of boards at once.
+    """
+    versions = get_versions([version_key(board_id) for board_id in board_ids])
+    return {board_id: versions[version_key(board_id)] for board_id in board_ids}
+
+def bump_board_version(board_id):
+    """
+    Invalidates every cached snapshot of a board.
+    """
+    bump_version(version_key(board_id))
+    mark_written('board', board_id)
+
+def get_board_snapshot(board_id):
+    """
+    Cached version of loader.load_board, raises Board.DoesNotExist the same way.
+    """
+    key = snapshot_key(board_id, get_board_version(board_id))
+    snapshot = cache.get(key)
+    if snapshot is None:
+        with up_to_date('board', [board_id]):
+            snapshot = load_board(board_id)
+        cache.set(key, snapshot, SNAPSHOT_TIMEOUT)
+    return snapshot
+
+def get_board_json(board_id):
+    """
+    The board snapshot encoded as JSON (bytes) for the board API, cached per version like the snapshot itself so an
+    unchanged board is only ever serialised once.
+    """
+    key = json_key(board_id, get_board_version(board_id))
+    content = cache.get(key)
+    if content is None:
+        snapshot = get_board_snapshot(board_id)
+        content = DjangoJSONEncoder().encode({
+            "board": snapshot["board"],
+            "members": snapshot["members"],
+            "lists": snapshot["lists"],
+        }).encode()
+        cache.set(key, content, SNAPSHOT_TIMEOUT)
+    return content
@@ -0,0 +1,132 @@
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import *
+from .loader import load_board
+from .realtime import publish
+
+"""
+Board Change Log
+================
+
+Every change to a board's contents gets appended to BoardChange with the next number in the board's sequence, and
+is pushed out to anyone watching live (see realtime.py) with that number attached. A client that drops off can then
+ask for the changes since the last number it saw instead of downloading the whole board again.
+
+Bumping Board.change_seq and inserting the change happen in the one transaction, so the board row lock keeps the
+sequence in commit order with no gaps. Bulk writes that skip the model signals log a single "board.changed", and
+clients are sent a full snapshot instead when they hit one of those.
+
+Payloads carry the whole (small) state of the object, never a diff, so applying a change twice is harmless.
+"""
+
+MAX_CHANGES = getattr(settings, 'BOARD_CHANGES_MAX', 500)
+RETENTION = getattr(settings, 'BOARD_CHANGES_RETENTION', timedelta(days=30))
+
+# Boards in the middle of being deleted, their children's post_delete signals shouldn't log anything
+_deleting = threading.local()
+
+def deleting_boards():
+    if not hasattr(_deleting, 'ids'):
+        _deleting.ids = set()
+    return _deleting.ids
+
+@contextmanager
+def deleting(board_ids):
+    """
+    Marks 'board_ids' as being deleted for the length of the block, whether the delete goes through or not.
+    """
+    ids = set(board_ids) - deleting_boards()
+    deleting_boards().update(ids)
+    try:
+        yield
+    finally:
+        deleting_boards().difference_update(ids)
+
+def forget_deleting(**kwargs):
+    # Boards only get marked by the pre_delete signal when they're deleted along with something else (their
+    # author), a delete like that failing would leave them marked, but not past the end of the request
+    deleting_boards().clear()
+
+request_started.connect(forget_deleting, dispatch_uid='board.changes.forget_deleting')
+
+def record_change(board_id, entity, op, object_id=None, **payload):
+    """
+    Appends a change to the boards log and publishes it, returns the new sequence number (None if the board has gone).
+    """
+    if board_id in deleting_boards():
+        return None
+
+    with transaction.atomic():
+        if not Board.objects.filter(id=board_id).update(change_seq=F('change_seq') + 1):
+            return None
+        seq = Board.objects.filter(id=board_id).values_list('change_seq', flat=True).get()
+        BoardChange.objects.create(board_id=board_id, seq=seq, entity=entity, op=op, object_id=object_id, payload=payload)
+
+    publish(board_id, '%s.%s' % (entity, op), seq=seq, id=object_id, **payload)
+    return seq
+
+def get_changes(board_id, since):
+    """
+    Get Changes
+    -----------
+
+    Everything that happened to a board after sequence number 'since'. Returns
+
+        {"seq": latest seq, "changes": [{seq, entity, op, id, data}, ...]}
+
+    or, when the client is too far behind (changes compacted away, too many of them, or a bulk "board.changed" in the
+    way), a full snapshot to start over from
+
+        {"seq": seq the snapshot is at least as new as, "reset": true, "snapshot": {...}}
+
+    Raises Board.DoesNotExist.
+    """
+    seq = Board.objects.filter(id=board_id).values_list('change_seq', flat=True).get()
+    if since == seq:
+        return {"seq": seq, "changes": []}
+
+    changes = list(BoardChange.objects.filter(board=board_id, seq__gt=since).order_by('seq')[:MAX_CHANGES + 1])
+
+    if (since > seq or len(changes) > MAX_CHANGES or not changes or changes[0].seq != since + 1
+            or any(c.entity == 'board' and c.op == 'changed' for c in changes)):
+        # The snapshot is loaded after reading 'seq' so it has at least everything up to there
+        snapshot = load_board(board_id)
+        snapshot.pop("member_ids")
+        return {"seq": seq, "reset": True, "snapshot": snapshot}
+
+    return {
+        "seq": changes[-1].seq,
+        "changes": [{
+            "seq": c.seq,
+            "entity": c.entity,
+            "op": c.op,
+            "id": c.object_id,
+            "data": c.payload,
+        } for c in changes],
+    }
+
+def compact_changes(before=None, keep=MAX_CHANGES, chunk_size=1000):
+    """
+    Deletes changes older than 'before' (default now - BOARD_CHANGES_RETENTION), always keeping the newest 'keep' of
+    each board. Deletes in chunks so it never holds big locks, returns how many were removed.
+    """
+    before = before or timezone.now() - RETENTION
+    removed = 0
+
+    for board_id, seq in Board.objects.filter(change_seq__gt=keep).values_list('id', 'change_seq').iterator():
+        old = BoardChange.objects.filter(board=board_id, seq__lte=seq - keep, date_created__lt=before)
+        while True:
+            ids = list(old.values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                break
+            removed += BoardChange.objects.filter(id__in=ids).delete()[0]
+
+    return removed
@@ -0,0 +1,91 @@
+from django.db import connection, transaction
+
+from .models import *
+from .export import Importer, create_board, export_rows, import_rows
+
+"""
+Board Templates and Cloning
+===========================
+
+Copies a board's lists, cards, tags, card tags and tasks (and optionally its comments and their reactions) into a
+new board in one transaction. It's the export and import (see export.py) without the JSON in between: rows are read
+a chunk at a time in id order and inserted with bulk_create a batch at a time, new ids are mapped from old in
+memory, so the number of queries depends on the size of the board over the batch size rather than on the number of
+rows.
+
+Attachments are copied as rows pointing at the same files, nothing is uploaded or copied on disk (files are only
+removed once nothing refers to them, see attachments.py). The search index is copied too, with the new ids, by the
+database itself (see copy_search_entries) rather than working it all out again from the text.
+
+Members aren't copied, the new board is the cloner's alone (they're its owner) until they share it.
+
+Templates are boards marked is_template, anyone who can read one can start a new board from it. Other boards can be
+cloned by their admins.
+"""
+
+BATCH_SIZE = 1000
+
+# Everything a clone copies, comments (and reactions) only when asked
+KINDS = ('tag', 'list', 'card', 'cardtag', 'task', 'attachment')
+COMMENT_KINDS = ('comment', 'reaction')
+
+# What search entries are kept for (see search.py), all named the same as their line types
+SOURCES = ('card', 'task', 'comment', 'tag')
+
+def copy_search_entries(source_id, board, ids, batch_size=BATCH_SIZE):
+    """
+    Copies the source boards search entries to 'board', 'ids' is {source: {old id: new id}} from the Importer
+    (sources are named the same as line types). Entries for anything that wasn't copied are left behind.
+
+    A big board has hundreds of thousands of entries, far too many to bring back and send again, so the old to new
+    ids go into temporary tables and the database copies the rows itself with one INSERT ... SELECT. Cards get a
+    table to themselves because MySQL can't use a temporary table twice in one query.
+    """
+    entries = connection.ops.quote_name(SearchEntry._meta.db_table)
+    objects = [(source, old, new) for source in SOURCES for old, new in ids.get(source, {}).items()]
+    drop = 'DROP TEMPORARY TABLE' if connection.vendor == 'mysql' else 'DROP TABLE'
+
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE TEMPORARY TABLE clone_cards (old_id bigint PRIMARY KEY, new_id bigint NOT NULL)')
+        cursor.execute('CREATE TEMPORARY TABLE clone_objects (source varchar(8) NOT NULL, old_id bigint NOT NULL, '
+            'new_id bigint NOT NULL, PRIMARY KEY (source, old_id))')
+        try:
+            cards = list(ids["card"].items())
+            for i in range(0, len(cards), batch_size):
+                cursor.executemany('INSERT INTO clone_cards VALUES (%s, %s)', cards[i:i + batch_size])
+            for i in range(0, len(objects), batch_size):
+                cursor.executemany('INSERT INTO clone_objects VALUES (%s, %s, %s)', objects[i:i + batch_size])
+
+            cursor.execute(
+                'INSERT INTO %s (board_id, card_id, source, object_id, term, weight) '
+                'SELECT %%s, c.new_id, e.source, o.new_id, e.term, e.weight FROM %s e '
+                'JOIN clone_cards c ON c.old_id = e.card_id '
+                'JOIN clone_objects o ON o.source = e.source AND o.old_id = e.object_id '
+                'WHERE e.board_id = %%s' % (entries, entries), [board.id, source_id])
+            return cursor.rowcount
+        finally:
+            cursor.execute('%s clone_cards' % drop)
+            cursor.execute('%s clone_objects' % drop)
+
+def clone_board(board_id, owner, title=None, comments=False, batch_size=BATCH_SIZE):
+    """
+    Clone Board
+    -----------
+
+    Copies board 'board_id' into a new board owned by 'owner', titled 'title' (the same title if they don't have a
+    board called that already). Returns (board, {row type: rows copied}).
+    """
+    kinds = KINDS + COMMENT_KINDS if comments else KINDS
+    rows = export_rows(board_id, batch_size, kinds)
+    header = next(rows)
+
+    with transaction.atomic():
+        board = create_board(header, owner, title, suffix='copy')
+        importer = Importer(board, owner, batch_size, remember=('tag', 'list', 'card', 'task', 'comment'))
+        import_rows(importer, enumerate(rows, 2))
+        if not comments:
+            Card.objects.filter(board=board).update(comment_count=0)
+
+        copy_search_entries(board_id, board, importer.ids, batch_size)
+
+    return board, importer.counts
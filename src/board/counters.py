@@ -0,0 +1,65 @@
+from django.db.models import Case, Count, F, IntegerField, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
+
+from .models import *
+
+"""
+Card and Comment Counters
+=========================
+
+Cards keep their own task/comment/attachment totals and comments keep a total per reaction type, so anything
+showing a card badge ("3/7 tasks, 12 comments, 2 files") reads them straight off the row instead of COUNT-ing.
+
+The receivers in signals.py move the counters with F() updates as things are added and removed, which is atomic in
+the database no matter how many requests are doing it at once. Anything going around the signals (bulk writes, or
+a counter that has drifted) can be put right with recount_cards()/recount_comments(), which is what the
+'manage.py recount_counters' command does.
+
+Card.save() and Comment.save() never write the counters back, see the models.
+"""
+
+REACTION_COUNTERS = {r.value: '%s_count' % r.name.lower() for r in Reaction.Reactions}
+
+def adjust(model, pk, **deltas):
+    """
+    Atomically adds 'deltas' ({field: amount}) to the counters of one row.
+    """
+    deltas = {field: F(field) + amount if amount > 0 else
+        # Never below zero, even if the counter has drifted (the fields are unsigned)
+        Case(When(**{'%s__gte' % field: -amount}, then=F(field) + amount), default=Value(0))
+        for field, amount in deltas.items() if amount}
+    if deltas:
+        model.objects.filter(pk=pk).update(**deltas)
+
+def count_of(model, key, **filters):
+    """
+    Correlated subquery counting 'model' rows pointing at the outer row through 'key'.
+    """
+    counted = (model.objects.filter(**{key: OuterRef('pk')}, **filters).order_by().values(key)
+        .annotate(total=Count('pk')).values('total'))
+    return Coalesce(Subquery(counted, output_field=IntegerField()), Value(0))
+
+def recount_cards(cards):
+    """
+    Recomputes every counter on 'cards' (a queryset or ids) with one UPDATE.
+    """
+    if not isinstance(cards, models.QuerySet):
+        cards = Card.objects.filter(id__in=list(cards))
+
+    return cards.order_by().update(
+        task_count=count_of(Task, 'card'),
+        task_done_count=count_of(Task, 'card', done=True),
+        comment_count=count_of(Comment, 'card'),
+        attachment_count=count_of(Attachment, 'card'),
+    )
+
+def recount_comments(comments):
+    """
+    Recomputes the reaction counters on 'comments' (a queryset or ids) with one UPDATE.
+    """
+    if not isinstance(comments, models.QuerySet):
+        comments = Comment.objects.filter(id__in=list(comments))
+
+    return comments.order_by().update(**{
+        field: count_of(Reaction, 'comment', reaction=reaction) for reaction, field in REACTION_COUNTERS.items()
+    })
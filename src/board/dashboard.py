@@ -0,0 +1,100 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from .models import *
+from .cache import get_version, get_board_versions
+from .permissions import access_version_key
+from .databases import up_to_date
+
+"""
+Dashboard
+=========
+
+Everything the dashboard lists about a users boards, without touching each board one at a time.
+
+    1. which boards the user owns or is a member of (and their access), cached per user and thrown away whenever
+       their access version moves (membership or authorship changes, see permissions.py)
+    2. a summary of each of those boards (title, card and task totals, last activity), cached per board version so
+       any change to a board's contents replaces its summary, see cache.py
+
+Both are fetched from the cache in bulk, and whatever isn't there is worked out with one query (the totals come
+from the counters kept on each card, see counters.py). A warm dashboard is a few cache round trips and no queries
+no matter how many boards the user has.
+"""
+
+DASHBOARD_TIMEOUT = getattr(settings, 'BOARD_SNAPSHOT_TIMEOUT', 60 * 60)
+
+def boards_key(user_id, version):
+    return 'user:%s:boards:%s' % (user_id, version)
+
+def summary_key(board_id, version):
+    return 'board:%s:summary:%s' % (board_id, version)
+
+def user_boards(user):
+    """
+    {board_id: access} for every board 'user' authored or is a member of.
+    """
+    key = boards_key(user.id, get_version(access_version_key(user.id)))
+    boards = cache.get(key)
+    if boards is None:
+        boards = dict(BoardMember.objects.filter(member=user, board__archived=False).values_list('board_id', 'access'))
+        boards.update({board_id: BoardMember.Access.OWNER
+            for board_id in Board.objects.filter(author=user, archived=False).values_list('id', flat=True)})
+        cache.set(key, boards, DASHBOARD_TIMEOUT)
+    return boards
+
+def summarise_boards(board_ids):
+    """
+    Summaries of 'board_ids' straight from the database, one query for any number of boards.
+    """
+    latest_change = BoardChange.objects.filter(board=OuterRef('pk')).order_by('-seq').values('date_created')[:1]
+    cards = Q(card__archived=False)
+
+    rows = (Board.objects.filter(id__in=board_ids).order_by()
+        .values('id', 'title', 'description', 'is_template', 'date_modified')
+        .annotate(
+            card_count=Count('card', filter=cards),
+            task_count=Coalesce(Sum('card__task_count', filter=cards), 0),
+            task_done_count=Coalesce(Sum('card__task_done_count', filter=cards), 0),
+            last_change=Subquery(latest_change),
+        ))
+
+    summaries = {}
+    for row in rows:
+        last_change = row.pop("last_change")
+        modified = row.pop("date_modified")
+        row["open_task_count"] = row["task_count"] - row["task_done_count"]
+        row["last_activity"] = max(last_change, modified) if last_change else modified
+        summaries[row["id"]] = row
+    return summaries
+
+def load_dashboard(user):
+    """
+    Load Dashboard
+    --------------
+
+    Every board 'user' owns or belongs to, most recently active first:
+
+        [{id, title, description, access, card_count, task_count, task_done_count, open_task_count,
+          last_activity}, ...]
+    """
+    boards = user_boards(user)
+    if not boards:
+        return []
+
+    versions = get_board_versions(list(boards))
+    keys = {board_id: summary_key(board_id, version) for board_id, version in versions.items()}
+    cached = cache.get_many(list(keys.values()))
+    summaries = {board_id: cached[key] for board_id, key in keys.items() if key in cached}
+
+    missing = [board_id for board_id in boards if board_id not in summaries]
+    if missing:
+        with up_to_date('board', missing):
+            fresh = summarise_boards(missing)
+        cache.set_many({keys[board_id]: summary for board_id, summary in fresh.items()}, DASHBOARD_TIMEOUT)
+        summaries.update(fresh)
+
+    return sorted(({**summary, "access": boards[board_id]} for board_id, summary in summaries.items()),
+        key=lambda b: (b["last_activity"], b["id"]), reverse=True)
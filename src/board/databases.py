@@ -0,0 +1,170 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+"""
+Database Connections and Replicas
+=================================
+
+Connections are kept open between requests (CONN_MAX_AGE in DATABASES) instead of a new MySQL connection for every
+request, which makes them a pool of one per worker thread. A connection the server has dropped in the meantime
+(wait_timeout, a restart) would only be noticed when the first query fails, so with CONN_HEALTH_CHECKS set it's
+pinged at the start of each request and reopened if it's gone. Django 4.1 does that itself for the same setting,
+check_connections() below is only connected on older versions.
+
+Reads can go to replicas, the aliases in DATABASE_REPLICAS, through ReplicaRouter. Only the views wrapped in
+@replica_reads use them (the board, dashboard and search pages), everything else stays on the primary, writes and
+any reads after a write in the same request included. ReplicaMiddleware has to be installed for any of it.
+
+Replicas lag behind, so for DATABASE_REPLICA_LAG seconds:
+
+    - someone who has just written anything reads everything from the primary (ReplicaMiddleware notices the
+      write), they see their own changes straight away
+    - someone whose access has just changed reads everything from the primary, or their new access map (and
+      board list) could be built from before the change and cached
+    - boards that have just been written to build their cached snapshots and dashboard summaries from the
+      primary, see up_to_date(), for the same reason
+
+Anyone else reading a board that's just changed might get a moment old search result or page of comments, which
+is what a replica is for. Locally two SQLite files can stand in for a primary and a replica, see
+todo/replica_settings.py.
+"""
+
+_routing = ContextVar('board_database_routing', default=None)
+
+class Routing:
+    """
+    Where the current requests reads go, and whether it's written anything.
+    """
+    def __init__(self):
+        self.replica = None
+        self.wrote = False
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+def replica_lag():
+    return getattr(settings, 'DATABASE_REPLICA_LAG', 5)
+
+def written_key(kind, object_id):
+    return 'replica:written:%s:%s' % (kind, object_id)
+
+def mark_written(kind, object_id):
+    """
+    Keeps reads about a 'board' or 'user' on the primary for a while once the current transaction commits.
+    """
+    if replicas():
+        transaction.on_commit(lambda: cache.set(written_key(kind, object_id), True, replica_lag()))
+
+def recently_written(kind, object_ids):
+    return bool(cache.get_many([written_key(kind, object_id) for object_id in object_ids]))
+
+@contextmanager
+def primary():
+    """
+    Reads from the primary inside the block, even in a view that's using a replica.
+    """
+    routing = _routing.get()
+    replica = routing.replica if routing else None
+    if routing:
+        routing.replica = None
+    try:
+        yield
+    finally:
+        if routing:
+            routing.replica = replica
+
+@contextmanager
+def up_to_date(kind, object_ids):
+    """
+    For building something that gets cached about 'object_ids': if any of them were written recently the replica
+    might not have it yet, and whatever's cached would stay out of date, so read from the primary.
+    """
+    routing = _routing.get()
+    if routing is None or routing.replica is None or not recently_written(kind, object_ids):
+        yield
+    else:
+        with primary():
+            yield
+
+def replica_reads(view):
+    """
+    Replica Reads
+    -------------
+
+    Decorator for read only views, their queries go to one of the replicas for GET and HEAD requests unless the
+    user has written (or been given access to something) in the last DATABASE_REPLICA_LAG seconds.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        routing = _routing.get()
+        if (routing is None or not replicas() or request.method not in ('GET', 'HEAD')
+                or recently_written('user', [request.user.id])):
+            return view(request, *args, **kwargs)
+
+        routing.replica = random.choice(replicas())
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            routing.replica = None
+    return wrapper
+
+class ReplicaMiddleware:
+    """
+    Tracks routing for each request and keeps someone on the primary for a while after they write. Goes after
+    AuthenticationMiddleware.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        routing = Routing()
+        token = _routing.set(routing)
+        try:
+            response = self.get_response(request)
+        finally:
+            _routing.reset(token)
+
+        if routing.wrote and replicas() and request.user.is_authenticated:
+            cache.set(written_key('user', request.user.id), True, replica_lag())
+        return response
+
+class ReplicaRouter:
+    """
+    Reads in @replica_reads views go to the replica picked for the request, everything else to the primary.
+    """
+    def db_for_read(self, model, **hints):
+        routing = _routing.get()
+        # Once a request has written its reads have to see it
+        if routing is None or routing.replica is None or routing.wrote:
+            return DEFAULT_DB_ALIAS
+        return routing.replica
+
+    def db_for_write(self, model, **hints):
+        routing = _routing.get()
+        if routing is not None:
+            routing.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas have the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, *replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+def check_connections(**kwargs):
+    for connection in connections.all():
+        if (connection.connection is not None and connection.settings_dict.get('CONN_HEALTH_CHECKS')
+                and not connection.in_atomic_block and not connection.is_usable()):
+            connection.close()
+
+if django.VERSION < (4, 1):
+    request_started.connect(check_connections, dispatch_uid='board.databases.check_connections')
@@ -0,0 +1,154 @@
+import json
+import logging
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from .models import *
+from .instrumentation import fingerprint
+from .search import reindex_cards
+from .sessions import discard_sessions
+from .workload import SCALES, generate_workload
+
+"""
+Query Plan Checks
+=================
+
+Runs the board pages against a generated workload (see workload.py), catches every SELECT they send and asks the
+database how it would run each one. Plans that read a whole table, or sort rows the index couldn't hand back in
+order, are flagged, so a missing index shows up here instead of once a board is big enough to notice.
+
+What counts as a problem in the plan depends on the database:
+
+    MySQL       type ALL (full table scan), type index (full index scan), Using filesort, Using temporary
+    SQLite      SCAN <table>, USE TEMP B-TREE
+    Postgres    Seq Scan, Sort
+
+Like the benchmarks, everything generated is rolled back afterwards. Small tables are often scanned on purpose
+(it's cheaper than the index), which is why it wants a realistically sized workload.
+"""
+
+def pages(client, board):
+    """
+    [(name, request), ...] for the board pages worth checking, each requested with an empty cache so the queries
+    behind it actually run.
+    """
+    card = Card.objects.filter(board=board, archived=False).order_by('list_id', 'location', 'id').first()
+    comments = reverse('card-comments', kwargs={"board_id": board.id, "card_id": card.id})
+    activity = reverse('board-activity', kwargs={"board_id": board.id})
+    cards = reverse('list-cards', kwargs={"board_id": board.id, "list_id": card.list_id})
+    task = Task.objects.filter(card=card).first()
+
+    def next_page(url):
+        # The second page is the one filtering on a cursor
+        cursor = client.get(url, {"limit": 1}).json()["next"]
+        return client.get(url, {"limit": 1, "cursor": cursor or ''})
+
+    operations = [{"op": "move", "card": card.id, "list": card.list_id}]
+    if task is not None:
+        operations.append({"op": "task", "task": task.id, "done": not task.done})
+
+    return [
+        ("board_view", lambda: client.get(reverse('board-main', kwargs={"board_id": board.id}))),
+        ("board_api", lambda: client.get(reverse('board-api', kwargs={"board_id": board.id}))),
+        ("board_changes", lambda: client.get(reverse('board-changes', kwargs={"board_id": board.id}), {"since": 0})),
+        ("board_search", lambda: client.get(reverse('board-search', kwargs={"board_id": board.id}), {"q": 'drill'})),
+        ("board_tags", lambda: client.get(reverse('board-api', kwargs={"board_id": board.id}), {"tags": 'bug'})),
+        ("search", lambda: client.get(reverse('search'), {"q": 'core sample'})),
+        ("dashboard", lambda: client.get(reverse('dashboard'))),
+        ("card_comments", lambda: next_page(comments)),
+        ("list_cards", lambda: next_page(cards)),
+        ("activity", lambda: next_page(reverse('activity'))),
+        ("board_activity", lambda: next_page(activity)),
+        ("board_bulk", lambda: client.post(reverse('board-bulk', kwargs={"board_id": board.id}),
+            json.dumps({"operations": operations}), content_type='application/json')),
+    ]
+
+def capture_selects(request):
+    """
+    Calls 'request', returns the (sql, params) of every SELECT it ran.
+    """
+    selects = []
+    def wrapper(execute, sql, params, many, context):
+        if sql.lstrip().upper().startswith('SELECT'):
+            selects.append((sql, params))
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(wrapper):
+        response = request()
+    if response.status_code >= 400:
+        raise RuntimeError('Responded %s' % response.status_code)
+    return selects
+
+def explain(sql, params):
+    """
+    The databases plan for a query, as a list of lines.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+        cursor.execute('EXPLAIN ' + sql, params)
+        if connection.vendor == 'mysql':
+            columns = [c[0] for c in cursor.description]
+            return ['table=%(table)s type=%(type)s key=%(key)s rows=%(rows)s extra=%(Extra)s' % dict(zip(columns, row))
+                for row in cursor.fetchall()]
+        return [row[0] for row in cursor.fetchall()]
+
+def problems(plan):
+    """
+    The lines of a plan (from explain()) that read a whole table or sort outside an index.
+    """
+    if connection.vendor == 'sqlite':
+        return [line for line in plan
+            if (line.startswith('SCAN ') and not line.startswith('SCAN CONSTANT')) or 'TEMP B-TREE' in line]
+    if connection.vendor == 'mysql':
+        return [line for line in plan if ' type=ALL ' in line or ' type=index ' in line
+            or 'Using filesort' in line or 'Using temporary' in line]
+    return [line for line in plan if 'Seq Scan' in line or line.strip().startswith(('Sort ', '->  Sort '))]
+
+def check_queries(scale='medium'):
+    """
+    Check Queries
+    -------------
+
+    Generates the 'scale' workload and explains every distinct query the board pages run on one of its boards.
+
+        [{"page", "sql", "plan": [lines], "problems": [lines]}, ...]    one per distinct query, in the order seen
+    """
+    checked = {}
+    performance = logging.getLogger('board.performance')
+    level = performance.level
+    performance.setLevel(logging.ERROR)
+
+    try:
+        with override_settings(ALLOWED_HOSTS=['testserver'], QUERY_BUDGET_RAISE=False), transaction.atomic():
+            workload = generate_workload(**SCALES[scale], prefix='explain-%s' % scale, index=False)
+            board = Board.objects.select_related('author').get(id=workload["boards"][0])
+            reindex_cards(Card.objects.filter(board=board).values_list('id', flat=True))
+            if connection.vendor in ('sqlite', 'postgresql'):
+                # Fresh statistics, or the planner guesses at table sizes (MySQL's ANALYZE TABLE would commit)
+                with connection.cursor() as cursor:
+                    cursor.execute('ANALYZE')
+
+            client = Client()
+            client.force_login(board.author)
+
+            for name, request in pages(client, board):
+                cache.clear()
+                for sql, params in capture_selects(request):
+                    key = fingerprint(sql)
+                    if key not in checked:
+                        plan = explain(sql, params)
+                        checked[key] = {"page": name, "sql": sql, "plan": plan, "problems": problems(plan)}
+
+            transaction.set_rollback(True)
+    finally:
+        performance.setLevel(level)
+        discard_sessions()
+        cache.clear()
+
+    return list(checked.values())
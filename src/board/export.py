@@ -0,0 +1,304 @@
+import json
+
+from django.contrib.auth.models import User
+from django.db import IntegrityError, connection, transaction
+
+from .models import *
+from .permissions import invalidate_user_access
+from .search import reindex_cards
+
+"""
+Board Export and Import
+=======================
+
+A board and everything on it as JSON Lines, one object per line, for moving boards between sites or keeping a
+copy. Unlike dumpdata it's one board at a time and never has the whole board in memory: export reads each table
+in chunks of primary keys and writes lines as it goes, import reads lines as they come and inserts them in
+batches. Lines come parents first, so by the time a card comes along its list has already been imported.
+
+    {"type": "board", "format": 1, "title": ..., "description": ...}
+    {"type": "member", "id": ..., "user": username, "access": ...}
+    {"type": "tag", "id": ..., "name": ..., "colour": ...}
+    {"type": "list", "id": ..., "title": ..., "location": ...}
+    {"type": "card", "id": ..., "list": list id, "author": username, "title": ..., ...}
+    {"type": "cardtag", "id": ..., "card": card id, "tag": tag id}
+    {"type": "task", "id": ..., "card": card id, "name": ..., "done": ...}
+    {"type": "comment", "id": ..., "card": card id, "author": username, "comment": ..., ...}
+    {"type": "reaction", "id": ..., "comment": comment id, "author": username, "reaction": ...}
+    {"type": "attachment", "id": ..., "card": card id, "author": username, "file": ..., "name": ..., ...}
+
+Ids are the exporting sites, import gives everything new ones and keeps a map of old to new for the rows other
+rows point at (lists, cards, tags and comments). People are exported by username, on import anyone without an
+account on this site becomes the importing user. Attachments are a manifest, the files themselves are left to be
+copied across with the rest of the media (same names, so deduplicated blobs stay deduplicated).
+
+The change log and uploads in progress aren't exported, the search index is rebuilt on import and dates are when
+it was imported.
+"""
+
+FORMAT = 1
+
+# Cards reindexed at a time after an import, each card has a couple of dozen search entries
+REINDEX_BATCH = 200
+
+# (type, model, {key in the line: field lookup}), parents before children
+TABLES = (
+    ('member', BoardMember, {"user": 'member__username', "access": 'access'}),
+    ('tag', Tag, {"name": 'name', "colour": 'colour'}),
+    ('list', List, {"title": 'title', "location": 'location'}),
+    ('card', Card, {"list": 'list', "author": 'author__username', "location": 'location', "title": 'title',
+        "description": 'description', "archived": 'archived', "task_count": 'task_count',
+        "task_done_count": 'task_done_count', "comment_count": 'comment_count',
+        "attachment_count": 'attachment_count'}),
+    ('cardtag', CardTag, {"card": 'card', "tag": 'tag'}),
+    ('task', Task, {"card": 'card', "name": 'name', "done": 'done'}),
+    ('comment', Comment, {"card": 'card', "author": 'author__username', "comment": 'comment',
+        "like_count": 'like_count', "dislike_count": 'dislike_count', "checkmark_count": 'checkmark_count',
+        "cross_count": 'cross_count'}),
+    ('reaction', Reaction, {"comment": 'comment', "author": 'author__username', "reaction": 'reaction'}),
+    ('attachment', Attachment, {"card": 'card', "author": 'author__username', "file": 'file', "name": 'name',
+        "size": 'size', "sha256": 'sha256'}),
+)
+
+class BoardImportError(ValueError):
+    pass
+
+def chunked(queryset, size):
+    """
+    Rows of a .values() queryset in primary key order, 'size' at a time. Each chunk is its own query starting after
+    the last id seen, so nothing holds more than a chunk, whatever the database driver does with big results.
+    """
+    last = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last).order_by('id')[:size])
+        yield from rows
+        if len(rows) < size:
+            return
+        last = rows[-1]["id"]
+
+def export_rows(board_id, chunk_size=2000, kinds=None):
+    """
+    The objects of a boards export (before they're turned into lines), the board first. 'kinds' limits it to those
+    line types.
+    """
+    board = Board.objects.filter(id=board_id).values('title', 'description').get()
+    yield {"type": 'board', "format": FORMAT, **board}
+
+    for kind, model, fields in TABLES:
+        if kinds is not None and kind not in kinds:
+            continue
+        rows = model.objects.filter(**{'comment__board' if model is Reaction else 'board': board_id})
+        rows = rows.values('id', *fields.values())
+        for row in chunked(rows, chunk_size):
+            yield {"type": kind, "id": row["id"], **{key: row[lookup] for key, lookup in fields.items()}}
+
+def export_board(board_id, chunk_size=2000):
+    """
+    Export Board
+    ------------
+
+    Generates the lines (with their newlines) of a boards export, for a StreamingHttpResponse or a file.
+    """
+    for row in export_rows(board_id, chunk_size):
+        yield json.dumps(row) + '\n'
+
+class Importer:
+    """
+    Builds rows from export lines and inserts them a batch at a time, remembering the new id of every row something
+    else might point at.
+    """
+    PARENTS = ('tag', 'list', 'card', 'comment')
+
+    def __init__(self, board, owner, batch_size, remember=PARENTS):
+        self.board = board
+        self.owner = owner
+        self.batch_size = batch_size
+        self.ids = {kind: {} for kind in remember}
+        self.users = {owner.username: owner.id}
+        self.pending = []
+        self.numbers = []
+        self.pending_kind = None
+        self.counts = {}
+
+    def user(self, username):
+        return self.users.get(username, self.owner.id)
+
+    def find_users(self, lines):
+        # One query per batch for any usernames not seen yet
+        names = {line[key] for line in lines for key in ('author', 'user') if line.get(key) not in (None, *self.users)}
+        if names:
+            found = dict(User.objects.filter(username__in=names).values_list('username', 'id'))
+            self.users.update({name: found.get(name, self.owner.id) for name in names})
+
+    def old(self, kind, old_id):
+        try:
+            return self.ids[kind][old_id]
+        except KeyError:
+            raise BoardImportError("%s %s isn't in the export" % (kind, old_id))
+
+    def build(self, line):
+        kind, board = line["type"], self.board
+        if kind == 'member':
+            # There's only one owner, the importing user
+            access = BoardMember.Access.ADMIN if line["access"] == BoardMember.Access.OWNER else line["access"]
+            return BoardMember(board=board, member_id=self.user(line["user"]), access=access)
+        if kind == 'tag':
+            return Tag(board=board, name=line["name"], colour=line["colour"])
+        if kind == 'list':
+            return List(board=board, title=line["title"], location=line["location"])
+        if kind == 'card':
+            return Card(board=board, list_id=self.old('list', line["list"]), author_id=self.user(line["author"]),
+                location=line["location"], title=line["title"], description=line["description"],
+                archived=line["archived"], task_count=line["task_count"], task_done_count=line["task_done_count"],
+                comment_count=line["comment_count"], attachment_count=line["attachment_count"])
+        if kind == 'cardtag':
+            return CardTag(board=board, card_id=self.old('card', line["card"]), tag_id=self.old('tag', line["tag"]))
+        if kind == 'task':
+            return Task(board=board, card_id=self.old('card', line["card"]), name=line["name"], done=line["done"])
+        if kind == 'comment':
+            return Comment(board=board, card_id=self.old('card', line["card"]), author_id=self.user(line["author"]),
+                comment=line["comment"], like_count=line["like_count"], dislike_count=line["dislike_count"],
+                checkmark_count=line["checkmark_count"], cross_count=line["cross_count"])
+        if kind == 'reaction':
+            return Reaction(comment_id=self.old('comment', line["comment"]), author_id=self.user(line["author"]),
+                reaction=line["reaction"])
+        if kind == 'attachment':
+            return Attachment(board=board, card_id=self.old('card', line["card"]), author_id=self.user(line["author"]),
+                file=line["file"], name=line["name"], size=line["size"], sha256=line["sha256"])
+        raise BoardImportError("Unknown line type '%s'" % kind)
+
+    def add(self, line, number=None):
+        if line.get("type") != self.pending_kind:
+            self.flush()
+            self.pending_kind = line.get("type")
+        self.pending.append(line)
+        self.numbers.append(number)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        lines, numbers, kind = self.pending, self.numbers, self.pending_kind
+        if not lines:
+            return
+        self.pending, self.numbers = [], []
+
+        self.find_users(lines)
+        rows = []
+        # Built a batch after they were read, so the error says which line it was rather than the one being read
+        for number, line in zip(numbers, lines):
+            try:
+                rows.append(self.build(line))
+            except (ValueError, KeyError, TypeError) as e:
+                raise BoardImportError("Line %s: %s" % (number, e))
+        model = type(rows[0])
+        # Members are already unique per board, except the owner who's added up front
+        if kind == 'member':
+            pairs = [(line, row) for line, row in zip(lines, rows) if row.member_id != self.owner.id]
+            lines, rows = [p[0] for p in pairs], [p[1] for p in pairs]
+            if not rows:
+                return
+        # Two people without accounts here both become the importing user, and can't both react the same way
+        try:
+            model.objects.bulk_create(rows, ignore_conflicts=kind == 'reaction')
+        except IntegrityError as e:
+            raise BoardImportError("Lines %s to %s: %s" % (numbers[0], numbers[-1], e))
+        self.counts[kind] = self.counts.get(kind, 0) + len(rows)
+
+        if kind in self.ids:
+            self.ids[kind].update(zip((line["id"] for line in lines), self.created_ids(model, rows)))
+
+    def created_ids(self, model, rows):
+        """
+        The ids bulk_create gave 'rows', in order.
+        """
+        if connection.features.can_return_rows_from_bulk_insert:
+            return [row.pk for row in rows]
+        # MySQL doesn't say, but the board is new and its rows only visible to this transaction, so ours are the
+        # latest ones on it (and ids go up in insert order)
+        return sorted(model.objects.filter(board=self.board).order_by('-id').values_list('id', flat=True)[:len(rows)])
+
+def create_board(header, owner, title=None, suffix='imported'):
+    """
+    The new board (and its owner membership) an import goes into. Must be called in a transaction.
+    """
+    base = title = (title or header["title"])[:45]
+    # One query for the titles it could clash with, then "title (copy)", "title (copy 2)" and so on, cut to fit
+    taken = set(Board.objects.filter(author=owner, title__startswith=base[:20]).values_list('title', flat=True))
+    number = 1
+    while title in taken:
+        label = suffix if number == 1 else '%s %s' % (suffix, number)
+        title = '%s (%s)' % (base[:42 - len(label)], label)
+        number += 1
+    board = Board.objects.create(title=title, author=owner, description=header.get("description", ''))
+    BoardMember.objects.create(board=board, member=owner, access=BoardMember.Access.OWNER)
+    return board
+
+def import_rows(importer, rows):
+    """
+    Feeds (line number, object) pairs to 'importer' and flushes what's left at the end.
+    """
+    for number, row in rows:
+        try:
+            importer.add(row, number)
+        except BoardImportError:
+            raise
+        except (ValueError, KeyError, TypeError) as e:
+            raise BoardImportError("Line %s: %s" % (number, e))
+    importer.flush()
+
+def parse_lines(lines):
+    """
+    (line number, object) for each line of 'lines', (line number, text) pairs, skipping blank ones.
+    """
+    for number, text in lines:
+        if not text.strip():
+            continue
+        try:
+            yield number, json.loads(text)
+        except ValueError as e:
+            raise BoardImportError("Line %s: %s" % (number, e))
+
+def reindex_board(board):
+    cards = []
+    for card in chunked(Card.objects.filter(board=board).values('id'), REINDEX_BATCH):
+        cards.append(card["id"])
+        if len(cards) == REINDEX_BATCH:
+            reindex_cards(cards)
+            cards = []
+    if cards:
+        reindex_cards(cards)
+
+def invalidate_members(board):
+    # bulk_create doesn't send the signals that would normally tell members about their new board
+    for user_id in BoardMember.objects.filter(board=board).values_list('member_id', flat=True):
+        invalidate_user_access(user_id)
+
+def import_board(lines, owner, title=None, batch_size=1000):
+    """
+    Import Board
+    ------------
+
+    Creates a new board for 'owner' from the lines of an export (any iterable of strings, a file works). Returns
+    (board, {line type: rows imported}). All or nothing, raises BoardImportError for anything that isn't an export.
+    """
+    # Numbered as they're read, the header is line 1
+    lines = enumerate(lines, 1)
+    try:
+        header = json.loads(next(lines)[1])
+    except (StopIteration, ValueError):
+        raise BoardImportError("Not a board export")
+    if not isinstance(header, dict) or header.get("type") != 'board' or header.get("format") != FORMAT:
+        raise BoardImportError("Not a board export (or a newer format)")
+
+    try:
+        with transaction.atomic():
+            board = create_board(header, owner, title)
+            importer = Importer(board, owner, batch_size)
+            import_rows(importer, parse_lines(lines))
+            reindex_board(board)
+            invalidate_members(board)
+    except IntegrityError as e:
+        # A board of the same title made at the same time (or one only the database thinks is the same)
+        raise BoardImportError("Couldn't create the board: %s" % e)
+
+    return board, importer.counts
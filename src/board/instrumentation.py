@@ -0,0 +1,171 @@
+import json
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.template.backends.django import DjangoTemplates, Template
+
+"""
+Request Instrumentation
+=======================
+
+Measures every request: how many SQL queries it ran, how long they took, how long templates took to render and
+which queries it ran more than once (the same statement with different parameters, i.e. an N+1 loop). The numbers
+go out in a Server-Timing header (so they show up in the browser's network tab) and in one structured line per
+request on the 'board.performance' logger.
+
+Views can declare how many queries they're allowed:
+
+    @login_required(login_url='/login/')
+    @query_budget(10)
+    def some_view(request):
+        ...
+
+Going over logs a warning, and with QUERY_BUDGET_RAISE on (as it is for the board tests) raises
+QueryBudgetExceeded instead so the test that caused it fails.
+
+Template timing needs the DjangoTemplates backend swapped for InstrumentedTemplates in settings.TEMPLATES.
+record_queries() gives the same numbers for code that isn't a request (tests, management commands).
+"""
+
+logger = logging.getLogger('board.performance')
+
+_current = ContextVar('request_metrics', default=None)
+
+STRINGS = re.compile(r"'(?:[^']|'')*'")
+NUMBERS = re.compile(r'\b\d+\b')
+IN_LISTS = re.compile(r'\((?:\s*(?:%s|\?)\s*,)+\s*(?:%s|\?)\s*\)')
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+def fingerprint(sql):
+    """
+    A query with its values taken out, so the same statement run with different parameters looks the same.
+    """
+    sql = STRINGS.sub('?', sql)
+    sql = NUMBERS.sub('?', sql)
+    sql = IN_LISTS.sub('(...)', sql)
+    return ' '.join(sql.split())
+
+class RequestMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        # A connection execute_wrapper, sees every query on the connections it's installed on
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+            self.fingerprints[fingerprint(sql)] += 1
+
+    @property
+    def total_time(self):
+        return time.perf_counter() - self.started
+
+    def duplicates(self):
+        return {sql: count for sql, count in self.fingerprints.most_common() if count > 1}
+
+    def server_timing(self):
+        return 'db;dur=%.1f;desc="%s queries", tpl;dur=%.1f, total;dur=%.1f' % (
+            self.db_time * 1000, self.queries, self.template_time * 1000, self.total_time * 1000)
+
+@contextmanager
+def record_queries():
+    """
+    Collects RequestMetrics for everything run inside the block, on every database connection.
+    """
+    metrics = RequestMetrics()
+    token = _current.set(metrics)
+    try:
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(metrics))
+            yield metrics
+    finally:
+        _current.reset(token)
+
+def query_budget(queries):
+    """
+    Declares the most queries a view should ever need, see QueryInstrumentationMiddleware.
+    """
+    def decorator(view):
+        view.query_budget = queries
+        return view
+    return decorator
+
+class InstrumentedTemplate(Template):
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None:
+            return super().render(context, request)
+
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.template_time += time.perf_counter() - start
+
+class InstrumentedTemplates(DjangoTemplates):
+    """
+    The Django template backend, with the time spent rendering added to the current requests metrics.
+    """
+    def from_string(self, template_code):
+        return InstrumentedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return InstrumentedTemplate(template.template, self)
+
+class QueryInstrumentationMiddleware:
+    """
+    Query Instrumentation Middleware
+    --------------------------------
+
+    Wants to be first in MIDDLEWARE so the session/auth queries are counted too.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with record_queries() as metrics:
+            request._query_budget = None
+            response = self.get_response(request)
+
+        response['Server-Timing'] = metrics.server_timing()
+
+        budget = request._query_budget
+        over = budget is not None and metrics.queries > budget
+        line = {
+            "method": request.method,
+            "path": request.path,
+            "view": getattr(request.resolver_match, 'view_name', None),
+            "status": response.status_code,
+            "queries": metrics.queries,
+            "budget": budget,
+            "db_ms": round(metrics.db_time * 1000, 1),
+            "template_ms": round(metrics.template_time * 1000, 1),
+            "total_ms": round(metrics.total_time * 1000, 1),
+            "duplicates": metrics.duplicates(),
+        }
+        logger.log(logging.WARNING if over else logging.INFO, json.dumps(line))
+
+        if over and getattr(settings, 'QUERY_BUDGET_RAISE', False):
+            raise QueryBudgetExceeded('%s ran %s queries, its budget is %s. Repeated queries: %s' % (
+                line["view"], metrics.queries, budget, json.dumps(line["duplicates"], indent=4)))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._query_budget = getattr(view_func, 'query_budget', None)
@@ -0,0 +1,273 @@
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+
+import django
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Count, F, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.db.models.lookups import LessThan
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import *
+
+"""
+Background Jobs
+===============
+
+A job queue kept in the database (the Job table), so slow work can be handed off by a request without needing a
+broker running anywhere. Jobs are inserted in the same transaction as whatever asked for them, so a request that
+rolls back never leaves a job behind and one that commits never loses one.
+
+    @job(concurrency=2)
+    def render_thumbnails(name):
+        ...
+
+    render_thumbnails.delay(name)       # or enqueue(render_thumbnails, name)
+
+'manage.py run_jobs' claims jobs and runs them on a pool of worker processes. Claiming uses SELECT ... FOR UPDATE
+SKIP LOCKED where the database has it (MySQL 8, Postgres) so any number of workers can claim at once without
+waiting on each other. SQLite has no row locks, there each job is claimed with a conditional UPDATE instead (only
+one writer at a time gets to change a row from pending to running, and for a type with a concurrency limit the
+same UPDATE counts the running ones).
+
+A job that raises is tried again later, waiting twice as long after each failure, until it runs out of attempts.
+A job left running by a worker that died is picked up again once it has been running longer than JOBS_TIMEOUT, if
+it has attempts left (one that keeps killing its worker is failed instead). Jobs can be run more than once that way
+so they should be safe to repeat.
+
+Workers claiming a type of job that has a concurrency limit take turns, holding its JobType row locked while they
+count how many are running and claim more, so two of them can't both take the last free slot.
+"""
+
+BACKOFF = getattr(settings, 'JOBS_BACKOFF', 10)
+MAX_BACKOFF = getattr(settings, 'JOBS_MAX_BACKOFF', 60 * 60)
+TIMEOUT = getattr(settings, 'JOBS_TIMEOUT', 15 * 60)
+
+def job(concurrency=None, max_attempts=5):
+    """
+    Marks a function as a job, 'concurrency' is the most of them that get run at once (None for no limit). Jobs
+    must be module level functions taking JSON-serialisable arguments.
+    """
+    def decorate(func):
+        func.job_concurrency = concurrency
+        func.job_max_attempts = max_attempts
+        func.delay = lambda *args, **kwargs: enqueue(func, *args, **kwargs)
+        return func
+    return decorate
+
+def job_name(func):
+    return '%s.%s' % (func.__module__, func.__qualname__)
+
+def enqueue(func, *args, delay=0, **kwargs):
+    """
+    Queues 'func' (a job, or its dotted path) to be called with 'args'/'kwargs' no sooner than 'delay' seconds from
+    now. Part of the current transaction.
+    """
+    if isinstance(func, str):
+        func = import_string(func)
+    return Job.objects.create(name=job_name(func), args=list(args), kwargs=kwargs,
+        max_attempts=getattr(func, 'job_max_attempts', 5), run_at=timezone.now() + timedelta(seconds=delay))
+
+def concurrency_of(name):
+    try:
+        return getattr(import_string(name), 'job_concurrency', None)
+    except ImportError:
+        return None
+
+def backoff(attempts):
+    """
+    Seconds to wait before trying again after 'attempts' failures, doubling each time with some jitter so a batch
+    of jobs failing together doesn't all come back together.
+    """
+    return min(BACKOFF * 2 ** (attempts - 1), MAX_BACKOFF) * random.uniform(0.75, 1.25)
+
+def running_jobs(name, stale):
+    return Job.objects.filter(name=name, status=Job.Status.RUNNING, locked_at__gte=stale)
+
+def claim(worker, limit):
+    """
+    Claims up to 'limit' jobs that are due for 'worker', returns them. Job types at their concurrency limit are
+    left for later.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=TIMEOUT)
+    due = (Q(status=Job.Status.PENDING, run_at__lte=now)
+        | Q(status=Job.Status.RUNNING, locked_at__lt=stale, attempts__lt=F('max_attempts')))
+
+    # Died with its worker on its last attempt, it won't be tried again
+    Job.objects.filter(status=Job.Status.RUNNING, locked_at__lt=stale, attempts__gte=F('max_attempts')).update(
+        status=Job.Status.FAILED, last_error='Still running after %s seconds on its last attempt' % TIMEOUT,
+        locked_by='', locked_at=None)
+
+    running = {}
+    limits = {}
+    claimed = []
+
+    with transaction.atomic():
+        skip_locked = connection.features.has_select_for_update_skip_locked
+        candidates = Job.objects.filter(due).order_by('run_at', 'id')
+        if skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+
+        # A few extra so jobs stuck behind a type at its limit don't hold everything else up
+        for job in candidates[:limit * 4]:
+            if job.name not in limits:
+                limits[job.name] = concurrency_of(job.name)
+                if limits[job.name] is not None:
+                    # Held until this commits, so the count includes whatever other workers have claimed
+                    JobType.objects.select_for_update().get_or_create(name=job.name)
+                    running[job.name] = running_jobs(job.name, stale).count()
+            if limits[job.name] is not None and running[job.name] >= limits[job.name]:
+                continue
+
+            # Without row locks someone else may have got there first, only the UPDATE that still sees it due (and
+            # its type under the limit, counted by the UPDATE itself) wins
+            if not skip_locked:
+                mine = Job.objects.filter(due, id=job.id, attempts=job.attempts)
+                if limits[job.name] is not None:
+                    total = running_jobs(job.name, stale).order_by().values('name').annotate(total=Count('id'))
+                    total = Coalesce(Subquery(total.values('total')), 0)
+                    mine = mine.filter(LessThan(total, Value(limits[job.name])))
+                if not mine.update(status=Job.Status.RUNNING, locked_by=worker, locked_at=now,
+                        attempts=F('attempts') + 1):
+                    continue
+
+            claimed.append(job)
+            if job.name in running:
+                running[job.name] += 1
+            if len(claimed) == limit:
+                break
+
+        if skip_locked and claimed:
+            Job.objects.filter(id__in=[j.id for j in claimed]).update(status=Job.Status.RUNNING, locked_by=worker,
+                locked_at=now, attempts=F('attempts') + 1)
+
+    for job in claimed:
+        job.status, job.locked_by, job.locked_at, job.attempts = Job.Status.RUNNING, worker, now, job.attempts + 1
+    return claimed
+
+def run_job(job_id, worker):
+    """
+    Runs a claimed job and records how it went. Returns True if it succeeded.
+    """
+    job = Job.objects.filter(id=job_id, locked_by=worker).first()
+    if job is None:
+        return False
+
+    try:
+        import_string(job.name)(*job.args, **job.kwargs)
+    except Exception:
+        error = traceback.format_exc()
+    else:
+        # Only if it's still ours, a job that took longer than the timeout may have been claimed again
+        Job.objects.filter(id=job.id, locked_by=worker).delete()
+        return True
+
+    finished = Job.objects.filter(id=job.id, locked_by=worker)
+    if job.attempts >= job.max_attempts:
+        finished.update(status=Job.Status.FAILED, last_error=error, locked_by='', locked_at=None)
+    else:
+        finished.update(status=Job.Status.PENDING, last_error=error, locked_by='', locked_at=None,
+            run_at=timezone.now() + timedelta(seconds=backoff(job.attempts)))
+    return False
+
+def run_pending(limit=None, worker=None):
+    """
+    Runs every due job in this process, one at a time. Returns how many were run.
+    """
+    worker = worker or default_worker_id()
+    ran = 0
+    while limit is None or ran < limit:
+        jobs = claim(worker, 1)
+        if not jobs:
+            break
+        run_job(jobs[0].id, worker)
+        ran += 1
+    return ran
+
+def default_worker_id():
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+def run_in_process(job_id, worker):
+    # Ctrl-C goes to the whole process group, the parent lets running jobs finish rather than have them interrupted
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # What Django does around each request, long lived worker processes shouldn't hang on to dead connections
+    close_old_connections()
+    try:
+        return run_job(job_id, worker)
+    finally:
+        close_old_connections()
+
+class Worker:
+    """
+    Worker
+    ------
+
+    Claims jobs and hands them to a pool of 'processes' worker processes, polling every 'poll' seconds when there's
+    nothing to do. processes=0 runs jobs in this process instead. Stops once the jobs in hand are finished on
+    SIGTERM/SIGINT (or when nothing is due, with once=True).
+    """
+    def __init__(self, processes=2, poll=1.0):
+        self.processes = processes
+        self.poll = poll
+        self.id = default_worker_id()
+        self.stopping = False
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def run(self, once=False):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        if not self.processes:
+            while not self.stopping:
+                if not run_pending(worker=self.id) and once:
+                    return
+                if not once:
+                    time.sleep(self.poll)
+            return
+
+        pool = self.make_pool()
+        running = set()
+        try:
+            while not self.stopping or running:
+                free = 0 if self.stopping else self.processes - len(running)
+                jobs = claim(self.id, free) if free else []
+                for job in jobs:
+                    running.add(pool.submit(run_in_process, job.id, self.id))
+
+                if not running:
+                    if once:
+                        return
+                    # Nothing due, give the database a rest before asking again
+                    time.sleep(self.poll)
+                    continue
+
+                done, running = wait(running, timeout=self.poll, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        future.result()
+                    except BrokenProcessPool:
+                        # A worker process died mid-job, its job gets picked up again after the timeout
+                        pool.shutdown(wait=False, cancel_futures=True)
+                        pool, running = self.make_pool(), set()
+                        break
+        finally:
+            pool.shutdown(wait=True)
+
+    def make_pool(self):
+        # Worker processes are started fresh ('spawn') rather than forked with copies of our database connections
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'),
+            initializer=django.setup)
@@ -0,0 +1,103 @@
+from .models import *
+
+"""
+Board Loader
+============
+
+Builds everything the board page needs in a fixed number of queries, no matter how many lists, cards or members
+the board has. The result is a plain nested structure of dicts/lists so it can go straight into a template (or
+anywhere else) without any more lazy lookups happening behind our backs.
+
+Queries issued:
+    1. the board (with its author)
+    2. board members (with their users and avatars)
+    3. lists
+    4. cards
+    5. card tags (with their tags)
+
+Task/comment/attachment totals come from the counters kept on each card (see counters.py).
+"""
+
+def load_board(board_id):
+    """
+    Load Board
+    ----------
+
+    Returns the nested board structure for 'board_id', raises Board.DoesNotExist if there isn't one.
+
+        {
+            "board":      {id, title, description, author_id, author, date_created, date_modified},
+            "members":    [{id, username, access, avatar}, ...],
+            "member_ids": {user ids of every member},
+            "lists":      [{id, title, location, "cards": [card, ...]}, ...],
+        }
+
+    where each (unarchived) card looks like
+
+        {id, list_id, title, description, location, author_id, date_modified,
+         "tags": [{id, name, colour}, ...], task_count, task_done_count, comment_count, attachment_count}
+    """
+    board = Board.objects.select_related('author').get(id=board_id)
+
+    members = [{
+        "id": m["member_id"],
+        "username": m["member__username"],
+        "access": m["access"],
+        "avatar": m["member__profile__avatar"] or None,
+    } for m in BoardMember.objects.filter(board=board).order_by('id')
+        .values('member_id', 'member__username', 'access', 'member__profile__avatar')]
+
+    tags = {}
+    for ct in CardTag.objects.filter(board=board).select_related('tag').order_by('tag__name'):
+        tags.setdefault(ct.card_id, []).append({
+            "id": ct.tag_id,
+            "name": ct.tag.name,
+            "colour": ct.tag.colour,
+        })
+
+    lists = []
+    by_list = {}
+    for l in List.objects.filter(board=board).order_by('location', 'id'):
+        entry = {
+            "id": l.id,
+            "title": l.title,
+            "location": l.location,
+            "cards": [],
+        }
+        lists.append(entry)
+        by_list[l.id] = entry
+
+    for c in Card.objects.filter(board=board, archived=False).order_by('list_id', 'location', 'id'):
+        if c.list_id not in by_list:
+            continue
+
+        by_list[c.list_id]["cards"].append({
+            "id": c.id,
+            "list_id": c.list_id,
+            "title": c.title,
+            "description": c.description,
+            "location": c.location,
+            "author_id": c.author_id,
+            "date_modified": c.date_modified,
+            "tags": tags.get(c.id, []),
+            "task_count": c.task_count,
+            "task_done_count": c.task_done_count,
+            "comment_count": c.comment_count,
+            "attachment_count": c.attachment_count,
+        })
+
+    return {
+        "board": {
+            "id": board.id,
+            "title": board.title,
+            "description": board.description,
+            "author_id": board.author_id,
+            "author": board.author.username,
+            "is_template": board.is_template,
+            "date_created": board.date_created,
+            "date_modified": board.date_modified,
+        },
+        "members": members,
+        "member_ids": {m["id"] for m in members},
+        "lists": lists,
+    }
@@ -0,0 +1,45 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand
+
+from board.benchmark import run_benchmark, run_session_benchmark, compare
+from board.workload import SCALES
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks the main pages against generated boards at each --scale and writes the results as JSON. "
+        "Nothing is left in the database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', nargs='+', choices=SCALES, default=['small', 'medium'])
+        parser.add_argument('--requests', type=int, default=50, help="Requests timed per endpoint")
+        parser.add_argument('--warmup', type=int, default=5, help="Untimed requests first")
+        parser.add_argument('--output', help="Write the JSON results here instead of to stdout")
+        parser.add_argument('--compare', help="Earlier results to compare against, exits with 1 if anything regressed")
+        parser.add_argument('--threshold', type=float, default=1.2, help="How many times slower counts as regressed")
+        parser.add_argument('--sessions', action='store_true',
+            help="Compare logging in and per request session overhead between session engines instead")
+
+    def handle(self, *args, **options):
+        if options['sessions']:
+            results = run_session_benchmark(requests=options['requests'], warmup=options['warmup'])
+        else:
+            results = run_benchmark(options['scales'], options['requests'], options['warmup'])
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            for r in results["results"]:
+                self.stdout.write('%-8s %-16s p50 %8.2f  p90 %8.2f  p99 %8.2f ms  %3d queries' % (
+                    r["scale"], r["endpoint"], r["p50_ms"], r["p90_ms"], r["p99_ms"], r["queries"]))
+        else:
+            self.stdout.write(json.dumps(results, indent=2))
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                lines, regressed = compare(json.load(f), results, options['threshold'])
+            for line in lines:
+                self.stderr.write(line)
+            if regressed:
+                sys.exit(1)
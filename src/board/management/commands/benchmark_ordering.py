@@ -0,0 +1,44 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from board.models import *
+from board.ordering import GAP, move_card
+
+
+class Command(BaseCommand):
+    help = "Times moving a card into the middle of lists of increasing size, nothing is left in the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 5000])
+        parser.add_argument('--moves', type=int, default=200)
+
+    def handle(self, *args, **options):
+        self.stdout.write('%8s %12s %10s' % ('cards', 'ms/move', 'queries'))
+
+        for size in options['sizes']:
+            with transaction.atomic():
+                user = User.objects.create(username='benchmark-ordering')
+                board = Board.objects.create(title='Ordering benchmark', author=user)
+                lst = List.objects.create(board=board, title='List', location=GAP)
+                Card.objects.bulk_create(
+                    Card(board=board, list=lst, author=user, location=(i + 1) * GAP) for i in range(size))
+
+                cards = list(Card.objects.filter(list=lst).order_by('location'))
+                middle = cards[size // 2]
+
+                # Alternate the last card between two places in the middle, each move lands in a fresh gap
+                moving = cards[-1]
+                with CaptureQueriesContext(connection) as ctx:
+                    start = time.perf_counter()
+                    for i in range(options['moves']):
+                        move_card(moving, after=cards[size // 2 + (i % 2)] if size > 2 else middle)
+                    elapsed = time.perf_counter() - start
+
+                self.stdout.write('%8d %12.3f %10.1f' % (
+                    size, elapsed * 1000 / options['moves'], len(ctx.captured_queries) / options['moves']))
+
+                transaction.set_rollback(True)
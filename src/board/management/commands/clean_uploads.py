@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from board.models import Upload
+from board.attachments import discard_upload
+
+
+class Command(BaseCommand):
+    help = "Discards resumable uploads that haven't had a chunk in a while, along with their part files."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24, help="Discard uploads idle for longer than this")
+
+    def handle(self, *args, **options):
+        stale = Upload.objects.filter(date_modified__lt=timezone.now() - timedelta(hours=options['hours']))
+        removed = 0
+        for upload in stale.iterator():
+            discard_upload(upload)
+            removed += 1
+        self.stdout.write('Discarded %s uploads' % removed)
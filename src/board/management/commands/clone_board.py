@@ -0,0 +1,37 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from board.models import Board
+from board.clone import clone_board, BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = ("Copies a board (lists, cards, tags, tasks, members and attachments, --comments for comments too) into a "
+        "new board owned by --owner.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('board', type=int, help="Id of the board to copy")
+        parser.add_argument('--owner', help="Username of the new boards owner, the original boards owner if left out")
+        parser.add_argument('--title', help="Title for the new board, the same one if left out")
+        parser.add_argument('--comments', action='store_true', help="Copy comments and reactions too")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Rows inserted per query")
+
+    def handle(self, *args, **options):
+        try:
+            board = Board.objects.select_related('author').get(id=options['board'])
+        except Board.DoesNotExist:
+            raise CommandError("No board %s" % options['board'])
+
+        owner = board.author
+        if options['owner']:
+            try:
+                owner = User.objects.get(username=options['owner'])
+            except User.DoesNotExist:
+                raise CommandError("No user called '%s'" % options['owner'])
+
+        start = time.perf_counter()
+        copy, counts = clone_board(board.id, owner, options['title'], options['comments'], options['batch_size'])
+        self.stdout.write('Copied board %s into board %s "%s" in %.1fs: %s' % (board.id, copy.id, copy.title,
+            time.perf_counter() - start, ', '.join('%s %s' % (count, kind) for kind, count in counts.items())))
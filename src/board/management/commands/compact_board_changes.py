@@ -0,0 +1,18 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from board.changes import compact_changes, MAX_CHANGES, RETENTION
+
+
+class Command(BaseCommand):
+    help = "Deletes old entries from the board change log, clients that far behind get a full snapshot instead."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=RETENTION.days, help="Keep changes newer than this many days")
+        parser.add_argument('--keep', type=int, default=MAX_CHANGES, help="Always keep this many changes per board")
+
+    def handle(self, *args, **options):
+        removed = compact_changes(timezone.now() - timedelta(days=options['days']), options['keep'])
+        self.stdout.write('Removed %s board changes' % removed)
@@ -0,0 +1,30 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from board.explain import check_queries
+from board.workload import SCALES
+
+
+class Command(BaseCommand):
+    help = ("EXPLAINs the queries behind the board pages on generated data and reports any that scan a whole table "
+        "or sort outside an index. Nothing is left in the database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=SCALES, default='medium')
+        parser.add_argument('--all', action='store_true', help="Show every plan, not just the flagged ones")
+        parser.add_argument('--fail', action='store_true', help="Exit with 1 if anything was flagged")
+
+    def handle(self, *args, **options):
+        results = check_queries(options['scale'])
+        flagged = [r for r in results if r["problems"]]
+
+        for r in results if options['all'] else flagged:
+            self.stdout.write('[%s] %s' % (r["page"], r["sql"]))
+            for line in r["plan"]:
+                self.stdout.write('    %s%s' % ('!! ' if line in r["problems"] else '', line))
+            self.stdout.write('')
+
+        self.stdout.write('%s queries checked, %s flagged' % (len(results), len(flagged)))
+        if flagged and options['fail']:
+            sys.exit(1)
@@ -0,0 +1,26 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from board.models import Board
+from board.export import export_board
+
+
+class Command(BaseCommand):
+    help = "Writes a board and everything on it out as JSON Lines, a chunk of rows at a time."
+
+    def add_arguments(self, parser):
+        parser.add_argument('board', type=int)
+        parser.add_argument('--output', help="Write here instead of to stdout")
+        parser.add_argument('--chunk-size', type=int, default=2000, help="Rows read per query")
+
+    def handle(self, *args, **options):
+        if not Board.objects.filter(id=options['board']).exists():
+            raise CommandError("Board %s doesn't exist" % options['board'])
+
+        out = open(options['output'], 'w', encoding='utf-8') if options['output'] else sys.stdout
+        try:
+            out.writelines(export_board(options['board'], options['chunk_size']))
+        finally:
+            if out is not sys.stdout:
+                out.close()
@@ -0,0 +1,45 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from board.workload import SCALES, generate_workload
+
+
+class Command(BaseCommand):
+    help = "Fills the database with generated users and boards. Use a --scale or give the sizes yourself."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=SCALES, default='small')
+        for name, help in [
+            ('users', "Users"),
+            ('boards', "Boards"),
+            ('lists', "Lists per board"),
+            ('cards', "Cards per list"),
+            ('members', "Members per board"),
+            ('tags', "Tags per board"),
+            ('tasks', "Tasks per card"),
+            ('comments', "Comments per card"),
+            ('reactions', "Reactions per comment"),
+        ]:
+            parser.add_argument('--%s' % name, type=int, help="%s (overrides the scale)" % help)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='load', help="Start of every generated username and board title")
+        parser.add_argument('--no-index', action='store_true', help="Skip building the search index")
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username__startswith='%s-user-' % options['prefix']).exists():
+            raise CommandError("There are already users named %s-user-..., pick another --prefix" % options['prefix'])
+
+        sizes = dict(SCALES[options['scale']])
+        for name in ('users', 'boards', 'lists', 'cards', 'members', 'tags', 'tasks', 'comments', 'reactions'):
+            if options[name] is not None:
+                sizes[name] = options[name]
+
+        start = time.perf_counter()
+        workload = generate_workload(**sizes, seed=options['seed'], prefix=options['prefix'],
+            index=not options['no_index'])
+
+        for model, rows in workload["rows"].items():
+            self.stdout.write('%-12s %10d' % (model, rows))
+        self.stdout.write('Generated in %.1fs, every user\'s password is "password"' % (time.perf_counter() - start))
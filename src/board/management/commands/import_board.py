@@ -0,0 +1,35 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from board.export import BoardImportError, import_board
+
+
+class Command(BaseCommand):
+    help = ("Creates a new board from an export (see export_board), owned by --owner. People in the export who "
+        "don't have an account here become the owner.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help="The export, - for stdin")
+        parser.add_argument('--owner', required=True, help="Username of the new boards owner")
+        parser.add_argument('--title', help="Title for the new board, the exported one if left out")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Rows inserted per query")
+
+    def handle(self, *args, **options):
+        try:
+            owner = User.objects.get(username=options['owner'])
+        except User.DoesNotExist:
+            raise CommandError("No user called '%s'" % options['owner'])
+
+        source = sys.stdin if options['file'] == '-' else open(options['file'], encoding='utf-8')
+        try:
+            board, counts = import_board(source, owner, options['title'], options['batch_size'])
+        except BoardImportError as e:
+            raise CommandError(str(e))
+        finally:
+            if source is not sys.stdin:
+                source.close()
+
+        self.stdout.write('Imported board %s "%s": %s' % (board.id, board.title,
+            ', '.join('%s %s' % (count, kind) for kind, count in counts.items())))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from board.models import Board
+from board.purge import archive_board, purge
+
+
+class Command(BaseCommand):
+    help = ("Purges archived boards here and now rather than waiting on the job workers, still a chunk at a time. "
+        "--archive archives the given boards first.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('boards', nargs='*', type=int, help="Board ids, every archived board if left out")
+        parser.add_argument('--archive', action='store_true', help="Archive the given boards first")
+        parser.add_argument('--chunk-size', type=int, help="Rows deleted per transaction, BOARD_PURGE_CHUNK_SIZE if left out")
+
+    def handle(self, *args, **options):
+        if options['archive']:
+            for board_id in options['boards']:
+                archive_board(board_id)
+
+        boards = Board.objects.filter(archived=True)
+        if options['boards']:
+            boards = boards.filter(id__in=options['boards'])
+
+        for board_id in boards.values_list('id', flat=True):
+            purge(board_id, options['chunk_size'])
+            self.stdout.write('Purged board %s' % board_id)
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from board.models import *
+from board.search import reindex_cards
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the card search index from scratch, for every board or just the ones given."
+
+    def add_arguments(self, parser):
+        parser.add_argument('boards', type=int, nargs='*', help="Board ids, all boards if left out")
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        cards = Card.objects.order_by('id')
+        if options['boards']:
+            cards = cards.filter(board__in=options['boards'])
+
+        done, last = 0, 0
+        while True:
+            ids = list(cards.filter(id__gt=last).values_list('id', flat=True)[:options['chunk_size']])
+            if not ids:
+                break
+            reindex_cards(ids)
+            done, last = done + len(ids), ids[-1]
+
+        self.stdout.write('Indexed %s cards' % done)
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from board.models import *
+from board.counters import recount_cards, recount_comments
+
+
+class Command(BaseCommand):
+    help = "Recomputes the task/comment/attachment counters on cards and the reaction counters on comments."
+
+    def add_arguments(self, parser):
+        parser.add_argument('boards', type=int, nargs='*', help="Board ids, all boards if left out")
+
+    def handle(self, *args, **options):
+        cards, comments = Card.objects.all(), Comment.objects.all()
+        if options['boards']:
+            cards = cards.filter(board__in=options['boards'])
+            comments = comments.filter(board__in=options['boards'])
+
+        self.stdout.write('Recounted %s cards and %s comments' % (recount_cards(cards), recount_comments(comments)))
@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from board.activity import rollup_activity, RETENTION, SUMMARY_RETENTION
+
+
+class Command(BaseCommand):
+    help = ("Rolls board activity older than the retention up into daily counts, and deletes daily counts older than "
+        "the summary retention. Run it daily, one at a time.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=RETENTION.days, help="Keep events newer than this many days")
+        parser.add_argument('--summary-days', type=int, default=SUMMARY_RETENTION.days,
+            help="Keep daily counts newer than this many days")
+
+    def handle(self, *args, **options):
+        rolled, removed = rollup_activity(timezone.now() - timedelta(days=options['days']),
+            timezone.localdate() - timedelta(days=options['summary_days']))
+        self.stdout.write('Rolled up %s activity events, removed %s daily counts' % (rolled, removed))
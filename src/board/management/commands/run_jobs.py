@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from board.jobs import Worker
+
+
+class Command(BaseCommand):
+    help = "Runs background jobs from the job queue until stopped (SIGTERM/Ctrl-C lets running jobs finish first)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2, help="Worker processes, 0 runs jobs in this process")
+        parser.add_argument('--poll', type=float, default=1.0, help="Seconds between checks when there's nothing to do")
+        parser.add_argument('--once', action='store_true', help="Stop once there's nothing left that is due")
+
+    def handle(self, *args, **options):
+        worker = Worker(processes=options['processes'], poll=options['poll'])
+        self.stdout.write('Worker %s running jobs with %s processes' % (worker.id, options['processes']))
+        worker.run(once=options['once'])
@@ -1,7 +1,11 @@
+import os
+import uuid
+
 from django.db import models
 from django.conf import settings
 from django.db.models.fields import BooleanField
 from django.urls import reverse
+from django.utils import timezone
 
 """
 Project Management Board Model
@@ -19,13 +23,36 @@ Contains Models:
     Comment
     Task
     Attachment
+    Blob
+    Upload
     Tag
     CardTag
     Reaction
+    BoardChange
+    Activity
+    ActivityDay
+    SearchEntry
+    Job
+    JobType
+
+Indexes follow the queries the board pages actually run (see 'manage.py explain_queries'), and a foreign key
+gets db_index=False where a composite index or unique constraint already starts with its column, a second index
+on the same leading column is only more to write.
 
 Author: Thomas Fabian
 """
 
+def without_counters(instance, values, update_fields):
+    """
+    Counter fields are only ever moved with F() updates, so a plain save() of an instance that has been sitting in
+    memory mustn't write its (possibly stale) copies back over them. Called from _do_update, so it's only the UPDATE
+    of a row that's there that leaves them out: an INSERT (a new row, or one deleted meanwhile) writes them all, and
+    update_fields a caller gives are left as they are.
+    """
+    if update_fields is not None:
+        return values
+    return [value for value in values if value[0].name not in instance.COUNTERS]
+
 class Profile(models.Model):
     """
     Member Model
@@ -41,6 +68,8 @@ class Profile(models.Model):
     location    = models.CharField(max_length=30, blank=True)
     bio         = models.TextField(max_length=500, blank=True)
     avatar      = models.ImageField(upload_to='avatars/', null=True, blank=True)
+    # Content hash of the avatar, its thumbnails are named after it and shared with any attachment of the same picture
+    avatar_sha256 = models.CharField(max_length=64, blank=True, db_index=True)
 
     class Meta:
         ordering = ('user', )
@@ -48,6 +77,33 @@ class Profile(models.Model):
     def __str__(self):
         return self.user.username
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        # Remember what was loaded so the profile is only written (and thumbnails only made for a new avatar) when
+        # something actually changed, see signals.py
+        instance = super().from_db(db, field_names, values)
+        instance._loaded = dict(zip(field_names, values))
+        instance._loaded_avatar = instance.__dict__.get('avatar')
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._loaded = {field.attname: field.value_from_object(self) for field in self._meta.concrete_fields}
+
+    def changed_fields(self):
+        """
+        Fields edited since the profile was loaded or last saved.
+        """
+        loaded = getattr(self, '_loaded', {})
+        return [name for name, value in loaded.items() if getattr(self, name) != value]
+
+class BoardQuerySet(models.QuerySet):
+
+    def delete(self):
+        from .changes import deleting
+        with deleting(self.values_list('id', flat=True)):
+            return super().delete()
+
 class Board(models.Model):
     """
     Board Model
@@ -55,19 +111,42 @@ class Board(models.Model):
 
     This is the base model for a specific project management board. All cards and board members reference this 
     model.
+
+    Boards are archived rather than deleted, an archived board is hidden from everyone and purged in the background,
+    see purge.py. Boards marked is_template are for starting new boards from, see clone.py.
+
+    change_seq is only ever moved with F() updates by changes.py, saving a board never writes it.
     """
+    COUNTERS = ('change_seq', )
+
     title           = models.CharField(max_length=45)
     author          = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     description     = models.TextField(max_length=500, blank=True)
+    change_seq      = models.PositiveBigIntegerField(default=0)
+    archived        = models.BooleanField(default=False)
+    date_archived   = models.DateTimeField(null=True, blank=True)
+    is_template     = models.BooleanField(default=False)
     date_created    = models.DateTimeField(auto_now_add=True)
     date_modified   = models.DateTimeField(auto_now=True)
 
+    objects = BoardQuerySet.as_manager()
+
     class Meta:
         constraints = [ models.UniqueConstraint(fields=['author','title'], name='uq_board') ]
 
     def __str__(self):
         return self.title
 
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        values = without_counters(self, values, update_fields)
+        return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+
+    def delete(self, *args, **kwargs):
+        # Its children's delete signals skip what's pointless for a board that's going (see changes.py)
+        from .changes import deleting
+        with deleting([self.id]):
+            return super().delete(*args, **kwargs)
+
     def get_absolute_url(self):
         return reverse('board-main', kwargs={"board_id": str(self.id)})
 
@@ -99,19 +178,21 @@ class BoardMember(models.Model):
         WRITE = 4
 
     # Fields
-    board   = models.ForeignKey(Board, on_delete=models.CASCADE, db_index=True)
-    member  = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    board   = models.ForeignKey(Board, on_delete=models.CASCADE, db_index=False)
+    member  = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_index=False)
     access  = models.IntegerField(choices=Access.choices, default=Access.READ)
 
     class Meta:
         ordering = ('board', )
         constraints = [ models.UniqueConstraint(fields=['board','member'], name='uq_member') ]
+        # A users boards (dashboard, search) straight from the index
+        indexes = [ models.Index(fields=['member','board','access'], name='ix_member_boards') ]
 
     def __str__(self):
         return self.member.username
 
     def has_admin_privileges(self):
-        return self.access in {self.OWNER, self.ADMIN}
+        return self.access in {self.Access.OWNER, self.Access.ADMIN}
 
 class List(models.Model):
     """
@@ -119,16 +200,16 @@ class List(models.Model):
     ----------
 
     A List is a 'container' similar to what holds the cards on trello. The location field is the order 
-    left-to-right on the board, I want it to be unique so that only one list can be in a location, but I'm not
-    sure how swapping them around should work (in the case of inserting a list inbetween pre-existing or moving
-    them around)
+    left-to-right on the board, it's a sparse rank within the board (see ordering.py) so lists can be moved or
+    inserted inbetween others by changing just the one row. Ties are broken by id.
     """
-    board       = models.ForeignKey(Board, on_delete=models.CASCADE, db_index=True)
+    board       = models.ForeignKey(Board, on_delete=models.CASCADE, db_index=False)
     title       = models.CharField(max_length=45)
-    location    = models.PositiveIntegerField(unique=True)
+    location    = models.PositiveBigIntegerField()
 
     class Meta:
-        ordering = ('board', )
+        ordering = ('board', 'location', 'id', )
+        indexes = [ models.Index(fields=['board','location','id'], name='ix_list_location') ]
 
     def __str__(self):
         return self.title
@@ -142,23 +223,49 @@ class Card(models.Model):
     ----------
 
     These are the cards that are contained within a list on a board, they aren't unique and any amount of the same
-    card can be made. The content is stored in another model based on some enum choice.
+    card can be made. The content is stored in another model based on some enum choice. The location is a sparse
+    rank within its list, see ordering.py.
+
+    The *_count fields are kept up to date by counters.py, saving a card never writes them.
     """
-    board           = models.ForeignKey(Board, on_delete=models.CASCADE, db_index=True)
-    list            = models.ForeignKey(List, on_delete=models.CASCADE)
-    location        = models.PositiveIntegerField()
+    COUNTERS = ('task_count', 'task_done_count', 'comment_count', 'attachment_count')
+
+    board           = models.ForeignKey(Board, on_delete=models.CASCADE, db_index=False)
+    list            = models.ForeignKey(List, on_delete=models.CASCADE, db_index=False)
+    location        = models.PositiveBigIntegerField()
     author          = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_index=True)
     title           = models.CharField(max_length=45, default='New Card')
     description     = models.TextField(max_length=256, blank=True)
+    archived        = models.BooleanField(default=False)
+    task_count      = models.PositiveIntegerField(default=0)
+    task_done_count = models.PositiveIntegerField(default=0)
+    comment_count   = models.PositiveIntegerField(default=0)
+    attachment_count= models.PositiveIntegerField(default=0)
     date_created    = models.DateTimeField(auto_now_add=True)
     date_modified   = models.DateTimeField(auto_now=True)
 
     class Meta:
-        ordering = ('board', 'list', )
+        ordering = ('board', 'list_id', 'location', 'id', )
+        indexes = [
+            models.Index(fields=['list','location','id'], name='ix_card_location'),
+            # The board loader, a boards cards already in list order
+            models.Index(fields=['board','list','location','id'], name='ix_card_board'),
+        ]
 
     def __str__(self):
         return self.title
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        # Remember what was loaded so a move or an archive is only recorded when it happens, see signals.py
+        instance = super().from_db(db, field_names, values)
+        instance._loaded = (instance.__dict__.get('list_id'), instance.__dict__.get('archived'))
+        return instance
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        values = without_counters(self, values, update_fields)
+        return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+
     def get_tags(self):
         return CardTag.objects.filter(card=self.id)
 
@@ -170,24 +277,35 @@ class Comment(models.Model):
     Comment Model
     -------------
 
-    A Comment that can be left on a card.
+    A Comment that can be left on a card. The *_count fields are the number of each type of reaction, kept up to
+    date by counters.py.
     """
+    COUNTERS = ('like_count', 'dislike_count', 'checkmark_count', 'cross_count')
 
     board           = models.ForeignKey(Board, on_delete=models.CASCADE, db_index=True)
-    card            = models.ForeignKey(Card, on_delete=models.CASCADE)
+    card            = models.ForeignKey(Card, on_delete=models.CASCADE, db_index=False)
     author          = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     comment         = models.CharField(max_length=2048)
+    like_count      = models.PositiveIntegerField(default=0)
+    dislike_count   = models.PositiveIntegerField(default=0)
+    checkmark_count = models.PositiveIntegerField(default=0)
+    cross_count     = models.PositiveIntegerField(default=0)
     date_created    = models.DateTimeField(auto_now_add=True)
     date_modified   = models.DateTimeField(auto_now=True)
 
     class Meta:
-        ordering = ('board', 'card', )
+        ordering = ('board', 'card_id', )
+        indexes = [ models.Index(fields=['card','date_created','id'], name='ix_comment_created') ]
 
     def __str__(self):
         return self.comment
 
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        values = without_counters(self, values, update_fields)
+        return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+
     def get_reactions(self):
-        return Reaction.objects.filter(card=self.id)
+        return Reaction.objects.filter(comment=self.id)
 
 class Task(models.Model):
     """
@@ -198,22 +316,33 @@ class Task(models.Model):
     """
 
     board   = models.ForeignKey(Board, on_delete=models.CASCADE, db_index=True)
-    card    = models.ForeignKey(Card, on_delete=models.CASCADE)
+    card    = models.ForeignKey(Card, on_delete=models.CASCADE, db_index=False)
     name    = models.CharField(max_length=25)
     done    = models.BooleanField(default=False)
 
     class Meta:
-        ordering = ('board', 'card', )
+        ordering = ('board', 'card_id', )
+        # Counting a cards (done) tasks, see counters.py
+        indexes = [ models.Index(fields=['card','done'], name='ix_task_done') ]
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        # Remember what was loaded so the cards counters only move when these actually change, see counters.py
+        instance = super().from_db(db, field_names, values)
+        instance._loaded = (instance.__dict__.get('card_id'), instance.__dict__.get('done'))
+        return instance
+
 class Attachment(models.Model):
     """
     Attachment Model
     ----------------
 
-    This Model handles file attachments to cards.
+    This Model handles file attachments to cards. Files that come in through the chunked uploads (attachments.py)
+    are stored once per content hash, so 'file' can be shared by any number of attachments, 'name' is what the
+    uploader called it.
     """
     def get_board_directory_path(instance, filename):
         return 'board_%s/%s' % (instance.board.id, filename)
@@ -221,10 +350,55 @@ class Attachment(models.Model):
     board   = models.ForeignKey(Board, on_delete=models.CASCADE, db_index=True)
     card    = models.ForeignKey(Card, on_delete=models.CASCADE)
     author  = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    file    = models.FileField(upload_to=get_board_directory_path)
+    file    = models.FileField(upload_to=get_board_directory_path, max_length=255)
+    name    = models.CharField(max_length=255, blank=True)
+    size    = models.PositiveBigIntegerField(default=0)
+    sha256  = models.CharField(max_length=64, blank=True, db_index=True)
 
     class Meta:
-        ordering = ('board', 'card', )
+        ordering = ('board', 'card_id', )
+
+    def get_name(self):
+        return self.name or os.path.basename(self.file.name)
+
+class Blob(models.Model):
+    """
+    Blob Model
+    ----------
+
+    One row per stored content hash (blobs/ab/abcdef...), only there to be locked. Completing an upload locks it
+    before deciding the content is already stored, and removing the file locks it before deciding nothing uses it
+    any more, so one can't be removing what the other has just decided to share (see attachments.py).
+    """
+    sha256  = models.CharField(max_length=64, primary_key=True)
+
+    def __str__(self):
+        return self.sha256
+
+class Upload(models.Model):
+    """
+    Upload Model
+    ------------
+
+    A resumable chunked upload in progress, the chunks are written straight to a part file on disk (see
+    attachments.py) and 'received' is how much of it has arrived so far. Becomes an Attachment once it's complete.
+    """
+    id              = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    board           = models.ForeignKey(Board, on_delete=models.CASCADE)
+    card            = models.ForeignKey(Card, on_delete=models.CASCADE)
+    author          = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    name            = models.CharField(max_length=255)
+    size            = models.PositiveBigIntegerField()
+    received        = models.PositiveBigIntegerField(default=0)
+    sha256          = models.CharField(max_length=64, blank=True)
+    date_created    = models.DateTimeField(auto_now_add=True)
+    date_modified   = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ('board', 'date_created', )
+
+    def __str__(self):
+        return self.name
 
 class Tag(models.Model):
     """
@@ -235,7 +409,7 @@ class Tag(models.Model):
     model that stores the tags available for each board.
     """
 
-    board   = models.ForeignKey(Board, on_delete=models.CASCADE, db_index=True)
+    board   = models.ForeignKey(Board, on_delete=models.CASCADE, db_index=False)
     name    = models.CharField(max_length=32)
     colour  = models.CharField(max_length=6)
 
@@ -250,13 +424,15 @@ class CardTag(models.Model):
 
     References the board tags so that each card can be supplied with its own tags (uniquely of course!)
     """
-    board   = models.ForeignKey(Board, on_delete=models.CASCADE, db_index=True)
+    board   = models.ForeignKey(Board, on_delete=models.CASCADE, db_index=False)
     card    = models.ForeignKey(Card, on_delete=models.CASCADE)
-    tag     = models.ForeignKey(Tag, on_delete=models.CASCADE)
+    tag     = models.ForeignKey(Tag, on_delete=models.CASCADE, db_index=False)
 
     class Meta:
-        ordering = ('board', 'card', )
+        ordering = ('board', 'card_id', )
         constraints = [ models.UniqueConstraint(fields=['board','card','tag'], name='uq_card_tag') ]
+        # The cards carrying a tag, when a tag is renamed or deleted
+        indexes = [ models.Index(fields=['tag','card'], name='ix_card_tag') ]
 
 class Reaction(models.Model):
     """
@@ -271,11 +447,164 @@ class Reaction(models.Model):
         CHECKMARK = 3
         CROSS = 4
 
-    comment         = models.ForeignKey(Comment, on_delete=models.CASCADE)
+    comment         = models.ForeignKey(Comment, on_delete=models.CASCADE, db_index=False)
     author          = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     reaction        = models.IntegerField(choices=Reactions.choices)
     date_created    = models.DateTimeField(auto_now_add=True)
 
     class Meta:
-        ordering = ('comment', )
-        constraints = [ models.UniqueConstraint(fields=['comment','author','reaction'], name='uq_reaction') ]
\ No newline at end of file
+        ordering = ('comment_id', )
+        constraints = [ models.UniqueConstraint(fields=['comment','author','reaction'], name='uq_reaction') ]
+
+class BoardChange(models.Model):
+    """
+    Board Change Model
+    ------------------
+
+    Append-only log of changes to a board, numbered by 'seq' (per board, from Board.change_seq) so clients can ask
+    for everything since the last change they saw. Written from the model signals, see changes.py.
+    """
+    board           = models.ForeignKey(Board, on_delete=models.CASCADE, db_index=False)
+    seq             = models.PositiveBigIntegerField()
+    entity          = models.CharField(max_length=16)
+    op              = models.CharField(max_length=16)
+    object_id       = models.BigIntegerField(null=True)
+    payload         = models.JSONField(default=dict)
+    date_created    = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('board', 'seq', )
+        constraints = [ models.UniqueConstraint(fields=['board','seq'], name='uq_board_change') ]
+
+    def __str__(self):
+        return '%s.%s' % (self.entity, self.op)
+
+class Activity(models.Model):
+    """
+    Activity Model
+    --------------
+
+    Append-only record of who did what on a board, for the activity feeds (see activity.py). Kept small: what
+    happened is a number, what it happened to an id (the card, list or member) and a short copy of its title, so a
+    feed reads without going back to cards and comments that may have changed or gone since. Events older than the
+    retention are rolled up into ActivityDay.
+    """
+    class Verb(models.IntegerChoices):
+        CARD_CREATED = 1
+        CARD_MOVED = 2
+        CARD_ARCHIVED = 3
+        CARD_DELETED = 4
+        COMMENTED = 5
+        REACTED = 6
+        TASK_ADDED = 7
+        TASK_DONE = 8
+        ATTACHED = 9
+        LIST_CREATED = 10
+        MEMBER_ADDED = 11
+
+    board           = models.ForeignKey(Board, on_delete=models.CASCADE, db_index=False)
+    actor           = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, related_name='+')
+    verb            = models.PositiveSmallIntegerField(choices=Verb.choices)
+    object_id       = models.BigIntegerField(null=True)
+    text            = models.CharField(max_length=64, blank=True)
+    date_created    = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('board', 'id', )
+        # A boards events newest first, and the feeds over several boards
+        indexes = [ models.Index(fields=['board','id'], name='ix_activity_board') ]
+
+    def __str__(self):
+        return self.get_verb_display()
+
+class ActivityDay(models.Model):
+    """
+    Activity Day Model
+    ------------------
+
+    How many of each kind of event a board had on a day, what's left of its Activity once the events themselves
+    are past the retention.
+    """
+    board           = models.ForeignKey(Board, on_delete=models.CASCADE, db_index=False)
+    day             = models.DateField()
+    verb            = models.PositiveSmallIntegerField(choices=Activity.Verb.choices)
+    count           = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ('board', 'day', 'verb', )
+        constraints = [ models.UniqueConstraint(fields=['board','day','verb'], name='uq_activity_day') ]
+        # Dropping days past the summary retention across all boards
+        indexes = [ models.Index(fields=['day'], name='ix_activity_day') ]
+
+class SearchEntry(models.Model):
+    """
+    Search Entry Model
+    ------------------
+
+    One row of the inverted search index, a term found in some piece of a card's content ('source' is one of card,
+    comment, task or tag, 'object_id' is the id of that thing) with its weighted number of occurrences. Maintained
+    from the model signals, see search.py.
+    """
+    board       = models.ForeignKey(Board, on_delete=models.CASCADE, db_index=False)
+    card        = models.ForeignKey(Card, on_delete=models.CASCADE, db_index=False)
+    source      = models.CharField(max_length=8)
+    object_id   = models.BigIntegerField()
+    term        = models.CharField(max_length=32)
+    weight      = models.PositiveIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['board','term','card'], name='ix_search_term'),
+            models.Index(fields=['card','source','object_id'], name='ix_search_source'),
+        ]
+
+    def __str__(self):
+        return self.term
+
+class Job(models.Model):
+    """
+    Job Model
+    ---------
+
+    A piece of work to be done outside of the request that asked for it, picked up by 'manage.py run_jobs' (see
+    jobs.py). 'name' is the dotted path of the function to call with 'args'/'kwargs'. Jobs are deleted once they
+    succeed, the ones left with status 'failed' ran out of attempts and 'last_error' says why.
+    """
+    class Status(models.TextChoices):
+        PENDING = 'pending'
+        RUNNING = 'running'
+        FAILED = 'failed'
+
+    name            = models.CharField(max_length=200)
+    args            = models.JSONField(default=list, blank=True)
+    kwargs          = models.JSONField(default=dict, blank=True)
+    status          = models.CharField(max_length=7, choices=Status.choices, default=Status.PENDING)
+    attempts        = models.PositiveIntegerField(default=0)
+    max_attempts    = models.PositiveIntegerField(default=5)
+    run_at          = models.DateTimeField(default=timezone.now)
+    locked_by       = models.CharField(max_length=100, blank=True)
+    locked_at       = models.DateTimeField(null=True, blank=True)
+    last_error      = models.TextField(blank=True)
+    date_created    = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('run_at', 'id', )
+        indexes = [
+            models.Index(fields=['status','run_at'], name='ix_job_claim'),
+        ]
+
+    def __str__(self):
+        return self.name
+
+class JobType(models.Model):
+    """
+    Job Type Model
+    --------------
+
+    One row per job name, only there to be locked. Workers claiming jobs of a type with a concurrency limit lock it
+    first, so counting the running ones and claiming more is done by one worker at a time (see jobs.py).
+    """
+    name    = models.CharField(max_length=200, primary_key=True)
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,119 @@
+from django.db import transaction
+from django.db.models import Max
+
+from .models import *
+from .cache import bump_board_version
+from .changes import record_change
+
+"""
+List and Card Ordering
+======================
+
+Lists (within a board) and cards (within a list) are ordered by their 'location', which is a sparse rank rather
+than a 0,1,2,... index. New items get a rank GAP past the end, and moving an item between two others gives it the
+midpoint of their ranks, so an insert or a move only ever writes the one row. When two neighbours end up with no room
+between them the siblings get renumbered (rebalanced) in a single transaction, which happens rarely enough
+(roughly every log2(GAP) moves into the same spot) to not matter.
+
+Ties can only happen through concurrent moves into the same gap, and are broken by id.
+"""
+
+GAP = 1 << 16
+
+def list_siblings(board_id):
+    return List.objects.filter(board=board_id)
+
+def card_siblings(list_id):
+    return Card.objects.filter(list=list_id)
+
+def next_rank(siblings):
+    """
+    Rank for an item appended to the end of 'siblings', uses the (scope, location) index.
+    """
+    last = siblings.aggregate(last=Max('location'))['last']
+    return GAP if last is None else last + GAP
+
+def rank_after(siblings, after=None, exclude=None):
+    """
+    Rank for an item placed directly after 'after' (or at the start when it's None), returns None if there's no
+    room between the neighbours and the siblings need rebalancing first.
+    """
+    siblings = siblings.order_by('location', 'id')
+    if exclude is not None:
+        siblings = siblings.exclude(pk=exclude.pk)
+
+    if after is None:
+        low = 0
+        high = siblings.values_list('location', flat=True).first()
+    else:
+        low = after.location
+        high = siblings.filter(location__gt=low).values_list('location', flat=True).first()
+
+    if high is None:
+        return low + GAP
+    if high - low < 2:
+        return None
+    return (low + high) // 2
+
+def rebalance(siblings):
+    """
+    Renumbers every sibling GAP apart keeping the current order, one transaction and one bulk UPDATE.
+    """
+    with transaction.atomic():
+        items = list(siblings.select_for_update().order_by('location', 'id'))
+        for i, item in enumerate(items):
+            item.location = (i + 1) * GAP
+        siblings.model.objects.bulk_update(items, ['location'], batch_size=1000)
+
+        for board_id in {item.board_id for item in items}:
+            bump_board_version(board_id)
+            record_change(board_id, 'board', 'changed', board_id)
+    return items
+
+def reorder(siblings, ids):
+    """
+    Bulk reorder, 'ids' is the complete new order of the siblings. Anything missing from 'ids' keeps its relative
+    order but goes after everything that was listed.
+    """
+    position = {pk: i for i, pk in enumerate(ids)}
+    with transaction.atomic():
+        items = list(siblings.select_for_update().order_by('location', 'id'))
+        items.sort(key=lambda item: position.get(item.pk, len(position)))
+        for i, item in enumerate(items):
+            item.location = (i + 1) * GAP
+        siblings.model.objects.bulk_update(items, ['location'], batch_size=1000)
+
+        for board_id in {item.board_id for item in items}:
+            bump_board_version(board_id)
+            record_change(board_id, 'board', 'changed', board_id)
+    return items
+
+def _place(item, siblings, after, fields):
+    with transaction.atomic():
+        rank = rank_after(siblings, after, exclude=item)
+        if rank is None:
+            rebalance(siblings)
+            if after is not None:
+                after.refresh_from_db(fields=['location'])
+            rank = rank_after(siblings, after, exclude=item)
+
+        item.location = rank
+        item.save(update_fields=fields)
+    return item
+
+def move_list(lst, after=None):
+    """
+    Moves a list to directly after the list 'after' on the same board, or to the front when 'after' is None.
+    """
+    return _place(lst, list_siblings(lst.board_id), after, ['location'])
+
+def move_card(card, to_list=None, after=None):
+    """
+    Moves a card to directly after the card 'after' within 'to_list' (its current list if not given), or to the top
+    of the list when 'after' is None.
+    """
+    if to_list is not None:
+        if to_list.board_id != card.board_id:
+            raise ValueError("Cards can't be moved to a list on another board")
+        card.list = to_list
+    return _place(card, card_siblings(card.list_id), after, ['list', 'location'])
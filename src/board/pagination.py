@@ -0,0 +1,117 @@
+import base64
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+"""
+Cursor Pagination
+=================
+
+Pages through a queryset by remembering where the last page stopped (the ordering values of its last row) instead
+of counting rows to skip. "WHERE (location, id) > (last location, last id) ORDER BY location, id LIMIT n" is a
+range scan starting right at the page on an index over those columns, so page 500 costs the same as page 1, where
+OFFSET has to walk past every row before it.
+
+The ordering has to end in something unique (the primary key) so no two rows tie, and wants an index over the same
+columns, see the Meta.indexes on the models being paged. Cursors are opaque strings for the client to hand back.
+
+    paginator = CursorPaginator(Comment.objects.filter(card=card), ('date_created', 'id'))
+    page = paginator.page(request.GET.get('cursor'))
+    page.items, page.next   # next is None on the last page
+"""
+
+class InvalidCursor(ValueError):
+    pass
+
+class Page:
+    def __init__(self, items, next):
+        self.items = items
+        self.next = next
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+class CursorEncoder(DjangoJSONEncoder):
+    # DjangoJSONEncoder rounds times to milliseconds, a cursor has to be exact or rows get repeated
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super().default(o)
+
+def encode_cursor(values):
+    data = json.dumps(values, cls=CursorEncoder, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise InvalidCursor("Invalid cursor")
+    if not isinstance(values, list):
+        raise InvalidCursor("Invalid cursor")
+    return values
+
+class CursorPaginator:
+    """
+    Cursor Paginator
+    ----------------
+
+    'ordering' is a list of field names as for order_by() ('-' for descending) ending with the primary key. The
+    queryset can be a .values() one as long as it includes the ordering fields.
+    """
+    def __init__(self, queryset, ordering, page_size=50):
+        self.queryset = queryset
+        self.ordering = list(ordering)
+        self.page_size = page_size
+        self.fields = [queryset.model._meta.get_field(name.lstrip('-')) for name in self.ordering]
+
+    def keys(self, row):
+        # Rows can be instances or dicts from .values()
+        if isinstance(row, dict):
+            return [row[field.attname] for field in self.fields]
+        return [getattr(row, field.attname) for field in self.fields]
+
+    def after(self, values):
+        """
+        Rows strictly after 'values' in the ordering, expanded as (a > x) OR (a = x AND b > y) OR ... which works for
+        any mix of directions. The a >= x in front is redundant but gives the database one index range to scan in
+        order, an OR on its own gets planned as separate lookups that then have to be sorted.
+        """
+        condition = Q()
+        for i, (name, value) in enumerate(zip(self.ordering, values)):
+            lookup = '%s__%s' % (name.lstrip('-'), 'lt' if name.startswith('-') else 'gt')
+            equal = {field.name: v for field, v in zip(self.fields[:i], values[:i])}
+            condition |= Q(**equal, **{lookup: value})
+
+        first = self.ordering[0]
+        start = Q(**{'%s__%s' % (first.lstrip('-'), 'lte' if first.startswith('-') else 'gte'): values[0]})
+        return start & condition
+
+    def parse(self, cursor):
+        values = decode_cursor(cursor)
+        if len(values) != len(self.fields):
+            raise InvalidCursor("Invalid cursor")
+        try:
+            return [field.to_python(value) for field, value in zip(self.fields, values)]
+        except Exception:
+            raise InvalidCursor("Invalid cursor")
+
+    def page(self, cursor=None):
+        """
+        The page following 'cursor' (the first page with no cursor), raises InvalidCursor for a cursor that wasn't
+        one of ours.
+        """
+        queryset = self.queryset.order_by(*self.ordering)
+        if cursor:
+            queryset = queryset.filter(self.after(self.parse(cursor)))
+
+        # One more than a page tells us whether there's another without counting
+        items = list(queryset[:self.page_size + 1])
+        more = len(items) > self.page_size
+        items = items[:self.page_size]
+        return Page(items, encode_cursor(self.keys(items[-1])) if more else None)
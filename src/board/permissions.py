@@ -0,0 +1,125 @@
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import OuterRef, Subquery
+
+from .models import *
+from .cache import get_version, bump_version
+from .databases import mark_written
+
+"""
+Board Permissions
+=================
+
+One place to answer "can this user read/write/admin this board?". Every user has a map of board id -> access level
+which lives in the cache (across requests) and on the request object (for the rest of the request), so repeat
+checks cost nothing. A board missing from the map is resolved with a single lookup on the board's primary key and
+the (board, member) unique index.
+
+The map is versioned per user, changes to BoardMember (or to who authored a board) bump the version, see signals.py.
+
+Usage:
+    @login_required(login_url='/login/')
+    @board_access_required(BoardMember.Access.WRITE)
+    def some_board_view(request, board_id):
+        request.board_access  # the users access level on this board
+"""
+
+ACCESS_TIMEOUT = getattr(settings, 'BOARD_ACCESS_TIMEOUT', 60 * 60)
+
+# BoardMember.Access values aren't in privilege order, so rank them (higher can do everything lower can)
+RANK = {
+    BoardMember.Access.READ: 1,
+    BoardMember.Access.WRITE: 2,
+    BoardMember.Access.ADMIN: 3,
+    BoardMember.Access.OWNER: 4,
+}
+
+# Stored in the map for boards the user can't see, so misses get cached too
+NO_ACCESS = 0
+
+def access_version_key(user_id):
+    return 'user:%s:access-version' % user_id
+
+def access_map_key(user_id, version):
+    return 'user:%s:access:%s' % (user_id, version)
+
+def invalidate_user_access(user_id):
+    bump_version(access_version_key(user_id))
+    mark_written('user', user_id)
+
+def lookup_access(user, board_id):
+    """
+    Resolves a users access straight from the database, returns NO_ACCESS if the board doesn't exist (or has been
+    archived).
+    """
+    membership = BoardMember.objects.filter(board=OuterRef('pk'), member=user.id).values('access')[:1]
+    row = Board.objects.filter(id=board_id, archived=False).values_list('author_id', Subquery(membership)).first()
+
+    if row is None:
+        return NO_ACCESS
+
+    author_id, access = row
+    if user.is_superuser or author_id == user.id:
+        return BoardMember.Access.OWNER
+    if access is None and user.is_staff:
+        return BoardMember.Access.READ
+    return access or NO_ACCESS
+
+def get_access(user, board_id, request=None):
+    """
+    Returns the users BoardMember.Access level on a board, or NO_ACCESS.
+    """
+    if user is None or not user.is_authenticated:
+        return NO_ACCESS
+
+    # Per-request map first, then the shared one in the cache
+    local = getattr(request, '_board_access', None) if request is not None else None
+    if local is not None and board_id in local:
+        return local[board_id]
+
+    key = access_map_key(user.id, get_version(access_version_key(user.id)))
+    access_map = cache.get(key) or {}
+
+    if board_id not in access_map:
+        access_map[board_id] = lookup_access(user, board_id)
+        cache.set(key, access_map, ACCESS_TIMEOUT)
+
+    if request is not None:
+        request._board_access = access_map
+
+    return access_map[board_id]
+
+def has_access(user, board_id, level, request=None):
+    return RANK.get(get_access(user, board_id, request), 0) >= RANK[level]
+
+def can_read(user, board_id, request=None):
+    return has_access(user, board_id, BoardMember.Access.READ, request)
+
+def can_write(user, board_id, request=None):
+    return has_access(user, board_id, BoardMember.Access.WRITE, request)
+
+def can_admin(user, board_id, request=None):
+    return has_access(user, board_id, BoardMember.Access.ADMIN, request)
+
+def board_access_required(level=BoardMember.Access.READ):
+    """
+    Board Access Required
+    ---------------------
+
+    Decorator for views taking a 'board_id', users without at least 'level' access get the same "Board Not Found"
+    page as a board that doesn't exist so we don't leak which boards are there. Sets request.board_access.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, board_id, *args, **kwargs):
+            access = get_access(request.user, board_id, request)
+            if RANK.get(access, 0) < RANK[level]:
+                from .views import error_view
+                return error_view(request, "Board Not Found")
+
+            request.board_access = access
+            return view(request, board_id, *args, **kwargs)
+        return wrapper
+    return decorator
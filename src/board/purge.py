@@ -0,0 +1,144 @@
+import os
+
+from django.conf import settings
+from django.db import router, transaction
+from django.utils import timezone
+
+from .models import *
+from .cache import bump_board_version
+from .permissions import invalidate_user_access
+from .changes import record_change
+from .attachments import part_path, release_file
+from .jobs import job
+
+"""
+Board Archival and Purging
+==========================
+
+Deleting a board through the ORM collects every list, card, comment, task, tag and reaction on it into memory
+(to send their delete signals and cascade) and deletes the lot in one transaction, which for a big board means a
+lot of memory and the tables locked for as long as it takes.
+
+So boards aren't deleted, they're archived: archive_board() marks the board archived (it disappears for everyone
+straight away) and queues purge_board, which deletes the boards rows a chunk at a time, children before parents,
+each chunk in its own short transaction. Memory and lock time depend on the chunk size, not the board.
+
+Chunks are deleted with plain DELETE ... WHERE id IN (...) statements, no model signals. Nothing they would do is
+needed for a board that's going away (counters, search entries and the change log all go with it), apart from
+removing attachment files, which is done here once each chunk has committed.
+
+A purge that doesn't finish within BOARD_PURGE_MAX_CHUNKS chunks queues itself again to carry on, so one big board
+can't hold on to a worker past its timeout. Purging is safe to repeat, it just carries on from what's left.
+BOARD_PURGE_CHUNK_SIZE and BOARD_PURGE_MAX_CHUNKS are read each time a purge starts, not when this is imported.
+"""
+
+def board_rows(board_id):
+    """
+    Querysets over everything belonging to a board, in the order they can be deleted.
+    """
+    return [
+        Reaction.objects.filter(comment__board=board_id),
+        Comment.objects.filter(board=board_id),
+        Task.objects.filter(board=board_id),
+        CardTag.objects.filter(board=board_id),
+        Attachment.objects.filter(board=board_id),
+        Upload.objects.filter(board=board_id),
+        SearchEntry.objects.filter(board=board_id),
+        Card.objects.filter(board=board_id),
+        List.objects.filter(board=board_id),
+        Tag.objects.filter(board=board_id),
+        BoardChange.objects.filter(board=board_id),
+        Activity.objects.filter(board=board_id),
+        ActivityDay.objects.filter(board=board_id),
+        BoardMember.objects.filter(board=board_id),
+    ]
+
+def archive_board(board_id):
+    """
+    Archive Board
+    -------------
+
+    Hides a board from everyone and queues it to be purged. Returns False if it was already archived (or doesn't
+    exist).
+    """
+    with transaction.atomic():
+        if not Board.objects.filter(id=board_id, archived=False).update(archived=True, date_archived=timezone.now()):
+            return False
+
+        # Everyone who could see it needs their access map and board list rebuilt
+        author_id = Board.objects.filter(id=board_id).values_list('author_id', flat=True).get()
+        for user_id in {author_id, *BoardMember.objects.filter(board=board_id).values_list('member_id', flat=True)}:
+            invalidate_user_access(user_id)
+        bump_board_version(board_id)
+
+        record_change(board_id, 'board', 'archived', board_id)
+        purge_board.delay(board_id)
+    return True
+
+def delete_chunk(queryset, size):
+    """
+    Deletes up to 'size' rows of 'queryset' in one transaction, returns how many went.
+    """
+    model = queryset.model
+    with transaction.atomic():
+        if model is Attachment:
+            rows = list(queryset.order_by().values_list('id', 'file')[:size])
+            ids = [pk for pk, _ in rows]
+            names = {name for _, name in rows}
+        elif model is Upload:
+            rows = list(queryset.order_by()[:size])
+            ids = [upload.id for upload in rows]
+        else:
+            ids = list(queryset.order_by().values_list('id', flat=True)[:size])
+
+        if not ids:
+            return 0
+
+        # A plain DELETE, no collecting and no signals (see the notes at the top)
+        model.objects.filter(id__in=ids)._raw_delete(router.db_for_write(model))
+
+        if model is Attachment:
+            # Files can be shared with attachments elsewhere, release_file checks
+            transaction.on_commit(lambda: [release_file(name) for name in names])
+        elif model is Upload:
+            transaction.on_commit(lambda: [remove_part(upload) for upload in rows])
+    return len(ids)
+
+def remove_part(upload):
+    try:
+        os.remove(part_path(upload))
+    except FileNotFoundError:
+        pass
+
+def purge(board_id, chunk_size=None, max_chunks=None):
+    """
+    Deletes an archived board and everything on it, at most 'max_chunks' chunks (None for no limit) of 'chunk_size'
+    rows (default BOARD_PURGE_CHUNK_SIZE). Returns True once the board is gone.
+    """
+    chunk_size = chunk_size or getattr(settings, 'BOARD_PURGE_CHUNK_SIZE', 1000)
+    if not Board.objects.filter(id=board_id, archived=True).exists():
+        return not Board.objects.filter(id=board_id).exists()
+
+    # Only chunks that deleted something count, finding a table already empty mustn't use up a job that then
+    # queues itself again without having got any further
+    chunks = 0
+    for queryset in board_rows(board_id):
+        while True:
+            if max_chunks is not None and chunks >= max_chunks:
+                return False
+            deleted = delete_chunk(queryset, chunk_size)
+            chunks += bool(deleted)
+            if deleted < chunk_size:
+                break
+
+    # Only the board row is left, so the usual delete has nothing to collect
+    Board.objects.filter(id=board_id).delete()
+    return True
+
+@job(concurrency=1)
+def purge_board(board_id):
+    """
+    Purges an archived board a bounded amount at a time, queueing itself again until it's gone.
+    """
+    if not purge(board_id, max_chunks=getattr(settings, 'BOARD_PURGE_MAX_CHUNKS', 100)):
+        purge_board.delay(board_id)
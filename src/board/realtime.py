@@ -0,0 +1,175 @@
+import asyncio
+import json
+import re
+import threading
+from http.cookies import SimpleCookie
+from importlib import import_module
+from types import SimpleNamespace
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from .permissions import can_read
+
+"""
+Real-time Board Events
+======================
+
+Pushes small per-board deltas ("card.saved", "task.saved", "comment.saved", ...) to everyone looking at a board
+using Server-Sent Events, so people don't have to keep reloading the board to see what their teammates did.
+
+The events endpoint (/b/<board_id>/events/) is served by BoardEventsApp, which sits in front of Django in
+todo/asgi.py. Each connection is just a coroutine waiting on its own queue, so thousands of idle connections cost a
+few KB each rather than a thread each. It needs to be run under an ASGI server (uvicorn, daphne, ...).
+
+Events are handed out by a broker, InMemoryBroker fans out within the one process which is all a single worker (and
+the tests) need. Something like redis pub/sub can be dropped in with the same three methods via the
+BOARD_EVENTS_BROKER setting.
+"""
+
+EVENTS_PATH = re.compile(r'^/b/(?P<board_id>\d+)/events/$')
+
+class InMemoryBroker:
+    """
+    In-Memory Broker
+    ----------------
+
+    Fans events out to subscriber queues in this process. publish() can be called from any thread (model signals run
+    in Django's sync threads), the queues belong to whichever event loop subscribed.
+    """
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, board_id):
+        queue = asyncio.Queue(self.queue_size)
+        with self.lock:
+            self.subscribers.setdefault(board_id, {})[queue] = asyncio.get_running_loop()
+        return queue
+
+    def unsubscribe(self, board_id, queue):
+        with self.lock:
+            queues = self.subscribers.get(board_id, {})
+            queues.pop(queue, None)
+            if not queues:
+                self.subscribers.pop(board_id, None)
+
+    def publish(self, board_id, event):
+        with self.lock:
+            queues = list(self.subscribers.get(board_id, {}).items())
+        for queue, loop in queues:
+            try:
+                loop.call_soon_threadsafe(deliver, queue, event)
+            except RuntimeError:
+                # Loop has gone away, the connection cleans itself up
+                pass
+
+def deliver(queue, event):
+    """
+    Puts an event on a subscribers queue, a client too slow to keep up gets its backlog swapped for a single
+    "board.resync" telling it to fetch the board again.
+    """
+    try:
+        queue.put_nowait(event)
+    except asyncio.QueueFull:
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait({"type": "board.resync"})
+
+_broker = None
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        _broker = import_string(getattr(settings, 'BOARD_EVENTS_BROKER', 'board.realtime.InMemoryBroker'))()
+    return _broker
+
+def publish(board_id, type, **data):
+    """
+    Queues an event for everyone watching 'board_id', sent once the current transaction commits.
+    """
+    event = dict(type=type, **data)
+    transaction.on_commit(lambda: get_broker().publish(board_id, event))
+
+def format_event(event):
+    return ('event: %s\ndata: %s\n\n' % (event["type"], json.dumps(event, cls=DjangoJSONEncoder))).encode()
+
+def authorise(headers, board_id):
+    """
+    Works out the user from the session cookie the same way AuthenticationMiddleware would, and checks they can read
+    the board. Returns the user or None.
+    """
+    cookie = SimpleCookie()
+    for name, value in headers:
+        if name == b'cookie':
+            cookie.load(value.decode('latin-1'))
+
+    morsel = cookie.get(settings.SESSION_COOKIE_NAME)
+    if morsel is None:
+        return None
+
+    session = import_module(settings.SESSION_ENGINE).SessionStore(morsel.value)
+    user = get_user(SimpleNamespace(session=session))
+    return user if can_read(user, board_id) else None
+
+class BoardEventsApp:
+    """
+    Board Events App
+    ----------------
+
+    ASGI application serving the events stream, anything else goes to the wrapped (Django) application.
+    """
+    def __init__(self, application, keepalive=None):
+        self.application = application
+        self.keepalive = keepalive or getattr(settings, 'BOARD_EVENTS_KEEPALIVE', 15)
+
+    async def __call__(self, scope, receive, send):
+        match = EVENTS_PATH.match(scope.get('path', '')) if scope['type'] == 'http' else None
+        if match is None:
+            return await self.application(scope, receive, send)
+
+        board_id = int(match['board_id'])
+        user = await sync_to_async(authorise)(scope.get('headers', []), board_id)
+        if user is None:
+            await send({"type": "http.response.start", "status": 403, "headers": [(b'content-type', b'text/plain')]})
+            await send({"type": "http.response.body", "body": b'Forbidden'})
+            return
+
+        await self.stream(board_id, receive, send)
+
+    async def stream(self, board_id, receive, send):
+        broker = get_broker()
+        queue = broker.subscribe(board_id)
+
+        # Only thing we expect from the client from here on is it going away
+        async def wait_for_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+        disconnect = asyncio.ensure_future(wait_for_disconnect())
+
+        try:
+            await send({"type": "http.response.start", "status": 200, "headers": [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ]})
+            await send({"type": "http.response.body", "body": b': connected\n\n', "more_body": True})
+
+            while not disconnect.done():
+                get = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait({get, disconnect}, timeout=self.keepalive, return_when=asyncio.FIRST_COMPLETED)
+
+                if get in done:
+                    await send({"type": "http.response.body", "body": format_event(get.result()), "more_body": True})
+                else:
+                    get.cancel()
+                    if not disconnect.done():
+                        await send({"type": "http.response.body", "body": b': keepalive\n\n', "more_body": True})
+        finally:
+            disconnect.cancel()
+            broker.unsubscribe(board_id, queue)
@@ -0,0 +1,176 @@
+import math
+import re
+from collections import Counter
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, Count, ExpressionWrapper, F, FloatField, Sum, When
+
+from .models import *
+from .cache import get_board_version
+from .dashboard import user_boards
+
+"""
+Board Search
+============
+
+Inverted index over card titles, descriptions, comments, task names and tag names, kept in SearchEntry. Everything
+rolls up to cards (a comment matching means its card matches) and is scoped per board, so a search is a couple of
+range scans on the (board, term, card) index instead of LIKE '%...%' scans over every text column.
+
+Entries are keyed by (card, source, object_id) so a single comment/task/tag/card change only rewrites its own rows,
+see the receivers in signals.py. Bulk writes call reindex_cards() for the cards they touched.
+
+Results are ranked by tf-idf: each term counts its weighted occurrences (a title hit counts more than a comment hit)
+times how rare the term is on the boards being searched. Every term has to match.
+"""
+
+WEIGHTS = {
+    "title": 5,
+    "tag": 3,
+    "task": 2,
+    "description": 1,
+    "comment": 1,
+}
+
+MAX_TERM_LENGTH = SearchEntry._meta.get_field('term').max_length
+
+TOKEN = re.compile(r'\w+')
+
+TOTAL_TIMEOUT = 5 * 60
+
+def tokenise(text):
+    return [t[:MAX_TERM_LENGTH] for t in TOKEN.findall((text or '').lower()) if len(t) > 1]
+
+def build_entries(board_id, card_id, source, object_id, fields):
+    """
+    SearchEntry rows (unsaved) for one source object, 'fields' is a list of (weight name, text).
+    """
+    weights = Counter()
+    for name, text in fields:
+        for term in tokenise(text):
+            weights[term] += WEIGHTS[name]
+    return [SearchEntry(board_id=board_id, card_id=card_id, source=source, object_id=object_id, term=term, weight=weight)
+        for term, weight in weights.items()]
+
+def card_entries(card):
+    return build_entries(card.board_id, card.id, 'card', card.id, [("title", card.title), ("description", card.description)])
+
+def comment_entries(comment):
+    return build_entries(comment.board_id, comment.card_id, 'comment', comment.id, [("comment", comment.comment)])
+
+def task_entries(task):
+    return build_entries(task.board_id, task.card_id, 'task', task.id, [("task", task.name)])
+
+def tag_entries(board_id, card_id, tag):
+    return build_entries(board_id, card_id, 'tag', tag.id, [("tag", tag.name)])
+
+def replace_entries(card_id, source, object_id, entries):
+    with transaction.atomic():
+        SearchEntry.objects.filter(card=card_id, source=source, object_id=object_id).delete()
+        SearchEntry.objects.bulk_create(entries, batch_size=1000)
+
+def remove_entries(card_id, source, object_id):
+    SearchEntry.objects.filter(card=card_id, source=source, object_id=object_id).delete()
+
+# Incremental updates, called from signals.py
+def index_card(card):
+    replace_entries(card.id, 'card', card.id, card_entries(card))
+
+def index_comment(comment):
+    replace_entries(comment.card_id, 'comment', comment.id, comment_entries(comment))
+
+def index_task(task):
+    replace_entries(task.card_id, 'task', task.id, task_entries(task))
+
+def index_card_tag(card_tag):
+    replace_entries(card_tag.card_id, 'tag', card_tag.tag_id, tag_entries(card_tag.board_id, card_tag.card_id, card_tag.tag))
+
+def index_tag(tag):
+    """
+    A renamed tag changes the entries of every card carrying it.
+    """
+    with transaction.atomic():
+        SearchEntry.objects.filter(board=tag.board_id, source='tag', object_id=tag.id).delete()
+        entries = []
+        for card_id in CardTag.objects.filter(tag=tag).values_list('card', flat=True):
+            entries += tag_entries(tag.board_id, card_id, tag)
+        SearchEntry.objects.bulk_create(entries, batch_size=1000)
+
+def reindex_cards(card_ids):
+    """
+    Rebuilds the entries of a whole set of cards with a fixed number of queries, for bulk writes and rebuilds.
+    """
+    card_ids = list(card_ids)
+    entries = []
+    for card in Card.objects.filter(id__in=card_ids):
+        entries += card_entries(card)
+    for comment in Comment.objects.filter(card__in=card_ids):
+        entries += comment_entries(comment)
+    for task in Task.objects.filter(card__in=card_ids):
+        entries += task_entries(task)
+    for card_tag in CardTag.objects.filter(card__in=card_ids).select_related('tag'):
+        entries += tag_entries(card_tag.board_id, card_tag.card_id, card_tag.tag)
+
+    with transaction.atomic():
+        SearchEntry.objects.filter(card__in=card_ids).delete()
+        SearchEntry.objects.bulk_create(entries, batch_size=1000)
+
+def readable_boards(user):
+    """
+    Ids of every board 'user' can read, for a board__in filter. Comes from the users cached board map (see
+    dashboard.py), an author-or-member subquery has to scan every board to answer the OR.
+    """
+    if user.is_superuser or user.is_staff:
+        return Board.objects.filter(archived=False).values('id')
+    return list(user_boards(user))
+
+def search(user, query, board_id=None, limit=20):
+    """
+    Search
+    ------
+
+    Cards matching every term in 'query' on 'board_id' (or on every board 'user' can read), best first:
+
+        [{"id", "board_id", "list_id", "title", "score"}, ...]
+
+    Callers searching a single board are expected to have checked access already (board_access_required).
+    """
+    terms = list(dict.fromkeys(tokenise(query)))
+    if not terms:
+        return []
+
+    # Card totals only feed the idf weights so they can be a little out of date, a board's is cached until it changes
+    entries = SearchEntry.objects.filter(term__in=terms, card__archived=False)
+    if board_id is not None:
+        entries = entries.filter(board=board_id)
+        cards = Card.objects.filter(board=board_id, archived=False)
+        total_key = 'search:total:%s:%s' % (board_id, get_board_version(board_id))
+    else:
+        boards = readable_boards(user)
+        entries = entries.filter(board__in=boards)
+        cards = Card.objects.filter(board__in=boards, archived=False)
+        total_key = 'search:total:user:%s' % user.id
+
+    # Document frequency of each term, then score in the database with the idf weights folded in
+    frequency = dict(entries.order_by().values('term').annotate(df=Count('card', distinct=True)).values_list('term', 'df'))
+    if len(frequency) < len(terms):
+        return []
+
+    total = cache.get(total_key)
+    if total is None:
+        total = cards.count()
+        cache.set(total_key, total, TOTAL_TIMEOUT)
+    idf = {term: math.log(1 + total / df) for term, df in frequency.items()}
+
+    score = Case(*[When(term=term, then=ExpressionWrapper(F('weight') * weight, output_field=FloatField()))
+        for term, weight in idf.items()], output_field=FloatField())
+
+    results = (entries.order_by().values('card')
+        .annotate(matched=Count('term', distinct=True), score=Sum(score))
+        .filter(matched=len(terms))
+        .order_by('-score', 'card_id')[:limit])
+    scores = {row['card']: row['score'] for row in results}
+
+    found = Card.objects.filter(id__in=scores).order_by().values('id', 'board_id', 'list_id', 'title')
+    return sorted(({**card, "score": scores[card["id"]]} for card in found), key=lambda r: (-r["score"], r["id"]))
@@ -0,0 +1,242 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.sessions.backends.base import CreateError, UpdateError, VALID_KEY_CHARS
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+from django.contrib.sessions.models import Session
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.signals import request_finished
+from django.db import DatabaseError, connections, transaction
+from django.utils.crypto import get_random_string
+
+"""
+Cached Sessions with Write-Behind
+=================================
+
+Selected with SESSION_ENGINE = 'board.sessions'.
+
+The database session engine reads the session row on every request and writes it whenever the session changes,
+logging in alone inserts a session, updates it with the user and deletes the one it replaced. Django's cached_db
+engine saves the reads but still writes through to the database every time.
+
+This one reads the same way (cache first, the database if the cache doesn't have it) but saves to the cache only,
+queueing the database write. Queued writes are flushed together at the end of a request, one SELECT to see which
+sessions exist then a bulk UPDATE and a bulk INSERT, once the oldest has waited SESSION_WRITE_BEHIND_INTERVAL
+seconds or SESSION_WRITE_BEHIND_BATCH sessions are waiting. A timer flushes them too, so a process that stops
+getting requests doesn't sit on them, and so does the process exiting.
+
+What's given up is durability of the last few seconds of session writes: a process dying with writes queued loses
+them, which only matters if the cache has lost the session too (a shared cache like memcached/redis won't have).
+Anyone it does happen to is logged out.
+
+Deleting a session (logging out) goes straight to the database, a session that's been ended must stay ended. It
+also leaves a marker in the cache for an hour, checked before anything cached or queued for the session is used, so
+neither a write still queued in some other process nor a request that loaded the session before the logout and
+saves it afterwards (that raises UpdateError, as the db engine does) can bring it back.
+
+All of this relies on every process seeing the same cache, the queued writes and the logout markers are only
+visible to the others through it. With a per-process cache (locmem, dummy) sessions are written straight through
+to the database instead, exactly as cached_db does.
+
+New session keys are only checked against the cache and the queue, not the database, 32 random characters aren't
+going to collide.
+"""
+
+logger = logging.getLogger(__name__)
+
+DELETED_PREFIX = 'board.sessions.deleted:'
+DELETED_TIMEOUT = 60 * 60
+
+# Caches each process has its own of
+LOCAL_CACHES = (LocMemCache, DummyCache)
+
+_lock = threading.Lock()
+# {session key: (encoded data, expire date)}, the writes waiting, when the oldest of them was queued, and the timer
+# that will flush them
+_pending = {}
+_oldest = None
+_timer = None
+
+def write_behind():
+    """
+    Whether the session cache is one every process shares, otherwise sessions are written through.
+    """
+    return not isinstance(caches[settings.SESSION_CACHE_ALIAS], LOCAL_CACHES)
+
+class SessionStore(CachedDBStore):
+    cache_key_prefix = 'board.sessions'
+
+    def load(self):
+        # Makes up a key if there isn't one yet
+        cache_key = self.cache_key
+        deleted_key = DELETED_PREFIX + self._session_key
+        try:
+            found = self._cache.get_many([cache_key, deleted_key])
+        except Exception:
+            # Same as cached_db, a cache that's down shouldn't log everyone out
+            found = {}
+
+        # Logged out, whatever is still cached or queued for it
+        if found.get(deleted_key):
+            self._session_key = None
+            return {}
+
+        data = found.get(cache_key)
+        if data is not None:
+            return data
+
+        with _lock:
+            queued = _pending.get(self._session_key)
+        if queued is not None:
+            data = self.decode(queued[0])
+            self._cache.set(cache_key, data, self.get_expiry_age(expiry=queued[1]))
+            return data
+
+        # The database, through the plain db engine, then back in the cache
+        return super().load()
+
+    def exists(self, session_key):
+        with _lock:
+            if session_key in _pending:
+                return True
+        return super().exists(session_key)
+
+    def _get_new_session_key(self):
+        if not write_behind():
+            return super()._get_new_session_key()
+        while True:
+            session_key = get_random_string(32, VALID_KEY_CHARS)
+            if self._cache.get(self.cache_key_prefix + session_key) is None and session_key not in _pending:
+                return session_key
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        if not must_create and self._cache.get(DELETED_PREFIX + self.session_key):
+            # Logged out since this request loaded it, the db engine finds the row gone
+            raise UpdateError
+        if not write_behind():
+            return super().save(must_create)
+
+        data = self._get_session(no_load=must_create)
+        if must_create:
+            if not self._cache.add(self.cache_key, data, self.get_expiry_age()):
+                raise CreateError
+        else:
+            self._cache.set(self.cache_key, data, self.get_expiry_age())
+        queue(self.session_key, self.encode(data), self.get_expiry_date())
+
+    def delete(self, session_key=None):
+        session_key = session_key or self.session_key
+        if session_key is None:
+            return
+        with _lock:
+            _pending.pop(session_key, None)
+        self._cache.set(DELETED_PREFIX + session_key, True, DELETED_TIMEOUT)
+        super().delete(session_key)
+
+def queue(session_key, data, expire_date):
+    global _oldest
+    with _lock:
+        _pending[session_key] = (data, expire_date)
+        if _oldest is None:
+            _oldest = time.monotonic()
+        start_timer()
+
+def start_timer():
+    # Called with _lock held
+    global _timer
+    if _timer is None:
+        _timer = threading.Timer(getattr(settings, 'SESSION_WRITE_BEHIND_INTERVAL', 5), in_thread, [flush_on_timer])
+        _timer.daemon = True
+        _timer.start()
+
+def in_thread(function):
+    try:
+        function()
+    finally:
+        # The database connections this thread opened, nothing else will close them
+        connections.close_all()
+
+def flush_on_timer():
+    global _timer
+    with _lock:
+        _timer = None
+    try:
+        flush_sessions()
+    except Exception:
+        logger.exception('Flushing sessions on the timer failed')
+
+def flush_due():
+    return _oldest is not None and (len(_pending) >= getattr(settings, 'SESSION_WRITE_BEHIND_BATCH', 100)
+        or time.monotonic() - _oldest >= getattr(settings, 'SESSION_WRITE_BEHIND_INTERVAL', 5))
+
+def flush_sessions():
+    """
+    Flush Sessions
+    --------------
+
+    Writes every queued session to the database, returns how many.
+    """
+    global _pending, _oldest
+    with _lock:
+        pending, _pending, _oldest = _pending, {}, None
+    if not pending:
+        return 0
+
+    # Sessions that have since been deleted, here or in another process
+    deleted = caches[settings.SESSION_CACHE_ALIAS].get_many([DELETED_PREFIX + key for key in pending])
+    pending = {key: value for key, value in pending.items() if DELETED_PREFIX + key not in deleted}
+    if not pending:
+        return 0
+
+    try:
+        with transaction.atomic():
+            existing = set(Session.objects.filter(session_key__in=pending).values_list('session_key', flat=True))
+            rows = [Session(session_key=key, session_data=data, expire_date=expire_date)
+                for key, (data, expire_date) in pending.items()]
+            Session.objects.bulk_update([row for row in rows if row.session_key in existing],
+                ['session_data', 'expire_date'])
+            # Ignoring conflicts covers another process inserting the same session in between
+            Session.objects.bulk_create([row for row in rows if row.session_key not in existing],
+                ignore_conflicts=True)
+    except DatabaseError:
+        # Put them back for next time, unless the session has been saved again since
+        logger.exception('Flushing %s sessions failed', len(pending))
+        with _lock:
+            for key, value in pending.items():
+                _pending.setdefault(key, value)
+            if _oldest is None:
+                _oldest = time.monotonic()
+            start_timer()
+        return 0
+    return len(pending)
+
+def discard_sessions():
+    """
+    Drops the queued writes, for throwaway sessions (tests, benchmarks) made in a transaction that's rolled back.
+    """
+    global _pending, _oldest, _timer
+    with _lock:
+        _pending, _oldest = {}, None
+        if _timer is not None:
+            _timer.cancel()
+            _timer = None
+
+def flush_if_due(**kwargs):
+    if flush_due():
+        flush_sessions()
+
+def flush_at_exit():
+    try:
+        flush_sessions()
+    except Exception:
+        logger.exception('Flushing sessions at exit failed')
+
+request_finished.connect(flush_if_due, dispatch_uid='board.sessions.flush_if_due')
+atexit.register(flush_at_exit)
@@ -1,8 +1,20 @@
+import os
+
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
 
-from .models import Profile
+from .models import *
+from .cache import bump_board_version
+from .permissions import invalidate_user_access
+from .changes import record_change, deleting_boards
+from . import search
+from .counters import adjust, recount_cards, recount_comments, REACTION_COUNTERS
+from .attachments import release_file
+from .thumbnails import schedule as schedule_thumbnails, source_digest
+from .tagfilter import card_tag_changed, invalidate_tag_index
+from . import activity
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -11,4 +23,308 @@ def create_user_profile(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
-    instance.profile.save()
\ No newline at end of file
+    # Users are saved on every login (last_login), only a profile that came along with the user and has been edited
+    # since is worth writing, anything else would be a query to load it and an UPDATE that changes nothing
+    if not User.profile.related.is_cached(instance):
+        return
+    changed = instance.profile.changed_fields()
+    if changed:
+        instance.profile.save(update_fields=changed)
+
+@receiver(post_save, sender=User)
+def invalidate_user(sender, instance, update_fields=None, **kwargs):
+    # is_staff/is_superuser feed into board access, a login only touches last_login
+    if update_fields is not None and not {'is_staff', 'is_superuser', 'is_active'} & set(update_fields):
+        return
+    invalidate_user_access(instance.id)
+
+# Anything that shows up in a board snapshot invalidates it when it changes
+@receiver(post_save, sender=Board)
+@receiver(post_delete, sender=Board)
+def invalidate_board(sender, instance, **kwargs):
+    bump_board_version(instance.id)
+
+@receiver(post_save, sender=BoardMember)
+@receiver(post_delete, sender=BoardMember)
+@receiver(post_save, sender=List)
+@receiver(post_delete, sender=List)
+@receiver(post_save, sender=Card)
+@receiver(post_delete, sender=Card)
+@receiver(post_save, sender=Task)
+@receiver(post_delete, sender=Task)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=CardTag)
+@receiver(post_delete, sender=CardTag)
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+@receiver(post_save, sender=Attachment)
+@receiver(post_delete, sender=Attachment)
+def invalidate_board_content(sender, instance, **kwargs):
+    bump_board_version(instance.board_id)
+
+# Board access maps, see permissions.py
+@receiver(pre_save, sender=Board)
+def remember_board_author(sender, instance, **kwargs):
+    if instance.pk:
+        instance._old_author_id = Board.objects.filter(pk=instance.pk).values_list('author_id', flat=True).first()
+
+@receiver(post_save, sender=Board)
+@receiver(post_delete, sender=Board)
+def invalidate_board_author(sender, instance, **kwargs):
+    invalidate_user_access(instance.author_id)
+    old_author_id = getattr(instance, '_old_author_id', None)
+    if old_author_id and old_author_id != instance.author_id:
+        invalidate_user_access(old_author_id)
+
+@receiver(post_save, sender=BoardMember)
+@receiver(post_delete, sender=BoardMember)
+def invalidate_member(sender, instance, **kwargs):
+    invalidate_user_access(instance.member_id)
+
+# Change log (and live deltas for anyone watching the board), see changes.py. Board.delete and Board.objects...delete
+# mark the boards themselves, these are for boards deleted along with something else (their author)
+@receiver(pre_delete, sender=Board)
+def start_board_delete(sender, instance, **kwargs):
+    deleting_boards().add(instance.id)
+
+@receiver(post_delete, sender=Board)
+def finish_board_delete(sender, instance, **kwargs):
+    deleting_boards().discard(instance.id)
+
+@receiver(post_save, sender=Card)
+def log_card(sender, instance, **kwargs):
+    record_change(instance.board_id, 'card', 'saved', instance.id, list=instance.list_id, location=instance.location,
+        title=instance.title, description=instance.description, archived=instance.archived)
+
+@receiver(post_save, sender=List)
+def log_list(sender, instance, **kwargs):
+    record_change(instance.board_id, 'list', 'saved', instance.id, title=instance.title, location=instance.location)
+
+@receiver(post_save, sender=Task)
+def log_task(sender, instance, **kwargs):
+    record_change(instance.board_id, 'task', 'saved', instance.id, card=instance.card_id, name=instance.name,
+        done=instance.done)
+
+@receiver(post_save, sender=Comment)
+def log_comment(sender, instance, **kwargs):
+    record_change(instance.board_id, 'comment', 'saved', instance.id, card=instance.card_id,
+        author=instance.author_id, comment=instance.comment)
+
+@receiver(post_save, sender=CardTag)
+def log_card_tag(sender, instance, **kwargs):
+    record_change(instance.board_id, 'cardtag', 'saved', instance.id, card=instance.card_id, tag=instance.tag_id)
+
+@receiver(post_delete, sender=Card)
+@receiver(post_delete, sender=List)
+@receiver(post_delete, sender=Task)
+@receiver(post_delete, sender=Comment)
+@receiver(post_delete, sender=CardTag)
+def log_delete(sender, instance, **kwargs):
+    record_change(instance.board_id, sender._meta.model_name, 'deleted', instance.id)
+
+def reaction_card(reaction):
+    """
+    (board id, card id) of a reactions comment, (None, None) if it's gone. Reactions only know their comment, this
+    is looked up once for all of its signals.
+    """
+    if not hasattr(reaction, '_card'):
+        reaction._card = (Comment.objects.filter(id=reaction.comment_id).values_list('board_id', 'card_id').first()
+            or (None, None))
+    return reaction._card
+
+@receiver(post_save, sender=Reaction)
+@receiver(post_delete, sender=Reaction)
+def log_reaction(sender, instance, created=False, **kwargs):
+    board_id, _ = reaction_card(instance)
+    if board_id is None:
+        return
+
+    if kwargs['signal'] is post_delete:
+        record_change(board_id, 'reaction', 'deleted', instance.id, comment=instance.comment_id)
+    else:
+        record_change(board_id, 'reaction', 'saved', instance.id, comment=instance.comment_id,
+            author=instance.author_id, reaction=instance.reaction)
+
+# Search index, see search.py
+@receiver(post_save, sender=Card)
+def index_card(sender, instance, update_fields=None, **kwargs):
+    # Moves only save the list and location, nothing that's searched
+    if update_fields is not None and not {'title', 'description'} & set(update_fields):
+        return
+    search.index_card(instance)
+
+@receiver(post_save, sender=Comment)
+def index_comment(sender, instance, **kwargs):
+    search.index_comment(instance)
+
+@receiver(post_save, sender=Task)
+def index_task(sender, instance, **kwargs):
+    search.index_task(instance)
+
+@receiver(post_save, sender=CardTag)
+def index_card_tag(sender, instance, **kwargs):
+    search.index_card_tag(instance)
+
+@receiver(post_save, sender=Tag)
+def index_tag(sender, instance, created, **kwargs):
+    if not created:
+        search.index_tag(instance)
+
+@receiver(post_delete, sender=Comment)
+@receiver(post_delete, sender=Task)
+def unindex(sender, instance, **kwargs):
+    # Whole boards going take their entries with them
+    if instance.board_id not in deleting_boards():
+        search.remove_entries(instance.card_id, sender._meta.model_name, instance.id)
+
+@receiver(post_delete, sender=CardTag)
+def unindex_card_tag(sender, instance, **kwargs):
+    if instance.board_id not in deleting_boards():
+        search.remove_entries(instance.card_id, 'tag', instance.tag_id)
+
+# Tag filter indexes, see tagfilter.py
+@receiver(post_save, sender=CardTag)
+def tag_filter_add(sender, instance, created, **kwargs):
+    if created:
+        card_tag_changed(instance, True)
+    else:
+        # Moved to another card or tag, there's no knowing which it was on before
+        invalidate_tag_index(instance.board_id)
+
+@receiver(post_delete, sender=CardTag)
+def tag_filter_remove(sender, instance, **kwargs):
+    if instance.board_id not in deleting_boards():
+        card_tag_changed(instance, False)
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def tag_filter_tag(sender, instance, created=False, **kwargs):
+    # A new tag isn't on any cards yet
+    if not created:
+        invalidate_tag_index(instance.board_id)
+
+# Activity feeds, see activity.py. Before the counters, which move Task._loaded on to the saved values
+@receiver(post_save, sender=Card)
+def card_activity(sender, instance, created, **kwargs):
+    # Against what was loaded, not update_fields, a rename or a reorder within the list isn't a move
+    loaded = getattr(instance, '_loaded', None)
+    if created:
+        activity.record(instance.board_id, Activity.Verb.CARD_CREATED, instance.id, instance.title, instance.author_id)
+    elif loaded is not None and instance.list_id != loaded[0]:
+        activity.record(instance.board_id, Activity.Verb.CARD_MOVED, instance.id, instance.title)
+    elif loaded is not None and instance.archived and not loaded[1]:
+        activity.record(instance.board_id, Activity.Verb.CARD_ARCHIVED, instance.id, instance.title)
+    instance._loaded = (instance.list_id, instance.archived)
+
+@receiver(post_delete, sender=Card)
+def card_deleted_activity(sender, instance, **kwargs):
+    activity.record(instance.board_id, Activity.Verb.CARD_DELETED, instance.id, instance.title)
+
+@receiver(post_save, sender=Comment)
+def comment_activity(sender, instance, created, **kwargs):
+    if created:
+        activity.record(instance.board_id, Activity.Verb.COMMENTED, instance.card_id, instance.comment,
+            instance.author_id)
+
+@receiver(post_save, sender=Reaction)
+def reaction_activity(sender, instance, created, **kwargs):
+    board_id, card_id = reaction_card(instance)
+    if created and board_id is not None:
+        activity.record(board_id, Activity.Verb.REACTED, card_id, instance.get_reaction_display(),
+            instance.author_id)
+
+@receiver(post_save, sender=Task)
+def task_activity(sender, instance, created, **kwargs):
+    loaded = getattr(instance, '_loaded', None)
+    if created:
+        activity.record(instance.board_id, Activity.Verb.TASK_ADDED, instance.card_id, instance.name)
+    elif instance.done and loaded is not None and loaded[1] is False:
+        activity.record(instance.board_id, Activity.Verb.TASK_DONE, instance.card_id, instance.name)
+
+@receiver(post_save, sender=Attachment)
+def attachment_activity(sender, instance, created, **kwargs):
+    if created:
+        activity.record(instance.board_id, Activity.Verb.ATTACHED, instance.card_id,
+            instance.name or os.path.basename(instance.file.name), instance.author_id)
+
+@receiver(post_save, sender=List)
+def list_activity(sender, instance, created, **kwargs):
+    if created:
+        activity.record(instance.board_id, Activity.Verb.LIST_CREATED, instance.id, instance.title)
+
+@receiver(post_save, sender=BoardMember)
+def member_activity(sender, instance, created, **kwargs):
+    # The owner comes with a new board, that's not news
+    if created and instance.access != BoardMember.Access.OWNER:
+        activity.record(instance.board_id, Activity.Verb.MEMBER_ADDED, instance.member_id, instance.member.username)
+
+# Card and comment counters, see counters.py
+@receiver(post_save, sender=Task)
+def count_task(sender, instance, created, **kwargs):
+    loaded = getattr(instance, '_loaded', None)
+
+    if created:
+        adjust(Card, instance.card_id, task_count=1, task_done_count=int(instance.done))
+    elif loaded is None or None in loaded:
+        # Don't know what it was before, so count the card again
+        recount_cards([instance.card_id])
+    elif loaded[0] != instance.card_id:
+        adjust(Card, loaded[0], task_count=-1, task_done_count=-int(loaded[1]))
+        adjust(Card, instance.card_id, task_count=1, task_done_count=int(instance.done))
+    else:
+        adjust(Card, instance.card_id, task_done_count=int(instance.done) - int(loaded[1]))
+
+    instance._loaded = (instance.card_id, instance.done)
+
+@receiver(post_delete, sender=Task)
+def uncount_task(sender, instance, **kwargs):
+    if instance.board_id not in deleting_boards():
+        adjust(Card, instance.card_id, task_count=-1, task_done_count=-int(instance.done))
+
+@receiver(post_save, sender=Comment)
+@receiver(post_save, sender=Attachment)
+def count_card_child(sender, instance, created, **kwargs):
+    if created:
+        adjust(Card, instance.card_id, **{'%s_count' % sender._meta.model_name: 1})
+
+@receiver(post_delete, sender=Comment)
+@receiver(post_delete, sender=Attachment)
+def uncount_card_child(sender, instance, **kwargs):
+    if instance.board_id not in deleting_boards():
+        adjust(Card, instance.card_id, **{'%s_count' % sender._meta.model_name: -1})
+
+@receiver(post_save, sender=Reaction)
+def count_reaction(sender, instance, created, **kwargs):
+    if created:
+        adjust(Comment, instance.comment_id, **{REACTION_COUNTERS[instance.reaction]: 1})
+    else:
+        recount_comments([instance.comment_id])
+
+@receiver(post_delete, sender=Reaction)
+def uncount_reaction(sender, instance, **kwargs):
+    adjust(Comment, instance.comment_id, **{REACTION_COUNTERS[instance.reaction]: -1})
+
+@receiver(post_delete, sender=Attachment)
+def release_attachment_file(sender, instance, **kwargs):
+    # Files are shared between attachments with the same content, only the last one out removes it
+    name = instance.file.name
+    transaction.on_commit(lambda: release_file(name))
+
+@receiver(post_save, sender=Attachment)
+def attachment_thumbnails(sender, instance, created, **kwargs):
+    if created:
+        schedule_thumbnails(instance.file.name, instance.sha256)
+
+@receiver(post_save, sender=Profile)
+def avatar_thumbnails(sender, instance, **kwargs):
+    # Only a new avatar needs thumbnails, not every edit to the profile
+    if instance.avatar and instance.avatar.name != getattr(instance, '_loaded_avatar', None):
+        # Remembered so the thumbnails aren't removed along with an attachment of the same picture, see release_file
+        instance.avatar_sha256 = source_digest(instance.avatar.name)
+        Profile.objects.filter(id=instance.id).update(avatar_sha256=instance.avatar_sha256)
+        schedule_thumbnails(instance.avatar.name, instance.avatar_sha256)
+        instance._loaded_avatar = instance.avatar.name
+    elif not instance.avatar and instance.avatar_sha256:
+        instance.avatar_sha256 = ''
+        Profile.objects.filter(id=instance.id).update(avatar_sha256='')
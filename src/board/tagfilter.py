@@ -0,0 +1,253 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import *
+from .cache import get_version, bump_version
+from .databases import up_to_date
+
+"""
+Tag Filters
+===========
+
+Filters a board's cards by a boolean expression over tag names:
+
+    bug urgent                      tagged bug and urgent (AND is implied)
+    bug AND NOT blocked
+    (bug OR "needs review") AND NOT blocked
+
+Keywords are case insensitive, names with spaces (or named like a keyword) go in double quotes, and a name no card
+is tagged with matches nothing.
+
+Expressions run against a TagIndex, each tag's cards as a bitmap (a Python int, one bit per card on the board), so
+AND/OR/NOT are single integer operations however many cards there are. An index is built from one CardTag query
+and kept in memory per process for the last BOARD_TAG_INDEXES boards filtered.
+
+Each board has a tag version counter in the cache. Saving or deleting a CardTag moves it on and, if this
+process's index was built for the version just before, updates that index in place (see card_tag_changed).
+Any other process sees the version has moved and rebuilds. Anything that changes tags without CardTag signals (tag
+renames, bulk_create) calls invalidate_tag_index instead.
+"""
+
+MAX_INDEXES = getattr(settings, 'BOARD_TAG_INDEXES', 200)
+
+# Longer filters than anyone would type, and deep enough nesting to run out of stack, are turned away
+MAX_LENGTH = 200
+
+KEYWORDS = ('and', 'or', 'not')
+TOKENS = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|([^\s()"]+))')
+
+_lock = threading.Lock()
+_indexes = OrderedDict()
+
+class TagFilterError(ValueError):
+    pass
+
+def tag_version_key(board_id):
+    return 'board:%s:tag-version' % board_id
+
+class TagIndex:
+    """
+    {tag id: bitmap of cards} for one board, with each card's bit position and the tag ids going by each name.
+    """
+    def __init__(self, version, rows):
+        self.version = version
+        self.cards = []
+        self.positions = {}
+        self.tags = {}
+        self.names = {}
+        self.tag_names = {}
+        for card_id, tag_id, name in rows:
+            self.add(card_id, tag_id, name)
+
+    def add(self, card_id, tag_id, name=None):
+        position = self.positions.get(card_id)
+        if position is None:
+            position = self.positions[card_id] = len(self.cards)
+            self.cards.append(card_id)
+        if tag_id not in self.tag_names:
+            self.tag_names[tag_id] = name
+            self.names.setdefault(name.lower(), set()).add(tag_id)
+        self.tags[tag_id] = self.tags.get(tag_id, 0) | 1 << position
+
+    def remove(self, card_id, tag_id):
+        position = self.positions.get(card_id)
+        if position is not None and tag_id in self.tags:
+            self.tags[tag_id] &= ~(1 << position)
+
+    def bitmap(self, name):
+        bitmap = 0
+        for tag_id in self.names.get(name.lower(), ()):
+            bitmap |= self.tags[tag_id]
+        return bitmap
+
+    def card_ids(self, bitmap):
+        # Finding the 1s in the binary string is a lot quicker than picking bits off a big int one at a time
+        bits = bin(bitmap)[:1:-1]
+        cards = []
+        position = bits.find('1')
+        while position != -1:
+            cards.append(self.cards[position])
+            position = bits.find('1', position + 1)
+        return cards
+
+@lru_cache(maxsize=256)
+def parse(text):
+    """
+    Parses a tag filter into nested tuples, ('tag', name), ('not', x), ('and', x, y) or ('or', x, y). Raises
+    TagFilterError if it doesn't make sense.
+    """
+    tokens = []
+    position = 0
+    text = text.strip()
+    if len(text) > MAX_LENGTH:
+        raise TagFilterError("Tag filter too long")
+    while position < len(text):
+        match = TOKENS.match(text, position)
+        if match is None:
+            raise TagFilterError("Unclosed quote")
+        opening, closing, quoted, word = match.groups()
+        if opening or closing:
+            tokens.append(opening or closing)
+        elif quoted is not None:
+            tokens.append(('tag', quoted))
+        elif word.lower() in KEYWORDS:
+            tokens.append(word.lower())
+        else:
+            tokens.append(('tag', word))
+        position = match.end()
+
+    if not tokens:
+        raise TagFilterError("Empty tag filter")
+
+    def expression(i):
+        node, i = term(i)
+        while i < len(tokens) and tokens[i] == 'or':
+            right, i = term(i + 1)
+            node = ('or', node, right)
+        return node, i
+
+    def term(i):
+        node, i = factor(i)
+        while i < len(tokens) and tokens[i] not in ('or', ')'):
+            right, i = factor(i + 1 if tokens[i] == 'and' else i)
+            node = ('and', node, right)
+        return node, i
+
+    def factor(i):
+        if i >= len(tokens):
+            raise TagFilterError("Tag filter ends too soon")
+        token = tokens[i]
+        if token == 'not':
+            node, i = factor(i + 1)
+            return ('not', node), i
+        if token == '(':
+            node, i = expression(i + 1)
+            if i >= len(tokens) or tokens[i] != ')':
+                raise TagFilterError("Missing ')'")
+            return node, i + 1
+        if isinstance(token, tuple):
+            return token, i + 1
+        raise TagFilterError("Unexpected '%s'" % token)
+
+    node, i = expression(0)
+    if i < len(tokens):
+        raise TagFilterError("Unexpected '%s'" % tokens[i])
+    return node
+
+def evaluate(node, index):
+    """
+    (bitmap of the indexed cards 'node' matches, whether it matches a card without tags).
+    """
+    kind = node[0]
+    if kind == 'tag':
+        return index.bitmap(node[1]), False
+    if kind == 'not':
+        bitmap, untagged = evaluate(node[1], index)
+        return ((1 << len(index.cards)) - 1) ^ bitmap, not untagged
+    left, left_untagged = evaluate(node[1], index)
+    right, right_untagged = evaluate(node[2], index)
+    if kind == 'and':
+        return left & right, left_untagged and right_untagged
+    return left | right, left_untagged or right_untagged
+
+def get_tag_index(board_id):
+    """
+    The boards TagIndex, from this process's memory if it's still current.
+    """
+    version = get_version(tag_version_key(board_id))
+    with _lock:
+        index = _indexes.get(board_id)
+        if index is not None and index.version == version:
+            _indexes.move_to_end(board_id)
+            return index
+
+    with up_to_date('board', [board_id]):
+        rows = list(CardTag.objects.filter(board=board_id).order_by().values_list('card_id', 'tag_id', 'tag__name'))
+    index = TagIndex(version, rows)
+
+    with _lock:
+        _indexes[board_id] = index
+        _indexes.move_to_end(board_id)
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+def filter_cards(board_id, text, card_ids):
+    """
+    Filter Cards
+    ------------
+
+    The ids out of 'card_ids' (cards on board 'board_id') matching the tag filter 'text', as a set. Raises
+    TagFilterError for a filter that doesn't parse.
+    """
+    index = get_tag_index(board_id)
+    bitmap, untagged = evaluate(parse(text), index)
+    matching = set(index.card_ids(bitmap))
+    return {card_id for card_id in card_ids
+        if card_id in matching or (untagged and card_id not in index.positions)}
+
+def filter_lists(lists, card_ids):
+    """
+    A copy of a snapshots lists with only the cards in 'card_ids'.
+    """
+    return [{**l, "cards": [card for card in l["cards"] if card["id"] in card_ids]} for l in lists]
+
+def card_tag_changed(card_tag, present):
+    """
+    Moves the boards tag version on once the current transaction commits, updating this process's index in place if
+    it was only that one change behind.
+    """
+    board_id, card_id, tag_id = card_tag.board_id, card_tag.card_id, card_tag.tag_id
+    key = tag_version_key(board_id)
+
+    def apply():
+        try:
+            version = cache.incr(key)
+        except ValueError:
+            cache.add(key, time.time_ns(), timeout=None)
+            version = None
+
+        with _lock:
+            index = _indexes.get(board_id)
+            if index is None:
+                return
+            # A tag the index hasn't seen would need its name looking up, rebuilding is as cheap
+            if version is None or index.version != version - 1 or (present and tag_id not in index.tag_names):
+                del _indexes[board_id]
+            elif present:
+                index.add(card_id, tag_id)
+                index.version = version
+            else:
+                index.remove(card_id, tag_id)
+                index.version = version
+    transaction.on_commit(apply)
+
+def invalidate_tag_index(board_id):
+    bump_version(tag_version_key(board_id))
@@ -0,0 +1,45 @@
+from django import template
+from django.urls import reverse
+from django.utils.html import format_html
+
+from board.thumbnails import size_for
+
+"""
+Thumbnail Template Tags
+=======================
+
+    {% load thumbnails %}
+    {% avatar member.id 32 member.username %}
+    {% thumbnail attachment 256 %}
+
+Both render a <picture> asking for the smallest derivative that covers the requested size (and the next one up for
+high density screens), WebP first with JPEG for browsers without it.
+"""
+
+register = template.Library()
+
+def picture(url_name, kwargs, px, alt):
+    def srcset(fmt):
+        return '%s 1x, %s 2x' % tuple(reverse(url_name, kwargs={**kwargs, "size": size_for(scale * px), "fmt": fmt})
+            for scale in (1, 2))
+
+    return format_html('<picture><source type="image/webp" srcset="{}">'
+        '<img src="{}" srcset="{}" alt="{}" style="max-width: {}px; max-height: {}px" loading="lazy"></picture>',
+        srcset('webp'), reverse(url_name, kwargs={**kwargs, "size": size_for(px), "fmt": 'jpeg'}), srcset('jpeg'),
+        alt, px, px)
+
+@register.simple_tag
+def avatar(user_id, px=64, alt=''):
+    return picture('avatar', {"user_id": user_id}, int(px), alt)
+
+@register.simple_tag
+def thumbnail(attachment, px=256, alt=''):
+    """
+    'attachment' is an Attachment or a dict with its "id" and "board_id".
+    """
+    if isinstance(attachment, dict):
+        kwargs = {"board_id": attachment["board_id"], "attachment_id": attachment["id"]}
+    else:
+        kwargs = {"board_id": attachment.board_id, "attachment_id": attachment.id}
+        alt = alt or attachment.get_name()
+    return picture('attachment-thumbnail', kwargs, int(px), alt)
@@ -1,3 +1,2009 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from io import BytesIO
+from datetime import timedelta
+
+from django.conf import settings as site_settings
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, router, transaction
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.base import UpdateError
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db.models.signals import post_delete
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.template import Context, Template
+from django.http import HttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
+from PIL import Image
+
+from .models import *
+from .loader import load_board
+from .cache import get_board_snapshot, get_board_version, bump_board_version
+from .permissions import get_access, can_read, can_write, can_admin, NO_ACCESS
+from .bulk import apply_operations
+from .realtime import BoardEventsApp, get_broker
+from .changes import get_changes, compact_changes, record_change, deleting_boards
+from .search import search, reindex_cards
+from .attachments import blob_name, release_file
+from .counters import recount_cards, recount_comments
+from . import thumbnails
+from .jobs import job, enqueue, claim, run_pending, TIMEOUT
+from .dashboard import load_dashboard
+from .workload import generate_workload
+from .benchmark import run_benchmark, run_session_benchmark, compare
+from .explain import check_queries
+from .purge import archive_board, purge
+from .export import BoardImportError, export_board, import_board
+from .clone import clone_board
+from .instrumentation import QueryInstrumentationMiddleware, QueryBudgetExceeded, record_queries, query_budget, fingerprint
+from .pagination import CursorPaginator, InvalidCursor
+from . import sessions
+from .sessions import SessionStore, flush_sessions, discard_sessions, queue
+from .databases import ReplicaMiddleware, replica_reads, up_to_date
+from .tagfilter import TagFilterError, parse, filter_cards, get_tag_index
+from .ordering import GAP, next_rank, card_siblings, list_siblings, move_card, move_list, reorder
+from .activity import acting_as, recent_activity, rollup_activity, user_feed
 
 # Create your tests here.
+
+def make_board(title='Test Board', lists=1, cards=1, author=None):
+    """
+    Builds a board with 'lists' lists each holding 'cards' cards, every card gets a tag, a couple of tasks
+    and an attachment so the loader has something to aggregate.
+    """
+    author = author or User.objects.create_user(username='author-%s' % title, password='password')
+    board = Board.objects.create(title=title, author=author)
+    BoardMember.objects.create(board=board, member=author, access=BoardMember.Access.OWNER)
+    tag = Tag.objects.create(board=board, name='bug', colour='ff0000')
+
+    for i in range(lists):
+        l = List.objects.create(board=board, title='List %s' % i, location=List.objects.count())
+        for j in range(cards):
+            c = Card.objects.create(board=board, list=l, location=j, author=author, title='Card %s' % j)
+            CardTag.objects.create(board=board, card=c, tag=tag)
+            Task.objects.create(board=board, card=c, name='one', done=True)
+            Task.objects.create(board=board, card=c, name='two')
+            Attachment.objects.create(board=board, card=c, author=author, file='board_%s/spec.txt' % board.id)
+
+    return board
+
+def board_contents(board):
+    """
+    Everything on a board without its ids, to compare an import or a copy with the original.
+    """
+    return [(l.title, [(c.title, c.author.username, c.task_count, c.attachment_count,
+        sorted(c.get_tags().values_list('tag__name', flat=True)),
+        sorted(Task.objects.filter(card=c).values_list('name', 'done')),
+        [(m.comment, m.author.username, m.like_count, m.get_reactions().count())
+            for m in Comment.objects.filter(card=c).order_by('id')],
+        sorted(c.get_attachments().values_list('file', 'name')))
+        for c in Card.objects.filter(list=l).order_by('location', 'id')])
+        for l in List.objects.filter(board=board).order_by('location', 'id')]
+
+
+# Jobs for JobTests, they have to be importable by name
+CALLS = []
+
+@job(concurrency=1)
+def record_call(value):
+    CALLS.append(value)
+
+@job(max_attempts=2)
+def always_fails():
+    raise ValueError("Nope")
+
+
+# Replicas are test mirrors of the primary (todo/replica_settings.py) but a separate connection, one that can't see
+# what a test has written in its transaction, so reads stay on the primary unless a test asks otherwise. Sessions
+# are kept in the default (locmem) cache rather than the shipped file based one so tests leave nothing on disk,
+# SessionTests set up a shared cache of their own
+@override_settings(QUERY_BUDGET_RAISE=True, DATABASE_REPLICAS=[], SESSION_CACHE_ALIAS='default')
+class BoardTestCase(TestCase):
+
+    def setUp(self):
+        # Board ids get reused between tests, so don't let snapshots (or sessions waiting to be written) leak from one
+        # to the next
+        cache.clear()
+        discard_sessions()
+
+        # Views going over their query budget fail the test instead, the per-request lines are just noise here
+        performance = logging.getLogger('board.performance')
+        self.addCleanup(performance.setLevel, performance.level)
+        performance.setLevel(logging.ERROR)
+
+
+class BoardLoaderTests(BoardTestCase):
+
+    def count_queries(self, board):
+        with CaptureQueriesContext(connection) as ctx:
+            load_board(board.id)
+        return len(ctx.captured_queries)
+
+    def test_structure(self):
+        board = make_board(lists=2, cards=3)
+        snapshot = load_board(board.id)
+
+        self.assertEqual(snapshot["board"]["title"], board.title)
+        self.assertEqual(snapshot["member_ids"], {board.author_id})
+        self.assertEqual([l["title"] for l in snapshot["lists"]], ['List 0', 'List 1'])
+
+        card = snapshot["lists"][0]["cards"][0]
+        self.assertEqual(card["tags"], [{"id": Tag.objects.get().id, "name": 'bug', "colour": 'ff0000'}])
+        self.assertEqual((card["task_done_count"], card["task_count"], card["attachment_count"]), (1, 2, 1))
+
+    def test_query_count_is_constant(self):
+        small = make_board('Small', lists=1, cards=1)
+        large = make_board('Large', lists=5, cards=20)
+
+        self.assertEqual(self.count_queries(small), self.count_queries(large))
+        self.assertLessEqual(self.count_queries(large), 5)
+
+    def test_missing_board(self):
+        with self.assertRaises(Board.DoesNotExist):
+            load_board(0)
+
+    def test_board_view(self):
+        board = make_board(lists=2, cards=2)
+        self.client.force_login(board.author)
+
+        response = self.client.get(board.get_absolute_url())
+        self.assertContains(response, 'Card 1')
+        self.assertContains(response, '1/2 tasks')
+
+    def test_board_view_requires_membership(self):
+        board = make_board()
+        self.client.force_login(User.objects.create_user(username='outsider', password='password'))
+
+        response = self.client.get(board.get_absolute_url())
+        self.assertNotContains(response, 'Card 0')
+
+
+class BoardSnapshotCacheTests(BoardTestCase):
+
+    def test_warm_view_only_queries_auth(self):
+        board = make_board(lists=2, cards=2)
+        self.client.force_login(board.author)
+        self.client.get(board.get_absolute_url())
+
+        # Just the user, the session comes out of the cache and nothing board related is loaded
+        with self.assertNumQueries(1):
+            response = self.client.get(board.get_absolute_url())
+        self.assertContains(response, 'Card 1')
+
+    def test_writes_invalidate_snapshot(self):
+        board = make_board()
+        card = Card.objects.get()
+        get_board_snapshot(board.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            card.title = 'Renamed'
+            card.save()
+
+        self.assertEqual(get_board_snapshot(board.id)["lists"][0]["cards"][0]["title"], 'Renamed')
+
+    def test_child_delete_bumps_version(self):
+        board = make_board()
+        version = get_board_version(board.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Task.objects.filter(done=True).get().delete()
+
+        self.assertGreater(get_board_version(board.id), version)
+        self.assertEqual(get_board_snapshot(board.id)["lists"][0]["cards"][0]["task_done_count"], 0)
+
+    def test_evicted_version_does_not_reuse_snapshot(self):
+        board = make_board()
+        get_board_snapshot(board.id)
+        cache.delete('board:%s:version' % board.id)
+
+        Card.objects.update(title='Changed')
+        self.assertEqual(get_board_snapshot(board.id)["lists"][0]["cards"][0]["title"], 'Changed')
+
+
+class BoardPermissionTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.board = make_board()
+        self.user = User.objects.create_user(username='member', password='password')
+
+    def test_levels(self):
+        BoardMember.objects.create(board=self.board, member=self.user, access=BoardMember.Access.WRITE)
+
+        self.assertTrue(can_read(self.user, self.board.id))
+        self.assertTrue(can_write(self.user, self.board.id))
+        self.assertFalse(can_admin(self.user, self.board.id))
+        self.assertTrue(can_admin(self.board.author, self.board.id))
+
+    def test_outsiders_and_missing_boards(self):
+        self.assertEqual(get_access(self.user, self.board.id), NO_ACCESS)
+        self.assertEqual(get_access(self.user, 0), NO_ACCESS)
+
+    def test_cached_after_first_lookup(self):
+        get_access(self.user, self.board.id)
+        with self.assertNumQueries(0):
+            self.assertFalse(can_read(self.user, self.board.id))
+
+    def test_membership_change_invalidates(self):
+        self.assertFalse(can_read(self.user, self.board.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            member = BoardMember.objects.create(board=self.board, member=self.user, access=BoardMember.Access.ADMIN)
+        self.assertTrue(can_admin(self.user, self.board.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            member.delete()
+        self.assertFalse(can_read(self.user, self.board.id))
+
+    def test_has_admin_privileges(self):
+        member = BoardMember.objects.create(board=self.board, member=self.user, access=BoardMember.Access.ADMIN)
+        self.assertTrue(member.has_admin_privileges())
+        member.access = BoardMember.Access.WRITE
+        self.assertFalse(member.has_admin_privileges())
+
+    def test_view_denies_outsiders(self):
+        self.client.force_login(self.user)
+        self.assertContains(self.client.get(self.board.get_absolute_url()), 'Page Not Found')
+
+
+class OrderingTests(BoardTestCase):
+
+    def titles(self, lst):
+        return list(card_siblings(lst.id).order_by('location', 'id').values_list('title', flat=True))
+
+    def test_lists_share_locations_across_boards(self):
+        first, second = make_board('First'), make_board('Second')
+        List.objects.create(board=first, title='Extra', location=GAP)
+        List.objects.create(board=second, title='Extra', location=GAP)
+
+        self.assertEqual(next_rank(list_siblings(first.id)), List.objects.filter(board=first).latest('location').location + GAP)
+
+    def test_move_card_within_and_between_lists(self):
+        board = make_board(lists=2, cards=3)
+        first, second = List.objects.filter(board=board).order_by('location')
+        card = Card.objects.get(list=first, title='Card 2')
+
+        move_card(card, after=None)
+        self.assertEqual(self.titles(first), ['Card 2', 'Card 0', 'Card 1'])
+
+        move_card(card, to_list=second, after=Card.objects.get(list=second, title='Card 0'))
+        self.assertEqual(self.titles(second), ['Card 0', 'Card 2', 'Card 1', 'Card 2'])
+        self.assertEqual(self.titles(first), ['Card 0', 'Card 1'])
+
+    def test_move_cost_does_not_grow(self):
+        def cost(size):
+            board = make_board('Size %s' % size, cards=size)
+            cards = list(Card.objects.filter(board=board).order_by('location'))
+            with CaptureQueriesContext(connection) as ctx:
+                move_card(cards[-1], after=cards[size // 2])
+            return len(ctx.captured_queries)
+
+        self.assertEqual(cost(5), cost(50))
+
+    def test_rebalance_when_gap_runs_out(self):
+        board = make_board(cards=2)
+        lst = List.objects.get(board=board)
+        first = Card.objects.get(title='Card 0')
+
+        # Keep moving new cards into the same spot until the gap has to be split more than it can be
+        for i in range(20):
+            card = Card.objects.create(board=board, list=lst, author=board.author, title='New %s' % i,
+                location=next_rank(card_siblings(lst.id)))
+            move_card(card, after=first)
+
+        self.assertEqual(self.titles(lst)[:2], ['Card 0', 'New 19'])
+        self.assertEqual(len(set(card_siblings(lst.id).values_list('location', flat=True))), 22)
+
+    def test_bulk_reorder_and_move_list(self):
+        board = make_board(lists=3, cards=0)
+        a, b, c = List.objects.filter(board=board).order_by('location')
+
+        reorder(list_siblings(board.id), [c.id, a.id, b.id])
+        self.assertEqual(list(list_siblings(board.id).order_by('location').values_list('id', flat=True)), [c.id, a.id, b.id])
+
+        b.refresh_from_db()
+        move_list(c, after=b)
+        self.assertEqual(list(list_siblings(board.id).order_by('location').values_list('id', flat=True)), [a.id, b.id, c.id])
+
+
+class BulkOperationTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.board = make_board(lists=2, cards=3)
+        self.first, self.second = List.objects.filter(board=self.board).order_by('location')
+        self.cards = list(Card.objects.filter(list=self.first).order_by('location'))
+
+    def test_mixed_batch(self):
+        tag = Tag.objects.create(board=self.board, name='urgent', colour='ffaa00')
+        task = Task.objects.filter(card=self.cards[0], done=False).get()
+
+        results = apply_operations(self.board, [
+            {"op": "move", "card": self.cards[0].id, "list": self.second.id},
+            {"op": "move", "card": self.cards[2].id, "list": self.first.id, "after": None},
+            {"op": "tag", "card": self.cards[1].id, "tag": tag.id},
+            {"op": "untag", "card": self.cards[1].id, "tag": Tag.objects.get(name='bug').id},
+            {"op": "archive", "card": self.cards[1].id},
+            {"op": "task", "task": task.id, "done": True},
+            {"op": "add_task", "card": self.cards[0].id, "name": 'three'},
+        ])
+
+        self.assertTrue(all(r["ok"] for r in results))
+        self.assertEqual(list(Card.objects.filter(list=self.first).order_by('location').values_list('id', flat=True)),
+            [self.cards[2].id, self.cards[1].id])
+        self.assertEqual(Card.objects.filter(list=self.second).order_by('location').last().id, self.cards[0].id)
+        self.assertEqual(list(self.cards[1].get_tags().values_list('tag__name', flat=True)), ['urgent'])
+        self.assertTrue(Card.objects.get(id=self.cards[1].id).archived)
+        self.assertEqual(Task.objects.filter(card=self.cards[0], done=True).count(), 2)
+        self.assertEqual(Task.objects.filter(card=self.cards[0]).count(), 3)
+
+    def test_per_item_errors(self):
+        other = make_board('Other')
+        task = Task.objects.filter(card=self.cards[0], done=False).get()
+        results = apply_operations(self.board, [
+            {"op": "archive", "card": Card.objects.get(board=other).id},
+            {"op": "explode"},
+            "nonsense",
+            {"op": "task", "task": task.id, "done": "false"},
+            {"op": "task", "task": task.id, "done": 1},
+            {"op": "archive", "card": self.cards[0].id},
+        ])
+        self.assertEqual([r["ok"] for r in results], [False, False, False, False, False, True])
+        self.assertFalse(Card.objects.get(board=other).archived)
+        self.assertFalse(Task.objects.get(id=task.id).done)
+
+    def test_query_count_independent_of_batch_size(self):
+        def cost(cards):
+            ops = [{"op": "move", "card": c.id, "list": self.second.id} for c in cards]
+            with CaptureQueriesContext(connection) as ctx:
+                apply_operations(self.board, ops)
+            return len(ctx.captured_queries)
+
+        self.assertEqual(cost(self.cards[:1]), cost(list(Card.objects.filter(board=self.board))))
+
+    def test_view(self):
+        reader = User.objects.create_user(username='reader', password='password')
+        BoardMember.objects.create(board=self.board, member=reader, access=BoardMember.Access.READ)
+        url = reverse('board-bulk', kwargs={"board_id": self.board.id})
+        body = json.dumps({"operations": [{"op": "archive", "card": self.cards[0].id}]})
+
+        self.client.force_login(reader)
+        self.client.post(url, body, content_type='application/json')
+        self.assertFalse(Card.objects.get(id=self.cards[0].id).archived)
+
+        self.client.force_login(self.board.author)
+        response = self.client.post(url, body, content_type='application/json')
+        self.assertEqual(response.json(), {"results": [{"ok": True}]})
+        self.assertTrue(Card.objects.get(id=self.cards[0].id).archived)
+
+
+class BoardApiTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.board = make_board(lists=2, cards=2)
+        self.url = reverse('board-api', kwargs={"board_id": self.board.id})
+        self.client.force_login(self.board.author)
+
+    def test_content(self):
+        response = self.client.get(self.url)
+        data = response.json()
+
+        self.assertEqual(data["board"]["title"], self.board.title)
+        self.assertEqual(data["members"][0]["username"], self.board.author.username)
+        self.assertEqual(data["lists"][1]["cards"][0]["tags"][0]["name"], 'bug')
+        self.assertEqual(data["lists"][1]["cards"][0]["task_done_count"], 1)
+        self.assertTrue(response.has_header('ETag'))
+        self.assertFalse(response.has_header('Last-Modified'))
+
+    def test_not_modified_without_loading_board(self):
+        etag = self.client.get(self.url)['ETag']
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_if_modified_since_is_ignored(self):
+        # A write in the same second as the last fetch still has to come through
+        since = http_date(time.time())
+        self.client.get(self.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            Card.objects.first().delete()
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=since).status_code, 200)
+
+    def test_change_gives_new_etag(self):
+        etag = self.client.get(self.url)['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Card.objects.first().delete()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class BoardEventsTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.board = make_board()
+        self.client.force_login(self.board.author)
+
+    async def fallback(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": 418, "headers": []})
+
+    async def request(self, path, cookie, until):
+        """
+        Runs the events app until 'until(messages)' is happy, then disconnects and returns what was sent.
+        """
+        incoming, messages = asyncio.Queue(), []
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": 'http', "path": path, "headers": [(b'cookie', cookie.encode())]}
+        app = asyncio.ensure_future(BoardEventsApp(self.fallback, keepalive=0.05)(scope, incoming.get, send))
+
+        for _ in range(200):
+            await asyncio.sleep(0.01)
+            if app.done() or until(messages):
+                break
+
+        await incoming.put({"type": 'http.disconnect'})
+        await asyncio.wait_for(app, 1)
+        return messages
+
+    def cookie(self):
+        return 'sessionid=%s' % self.client.cookies['sessionid'].value
+
+    async def test_streams_published_events(self):
+        path = '/b/%s/events/' % self.board.id
+
+        def until(messages):
+            if len(messages) == 2:
+                get_broker().publish(self.board.id, {"type": 'task.saved', "id": 1, "done": True})
+            return any(b'task.saved' in m.get('body', b'') for m in messages)
+
+        messages = await self.request(path, self.cookie(), until)
+
+        self.assertEqual(messages[0]["status"], 200)
+        self.assertIn(b'event: task.saved\ndata: {"type": "task.saved", "id": 1, "done": true}\n\n', [m.get('body') for m in messages])
+        self.assertEqual(get_broker().subscribers, {})
+
+    async def test_requires_access(self):
+        messages = await self.request('/b/%s/events/' % self.board.id, 'sessionid=nonsense', lambda messages: False)
+        self.assertEqual(messages[0]["status"], 403)
+
+    async def test_other_paths_go_to_django(self):
+        messages = await self.request('/dashboard/', self.cookie(), lambda messages: False)
+        self.assertEqual(messages[0]["status"], 418)
+
+    def test_signals_publish_after_commit(self):
+        received = []
+        broker = get_broker()
+        broker.publish, original = (lambda board_id, event: received.append((board_id, event))), broker.publish
+
+        try:
+            with self.captureOnCommitCallbacks(execute=True):
+                task = Task.objects.filter(done=False).first()
+                task.done = True
+                task.save()
+        finally:
+            broker.publish = original
+
+        self.assertIn((self.board.id, {"type": 'task.saved', "seq": Board.objects.get().change_seq, "id": task.id,
+            "card": task.card_id, "name": task.name, "done": True}), received)
+
+
+class ChangeLogTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.board = make_board()
+        self.seq = Board.objects.get(id=self.board.id).change_seq
+
+    def test_changes_since(self):
+        card = Card.objects.get()
+        card.title = 'Renamed'
+        card.save()
+        Task.objects.filter(card=card).first().delete()
+
+        result = get_changes(self.board.id, self.seq)
+        self.assertEqual([(c["entity"], c["op"]) for c in result["changes"]], [('card', 'saved'), ('task', 'deleted')])
+        self.assertEqual(result["changes"][0]["data"]["title"], 'Renamed')
+        self.assertEqual(result["seq"], self.seq + 2)
+        self.assertEqual(get_changes(self.board.id, result["seq"]), {"seq": result["seq"], "changes": []})
+
+    def test_stale_board_save_keeps_sequence(self):
+        stale = Board.objects.get(id=self.board.id)
+        card = Card.objects.get()
+        card.title = 'Renamed'
+        card.save()
+
+        stale.description = 'Edited'
+        stale.save()
+        card.title = 'Renamed again'
+        card.save()
+
+        result = get_changes(self.board.id, self.seq)
+        self.assertEqual([c["seq"] for c in result["changes"]][-2:], [result["seq"] - 1, result["seq"]])
+        self.assertEqual(Board.objects.get(id=self.board.id).change_seq, result["seq"])
+        self.assertEqual(result["changes"][-1]["data"]["title"], 'Renamed again')
+
+    def test_reactions_are_logged(self):
+        comment = Comment.objects.create(board=self.board, card=Card.objects.get(), author=self.board.author, comment='Hi')
+        Reaction.objects.create(comment=comment, author=self.board.author, reaction=Reaction.Reactions.LIKE)
+
+        entities = [c["entity"] for c in get_changes(self.board.id, self.seq)["changes"]]
+        self.assertEqual(entities, ['comment', 'reaction'])
+
+    def test_snapshot_when_compacted(self):
+        for i in range(3):
+            List.objects.create(board=self.board, title='More %s' % i, location=(i + 2) * 65536)
+        BoardChange.objects.update(date_created=timezone.now() - timedelta(days=60))
+
+        self.assertGreater(compact_changes(keep=1), 0)
+        result = get_changes(self.board.id, self.seq)
+        self.assertTrue(result["reset"])
+        self.assertEqual(len(result["snapshot"]["lists"]), 4)
+        self.assertEqual(len(get_changes(self.board.id, result["seq"] - 1)["changes"]), 1)
+
+    def test_snapshot_after_bulk_change(self):
+        apply_operations(self.board, [{"op": "archive", "card": Card.objects.get().id}])
+        self.assertTrue(get_changes(self.board.id, self.seq)["reset"])
+
+    def test_board_delete(self):
+        self.board.delete()
+        self.assertFalse(BoardChange.objects.exists())
+
+    def test_failed_board_delete_isnt_remembered(self):
+        def fail(**kwargs):
+            raise RuntimeError("Nope")
+        post_delete.connect(fail, sender=Task, dispatch_uid='fail')
+        self.addCleanup(post_delete.disconnect, sender=Task, dispatch_uid='fail')
+
+        for delete in (self.board.delete, Board.objects.filter(id=self.board.id).delete):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                delete()
+            self.assertFalse(deleting_boards())
+
+        # Deleting the author takes the board along through the signals, the next request forgets it
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            self.board.author.delete()
+        request_started.send(sender=None)
+        self.assertFalse(deleting_boards())
+
+        # The board's changes are still being logged
+        card = Card.objects.get()
+        card.save()
+        self.assertEqual(BoardChange.objects.filter(board=self.board).last().object_id, card.id)
+
+    def test_view(self):
+        self.client.force_login(self.board.author)
+        url = reverse('board-changes', kwargs={"board_id": self.board.id})
+
+        self.assertEqual(self.client.get(url, {"since": self.seq}).json(), {"seq": self.seq, "changes": []})
+        self.assertEqual(self.client.get(url, {"since": 'x'}).status_code, 400)
+
+
+class SearchTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.board = make_board(cards=3)
+        self.user = self.board.author
+        self.cards = list(Card.objects.filter(board=self.board).order_by('location'))
+
+    def ids(self, query, **kwargs):
+        return [r["id"] for r in search(self.user, query, **kwargs)]
+
+    def test_sources_and_ranking(self):
+        first, second, third = self.cards
+        first.title = 'Deploy pipeline'
+        first.save()
+        Comment.objects.create(board=self.board, card=second, author=self.user, comment='The pipeline is broken again')
+        Task.objects.create(board=self.board, card=third, name='Fix flaky deploy')
+
+        self.assertEqual(self.ids('pipeline'), [first.id, second.id])
+        self.assertEqual(self.ids('deploy', board_id=self.board.id), [first.id, third.id])
+        self.assertEqual(self.ids('deploy pipeline'), [first.id])
+        self.assertEqual(self.ids('bug'), sorted(c.id for c in self.cards))
+        self.assertEqual(self.ids('nothing'), [])
+
+    def test_moves_dont_reindex(self):
+        with CaptureQueriesContext(connection) as ctx:
+            move_card(self.cards[0], after=self.cards[2])
+        self.assertFalse([q for q in ctx.captured_queries if 'board_searchentry' in q['sql']])
+
+        self.cards[0].title = 'Renamed'
+        self.cards[0].save(update_fields=['title'])
+        self.assertEqual(self.ids('renamed'), [self.cards[0].id])
+
+    def test_updates_and_deletes(self):
+        card = self.cards[0]
+        comment = Comment.objects.create(board=self.board, card=card, author=self.user, comment='quarterly report')
+        self.assertEqual(self.ids('quarterly'), [card.id])
+
+        comment.comment = 'annual report'
+        comment.save()
+        self.assertEqual(self.ids('quarterly'), [])
+
+        comment.delete()
+        self.assertEqual(self.ids('annual'), [])
+
+        tag = Tag.objects.get(board=self.board)
+        tag.name = 'defect'
+        tag.save()
+        self.assertEqual(self.ids('bug'), [])
+        self.assertEqual(len(self.ids('defect')), 3)
+
+        CardTag.objects.filter(card=card).delete()
+        self.assertEqual(len(self.ids('defect')), 2)
+
+    def test_permissions(self):
+        other = make_board('Secret Board')
+        secret = Card.objects.get(board=other)
+        secret.title = 'classified'
+        secret.save()
+
+        self.assertEqual(self.ids('classified'), [])
+        self.assertEqual(self.ids('classified', board_id=other.id), [secret.id])
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('board-search', kwargs={"board_id": other.id}), {"q": 'classified'})
+        self.assertNotContains(response, 'classified')
+        self.assertEqual(self.client.get(reverse('search'), {"q": 'classified'}).json(), {"results": []})
+
+    def test_bulk_and_rebuild(self):
+        apply_operations(self.board, [{"op": "add_task", "card": self.cards[0].id, "name": 'migrate database'}])
+        self.assertEqual(self.ids('migrate'), [self.cards[0].id])
+
+        SearchEntry.objects.all().delete()
+        reindex_cards(c.id for c in self.cards)
+        self.assertEqual(self.ids('migrate'), [self.cards[0].id])
+
+
+class CounterTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.board = make_board()
+        self.card = Card.objects.get()
+
+    def counts(self):
+        self.card.refresh_from_db()
+        return (self.card.task_done_count, self.card.task_count, self.card.comment_count, self.card.attachment_count)
+
+    def test_card_counters_follow_children(self):
+        self.assertEqual(self.counts(), (1, 2, 0, 1))
+
+        task = Task.objects.get(done=False)
+        task.done = True
+        task.save()
+        task.save()
+        self.assertEqual(self.counts(), (2, 2, 0, 1))
+
+        Comment.objects.create(board=self.board, card=self.card, author=self.board.author, comment='Hello')
+        Attachment.objects.get().delete()
+        task.delete()
+        self.assertEqual(self.counts(), (1, 1, 1, 0))
+
+    def test_stale_card_save_keeps_counters(self):
+        stale = Card.objects.get()
+        Task.objects.create(board=self.board, card=self.card, name='three')
+
+        stale.title = 'Renamed'
+        with CaptureQueriesContext(connection) as queries:
+            stale.save()
+        self.assertEqual(self.counts(), (1, 3, 0, 1))
+        self.assertEqual(self.card.title, 'Renamed')
+        self.assertNotIn('task_count', queries[0]['sql'])
+
+    def test_save_without_update_fields_is_still_a_save(self):
+        # The row went meanwhile, a plain save() puts it back rather than failing
+        card = Card.objects.get()
+        Card.objects.filter(id=card.id)._raw_delete(connection.alias)
+        card.save()
+        self.assertEqual(Card.objects.get(id=card.id).title, card.title)
+
+        # update_fields given are kept, counters included
+        card.task_count = 7
+        card.save(update_fields=['task_count'])
+        self.assertEqual(Card.objects.get(id=card.id).task_count, 7)
+
+    def test_reaction_counters(self):
+        comment = Comment.objects.create(board=self.board, card=self.card, author=self.board.author, comment='Hello')
+        like = Reaction.objects.create(comment=comment, author=self.board.author, reaction=Reaction.Reactions.LIKE)
+        Reaction.objects.create(comment=comment, author=self.board.author, reaction=Reaction.Reactions.CROSS)
+
+        comment.refresh_from_db()
+        self.assertEqual((comment.like_count, comment.cross_count), (1, 1))
+        self.assertEqual(comment.get_reactions().count(), 2)
+
+        like.reaction = Reaction.Reactions.DISLIKE
+        like.save()
+        comment.refresh_from_db()
+        self.assertEqual((comment.like_count, comment.dislike_count), (0, 1))
+
+    def test_bulk_and_recount(self):
+        apply_operations(self.board, [{"op": "add_task", "card": self.card.id, "name": 'three'}])
+        self.assertEqual(self.counts(), (1, 3, 0, 1))
+
+        Card.objects.update(task_count=0, task_done_count=0, attachment_count=7)
+        recount_cards(Card.objects.all())
+        self.assertEqual(self.counts(), (1, 3, 0, 1))
+
+    def test_never_negative(self):
+        Card.objects.update(attachment_count=0)
+        Attachment.objects.get().delete()
+        self.assertEqual(self.counts()[3], 0)
+
+
+class AttachmentUploadTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=media, ATTACHMENT_UPLOAD_DIR=os.path.join(media, 'uploads'))
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.board = make_board()
+        self.card = Card.objects.get()
+        self.client.force_login(self.board.author)
+
+    def start(self, content, **extra):
+        response = self.client.post(reverse('board-uploads', kwargs={"board_id": self.board.id}),
+            json.dumps({"card": self.card.id, "name": 'spec.pdf', "size": len(content), **extra}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        return response.json()["id"]
+
+    def put(self, upload_id, content, start):
+        return self.client.put(reverse('board-upload', kwargs={"board_id": self.board.id, "upload_id": upload_id}),
+            content, content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE='bytes %s-%s/*' % (start, start + len(content) - 1))
+
+    def complete(self, upload_id):
+        return self.client.post(reverse('board-upload-complete', kwargs={"board_id": self.board.id, "upload_id": upload_id}))
+
+    def upload(self, content):
+        upload_id = self.start(content, sha256=hashlib.sha256(content).hexdigest())
+        self.assertEqual(self.put(upload_id, content, 0).status_code, 200)
+        return self.complete(upload_id).json()
+
+    def test_chunked_upload_and_resume(self):
+        content = os.urandom(1000)
+        upload_id = self.start(content)
+
+        self.assertEqual(self.put(upload_id, content[:400], 0).json()["offset"], 400)
+
+        # Out of order chunk is refused with where to carry on from
+        response = self.put(upload_id, content[600:], 600)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["offset"], 400)
+
+        self.assertEqual(self.client.get(reverse('board-upload', kwargs={"board_id": self.board.id, "upload_id": upload_id})).json()["offset"], 400)
+        self.assertEqual(self.complete(upload_id).status_code, 409)
+
+        self.put(upload_id, content[400:], 400)
+        data = self.complete(upload_id).json()
+
+        attachment = Attachment.objects.get(id=data["attachment"])
+        self.assertEqual(data["sha256"], hashlib.sha256(content).hexdigest())
+        self.assertEqual((attachment.name, attachment.size), ('spec.pdf', 1000))
+        with default_storage.open(attachment.file.name) as f:
+            self.assertEqual(f.read(), content)
+        self.assertFalse(Upload.objects.exists())
+
+    def test_hash_mismatch_discards_upload(self):
+        upload_id = self.start(b'hello world', sha256='0' * 64)
+        self.put(upload_id, b'hello world', 0)
+
+        self.assertEqual(self.complete(upload_id).status_code, 422)
+        self.assertFalse(Upload.objects.exists())
+        self.assertFalse(os.listdir(os.path.join(default_storage.location, 'uploads')))
+
+    def test_same_content_stored_once(self):
+        content = b'the same spec' * 100
+        first, second = self.upload(content), self.upload(content)
+
+        self.assertEqual((first["deduplicated"], second["deduplicated"]), (False, True))
+        a, b = Attachment.objects.filter(id__in=[first["attachment"], second["attachment"]])
+        self.assertEqual(a.file.name, b.file.name)
+
+        # The file stays until the last attachment using it goes
+        with self.captureOnCommitCallbacks(execute=True):
+            a.delete()
+        self.assertTrue(default_storage.exists(b.file.name))
+        with self.captureOnCommitCallbacks(execute=True):
+            b.delete()
+        self.assertFalse(default_storage.exists(b.file.name))
+
+    def test_total_must_match_upload_size(self):
+        upload_id = self.start(b'hello world')
+        response = self.client.put(reverse('board-upload', kwargs={"board_id": self.board.id, "upload_id": upload_id}),
+            b'hello', content_type='application/octet-stream', HTTP_CONTENT_RANGE='bytes 0-4/5')
+
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.json()["offset"], 0)
+
+    def test_removal_and_deduplication_share_a_lock(self):
+        content = b'the same spec' * 100
+        sha256 = hashlib.sha256(content).hexdigest()
+
+        with CaptureQueriesContext(connection) as queries:
+            attachment = Attachment.objects.get(id=self.upload(content)["attachment"])
+        self.assertTrue(any('board_blob' in query['sql'] for query in queries))
+        self.assertTrue(Blob.objects.filter(sha256=sha256).exists())
+
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                attachment.delete()
+        self.assertTrue(any('board_blob' in query['sql'] and 'SELECT' in query['sql'] for query in queries))
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(default_storage.exists(attachment.file.name))
+
+        # Stored again from scratch, not deduplicated onto the removed file
+        data = self.upload(content)
+        self.assertFalse(data["deduplicated"])
+        self.assertTrue(default_storage.exists(Attachment.objects.get(id=data["attachment"]).file.name))
+
+    def test_stored_before_the_lock_and_again_if_removed_meanwhile(self):
+        content = b'the same spec' * 100
+        name = blob_name(hashlib.sha256(content).hexdigest())
+        stored = []
+
+        def remove_first(execute, sql, params, many, context):
+            # As if release_file had removed the file just before this upload locked the Blob row
+            if 'board_blob' in sql and not stored:
+                stored.append(default_storage.exists(name))
+                default_storage.delete(name)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(remove_first):
+            data = self.upload(content)
+
+        self.assertEqual(stored, [True])
+        self.assertFalse(data["deduplicated"])
+        with default_storage.open(Attachment.objects.get(id=data["attachment"]).file.name) as f:
+            self.assertEqual(f.read(), content)
+        self.assertFalse(os.listdir(os.path.join(default_storage.location, 'uploads')))
+
+    def test_range_download(self):
+        content = bytes(range(256)) * 4
+        attachment = Attachment.objects.get(id=self.upload(content)["attachment"])
+        url = reverse('attachment', kwargs={"board_id": self.board.id, "attachment_id": attachment.id})
+
+        response = self.client.get(url)
+        self.assertEqual(b''.join(response.streaming_content), content)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+        response = self.client.get(url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 100-199/1024')
+        self.assertEqual(b''.join(response.streaming_content), content[100:200])
+
+        response = self.client.get(url, HTTP_RANGE='bytes=-24')
+        self.assertEqual(b''.join(response.streaming_content), content[-24:])
+
+        # A stale If-Range gets the whole file
+        response = self.client.get(url, HTTP_RANGE='bytes=100-199', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=5000-').status_code, 416)
+
+
+class ThumbnailTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=media)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.board = make_board()
+        self.card = Card.objects.get()
+        self.client.force_login(self.board.author)
+
+    def image(self, name, size=(800, 600)):
+        data = BytesIO()
+        Image.new('RGB', size, (200, 30, 30)).save(data, 'PNG')
+        return default_storage.save(name, ContentFile(data.getvalue()))
+
+    def attach(self, name):
+        with self.captureOnCommitCallbacks():
+            return Attachment.objects.create(board=self.board, card=self.card, author=self.board.author, file=name)
+
+    def test_background_generation(self):
+        name = self.image('photo.png')
+        self.attach(name)
+        self.assertEqual(run_pending(), 1)
+
+        digest = thumbnails.source_digest(name)
+        for size, side in thumbnails.SIZES.items():
+            with Image.open(default_storage.open(thumbnails.derivative_name(digest, size, 'webp'))) as image:
+                self.assertEqual(image.format, 'WEBP')
+                self.assertLessEqual(max(image.size), side)
+            self.assertTrue(default_storage.exists(thumbnails.derivative_name(digest, size, 'jpeg')))
+
+    def test_same_content_shares_derivatives(self):
+        first = self.image('one.png')
+        second = default_storage.save('two.png', default_storage.open(first))
+
+        self.assertEqual(thumbnails.get_derivative(first, 'small', 'webp'), thumbnails.get_derivative(second, 'small', 'webp'))
+
+    def test_lazy_generation_and_revalidation(self):
+        attachment = self.attach(self.image('board/photo.png'))
+        url = reverse('attachment-thumbnail', kwargs={"board_id": self.board.id, "attachment_id": attachment.id,
+            "size": 'medium', "fmt": 'webp'})
+
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        with Image.open(BytesIO(b''.join(response.streaming_content))) as image:
+            self.assertEqual(image.size, (256, 192))
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_not_an_image(self):
+        attachment = Attachment.objects.get()
+        url = reverse('attachment-thumbnail', kwargs={"board_id": self.board.id, "attachment_id": attachment.id,
+            "size": 'small', "fmt": 'webp'})
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_avatar_helper_picks_smallest_adequate_size(self):
+        user = self.board.author
+        user.profile.avatar = self.image('avatars/me.png')
+        with self.captureOnCommitCallbacks():
+            user.profile.save()
+
+        html = Template('{% load thumbnails %}{% avatar user_id 48 %}').render(Context({"user_id": user.id}))
+        small = reverse('avatar', kwargs={"user_id": user.id, "size": 'small', "fmt": 'webp'})
+        self.assertIn('%s 1x' % small, html)
+
+        response = self.client.get(small)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(load_board(self.board.id)["members"][0]["avatar"], 'avatars/me.png')
+
+    def test_avatar_keeps_shared_derivatives(self):
+        profile = self.board.author.profile
+        profile.avatar = self.image('avatars/me.png')
+        with self.captureOnCommitCallbacks():
+            profile.save()
+        digest = thumbnails.source_digest(profile.avatar.name)
+        self.assertEqual(Profile.objects.get(id=profile.id).avatar_sha256, digest)
+        derivative = thumbnails.get_derivative(profile.avatar.name, 'small', 'webp')
+
+        # An attachment of the same picture goes, the avatar still shows its thumbnails
+        name = default_storage.save(blob_name(digest), default_storage.open(profile.avatar.name))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.attach(name).delete()
+        self.assertFalse(default_storage.exists(name))
+        self.assertTrue(default_storage.exists(derivative))
+
+        # Once the avatar changes the last user of them is gone
+        profile.avatar = None
+        profile.save()
+        self.assertEqual(Profile.objects.get(id=profile.id).avatar_sha256, '')
+        default_storage.save(name, ContentFile(b''))
+        release_file(name)
+        self.assertFalse(default_storage.exists(derivative))
+
+
+class JobTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        CALLS.clear()
+
+    def test_enqueue_is_part_of_the_transaction(self):
+        try:
+            with transaction.atomic():
+                record_call.delay(1)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(Job.objects.exists())
+
+        record_call.delay(2)
+        enqueue('board.tests.record_call', 3)
+        self.assertEqual(run_pending(), 2)
+        self.assertEqual(CALLS, [2, 3])
+        self.assertFalse(Job.objects.exists())
+
+    def test_delay(self):
+        enqueue(record_call, 1, delay=60)
+        self.assertEqual(run_pending(), 0)
+
+    def test_retry_with_backoff_then_fail(self):
+        always_fails.delay()
+        run_pending()
+
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (Job.Status.PENDING, 1))
+        self.assertGreater(job.run_at, timezone.now())
+        self.assertIn('ValueError: Nope', job.last_error)
+
+        Job.objects.update(run_at=timezone.now())
+        run_pending()
+        self.assertEqual(Job.objects.get().status, Job.Status.FAILED)
+        Job.objects.update(run_at=timezone.now())
+        self.assertEqual(run_pending(), 0)
+
+    def test_concurrency_limit(self):
+        record_call.delay(1)
+        record_call.delay(2)
+        always_fails.delay()
+
+        # record_call only runs one at a time so the second waits, always_fails doesn't
+        claimed = claim('worker-1', 3)
+        self.assertEqual([j.name for j in claimed], ['board.tests.record_call', 'board.tests.always_fails'])
+        self.assertEqual(claim('worker-2', 3), [])
+
+    def test_dead_worker_jobs_are_reclaimed(self):
+        record_call.delay(1)
+        claim('worker-1', 1)
+        self.assertEqual(claim('worker-2', 1), [])
+
+        Job.objects.update(locked_at=timezone.now() - timedelta(seconds=TIMEOUT + 1))
+        self.assertEqual(run_pending(worker='worker-2'), 1)
+        self.assertEqual(CALLS, [1])
+
+    def test_running_jobs_are_counted_under_the_type_lock(self):
+        record_call.delay(1)
+        always_fails.delay()
+        with CaptureQueriesContext(connection) as queries:
+            claim('worker-1', 2)
+        sql = [q['sql'] for q in queries.captured_queries]
+
+        # Only the limited type has a lock row, and it's taken before counting what's running
+        self.assertEqual(list(JobType.objects.values_list('name', flat=True)), ['board.tests.record_call'])
+        locked = next(i for i, q in enumerate(sql) if 'board_jobtype' in q)
+        counted = next(i for i, q in enumerate(sql) if 'COUNT(' in q)
+        self.assertLess(locked, counted)
+        if not connection.features.has_select_for_update_skip_locked:
+            self.assertTrue(any(q.startswith('UPDATE "board_job"') and 'COUNT(' in q for q in sql))
+
+    def test_dead_worker_on_its_last_attempt_is_failed(self):
+        always_fails.delay()
+        Job.objects.update(status=Job.Status.RUNNING, attempts=2, locked_by='worker-1',
+            locked_at=timezone.now() - timedelta(seconds=TIMEOUT + 1))
+        self.assertEqual(claim('worker-2', 1), [])
+
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts, job.locked_by), (Job.Status.FAILED, 2, ''))
+        self.assertIn('last attempt', job.last_error)
+
+
+class DashboardTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.mine = make_board('Mine', lists=2, cards=2)
+            self.user = self.mine.author
+            self.theirs = make_board('Theirs', lists=1, cards=3)
+            BoardMember.objects.create(board=self.theirs, member=self.user, access=BoardMember.Access.READ)
+            make_board('Someone Elses')
+
+    def test_content(self):
+        boards = {b["title"]: b for b in load_dashboard(self.user)}
+
+        self.assertEqual(set(boards), {'Mine', 'Theirs'})
+        self.assertEqual((boards['Mine']["card_count"], boards['Mine']["open_task_count"]), (4, 4))
+        self.assertEqual((boards['Theirs']["card_count"], boards['Theirs']["access"]), (3, BoardMember.Access.READ))
+
+    def test_warm_dashboard_needs_no_queries(self):
+        load_dashboard(self.user)
+        with self.assertNumQueries(0):
+            load_dashboard(self.user)
+
+    def test_card_change_only_reloads_that_board(self):
+        load_dashboard(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            Task.objects.filter(board=self.theirs, done=False).update(done=True)
+            recount_cards(Card.objects.filter(board=self.theirs))
+            record_change(self.theirs.id, 'board', 'changed', self.theirs.id)
+            bump_board_version(self.theirs.id)
+
+        with self.assertNumQueries(1):
+            boards = load_dashboard(self.user)
+        self.assertEqual([(b["title"], b["open_task_count"]) for b in boards], [('Theirs', 0), ('Mine', 4)])
+
+    def test_membership_change(self):
+        load_dashboard(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            BoardMember.objects.get(board=self.theirs, member=self.user).delete()
+        self.assertEqual([b["title"] for b in load_dashboard(self.user)], ['Mine'])
+
+    def test_view(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('dashboard'))
+        self.assertContains(response, reverse('board-main', kwargs={"board_id": self.theirs.id}))
+        self.assertContains(response, '3 cards')
+
+
+class InstrumentationTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.board = make_board(lists=2, cards=3)
+        self.client.force_login(self.board.author)
+
+    def test_server_timing_and_log_line(self):
+        with self.assertLogs('board.performance', 'INFO') as logs:
+            response = self.client.get(reverse('board-main', kwargs={"board_id": self.board.id}))
+
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="\d+ queries", tpl;dur=[\d.]+, total;dur=[\d.]+$')
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((line["view"], line["status"], line["budget"]), ('board-main', 200, 10))
+        self.assertGreater(line["template_ms"], 0)
+        self.assertEqual(line["queries"], int(re.search(r'"(\d+) queries"', response['Server-Timing'])[1]))
+
+    def test_duplicate_fingerprints(self):
+        with record_queries() as metrics:
+            for card in Card.objects.all():
+                Task.objects.filter(card=card).count()
+
+        self.assertEqual(metrics.queries, 7)
+        self.assertEqual(list(metrics.duplicates().values()), [6])
+        self.assertEqual(fingerprint("SELECT * FROM t WHERE id IN (%s, %s, %s) AND name = 'x' LIMIT 21"),
+            "SELECT * FROM t WHERE id IN (...) AND name = ? LIMIT ?")
+
+    def test_budget(self):
+        @query_budget(1)
+        def view(request):
+            list(Card.objects.all())
+            list(Task.objects.all())
+            return HttpResponse()
+
+        request = RequestFactory().get('/')
+        middleware = QueryInstrumentationMiddleware(lambda r: middleware.process_view(r, view, (), {}) or view(r))
+
+        with self.assertRaises(QueryBudgetExceeded):
+            middleware(request)
+
+        with override_settings(QUERY_BUDGET_RAISE=False), self.assertLogs('board.performance', 'WARNING'):
+            self.assertEqual(middleware(request).status_code, 200)
+
+
+class WorkloadTests(BoardTestCase):
+
+    def test_generate(self):
+        existing = make_board()
+        workload = generate_workload(users=6, boards=3, lists=2, cards=4, tags=3, tasks=2, comments=2, reactions=2,
+            members=3, seed=1)
+
+        self.assertEqual(len(workload["boards"]), 3)
+        self.assertEqual(Card.objects.filter(board__in=workload["boards"]).count(), 3 * 2 * 4)
+        self.assertEqual(BoardMember.objects.filter(board__in=workload["boards"]).count(), 3 * 3)
+        self.assertEqual(Reaction.objects.count(), 3 * 2 * 4 * 2 * 2)
+        self.assertTrue(User.objects.get(id=workload["users"][0]).check_password('password'))
+
+        # Counters are filled in as if everything came in through the site
+        cards = Card.objects.filter(board__in=workload["boards"])
+        counted = list(cards.values_list('task_count', 'task_done_count', 'comment_count'))
+        comments = list(Comment.objects.values_list('like_count', 'dislike_count', 'checkmark_count', 'cross_count'))
+        recount_cards(cards)
+        recount_comments(Comment.objects.all())
+        self.assertEqual(list(cards.values_list('task_count', 'task_done_count', 'comment_count')), counted)
+        self.assertEqual(list(Comment.objects.values_list('like_count', 'dislike_count', 'checkmark_count', 'cross_count')), comments)
+
+        card = cards.first()
+        self.assertIn(card.id, [r["id"] for r in search(card.author, card.title, board_id=card.board_id)])
+        self.assertEqual(Board.objects.get(id=existing.id).title, existing.title)
+
+    def test_benchmark(self):
+        results = run_benchmark(['small'], requests=2, warmup=0, login_requests=1)
+
+        self.assertEqual({r["endpoint"] for r in results["results"]},
+            {'board_view', 'board_view_cold', 'board_api', 'dashboard', 'dashboard_cold', 'board_search', 'login'})
+        # The session is read from the database as well with the cache emptied, it's written through with locmem
+        self.assertEqual(next(r for r in results["results"] if r["endpoint"] == 'board_view_cold')["queries"], 8)
+        self.assertFalse(User.objects.filter(username__startswith='benchmark-').exists())
+
+        slower = {**results, "results": [{**r, "p50_ms": r["p50_ms"] * 2} for r in results["results"]]}
+        self.assertTrue(compare(results, slower)[1])
+        self.assertFalse(compare(slower, results)[1])
+
+
+class PaginationTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.board = make_board(cards=7)
+        self.card = Card.objects.filter(board=self.board).first()
+        for n in range(7):
+            Comment.objects.create(board=self.board, card=self.card, author=self.board.author, comment='c%s' % n)
+        # Ties on the first key have to be broken by id, not skipped or repeated
+        Comment.objects.filter(comment__in=['c2', 'c3', 'c4']).update(date_created=timezone.now())
+        self.client.force_login(self.board.author)
+
+    def pages(self, paginator):
+        pages, cursor = [], None
+        while True:
+            page = paginator.page(cursor)
+            pages.append([c.comment for c in page])
+            if page.next is None:
+                return pages
+            cursor = page.next
+
+    def test_pages(self):
+        comments = Comment.objects.filter(card=self.card)
+        expected = list(comments.order_by('date_created', 'id').values_list('comment', flat=True))
+
+        pages = self.pages(CursorPaginator(comments, ('date_created', 'id'), 3))
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual(sum(pages, []), expected)
+
+        pages = self.pages(CursorPaginator(comments, ('-date_created', '-id'), 2))
+        self.assertEqual(sum(pages, []), expected[::-1])
+
+        # An exact multiple of the page size doesn't end on an empty page
+        self.assertEqual(len(self.pages(CursorPaginator(comments, ('date_created', 'id'), 7))), 1)
+
+    def test_invalid_cursor(self):
+        paginator = CursorPaginator(Comment.objects.all(), ('date_created', 'id'))
+        for cursor in ('nonsense!', 'e30', 'WzFd', 'WyJub3QgYSBkYXRlIiwgMV0'):
+            with self.assertRaises(InvalidCursor):
+                paginator.page(cursor)
+
+        url = reverse('card-comments', kwargs={"board_id": self.board.id, "card_id": self.card.id})
+        self.assertEqual(self.client.get(url, {"cursor": 'nonsense!'}).status_code, 400)
+
+    def test_comments_view(self):
+        url = reverse('card-comments', kwargs={"board_id": self.board.id, "card_id": self.card.id})
+        seen, cursor = [], ''
+        while cursor is not None:
+            with CaptureQueriesContext(connection) as queries:
+                data = self.client.get(url, {"cursor": cursor, "limit": 2}).json()
+            # The same handful of queries however deep the page
+            self.assertLessEqual(len(queries), 4)
+            seen += [c["comment"] for c in data["results"]]
+            cursor = data["next"]
+        self.assertEqual(sorted(seen), ['c%s' % n for n in range(7)])
+
+    def test_list_cards_view(self):
+        lst = self.card.list
+        Card.objects.filter(list=lst, title='Card 3').update(archived=True)
+        url = reverse('list-cards', kwargs={"board_id": self.board.id, "list_id": lst.id})
+
+        first = self.client.get(url, {"limit": 4}).json()
+        second = self.client.get(url, {"limit": 4, "cursor": first["next"]}).json()
+        self.assertEqual([c["title"] for c in first["results"] + second["results"]],
+            ['Card 0', 'Card 1', 'Card 2', 'Card 4', 'Card 5', 'Card 6'])
+        self.assertIsNone(second["next"])
+
+        # Another boards list isn't reachable through this board
+        other = make_board(title='Other')
+        url = reverse('list-cards', kwargs={"board_id": self.board.id, "list_id": other.list_set.first().id})
+        self.assertEqual(self.client.get(url).json()["results"], [])
+
+
+class QueryPlanTests(BoardTestCase):
+
+    def test_board_pages_use_indexes(self):
+        results = check_queries('small')
+        pages = {r["page"] for r in results}
+        self.assertTrue({'board_view', 'dashboard', 'card_comments', 'list_cards', 'board_bulk'} <= pages)
+
+        # The loaders card query and both kinds of paged query come straight off an index, in order
+        cards = [r for r in results if r["page"] in ('board_view', 'list_cards', 'card_comments')
+            and re.search(r'FROM "board_(card|comment)"', r["sql"])]
+        self.assertEqual(len(cards), 5)
+        for r in cards:
+            self.assertEqual(r["problems"], [], r["sql"])
+
+        self.assertFalse(User.objects.filter(username__startswith='explain-').exists())
+
+
+class PurgeTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=media)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.board = make_board(lists=2, cards=3)
+        self.other = make_board(title='Other')
+        self.member = User.objects.create_user(username='member', password='password')
+        BoardMember.objects.create(board=self.board, member=self.member, access=BoardMember.Access.WRITE)
+        for card in Card.objects.filter(board=self.board):
+            comment = Comment.objects.create(board=self.board, card=card, author=self.member, comment='hi')
+            Reaction.objects.create(comment=comment, author=self.member, reaction=Reaction.Reactions.LIKE)
+
+    def test_archive_hides_board(self):
+        self.client.force_login(self.member)
+        url = reverse('board-main', kwargs={"board_id": self.board.id})
+        self.assertEqual(self.client.get(url).context["title"], self.board.title)
+        self.assertIn(self.board.id, [b["id"] for b in load_dashboard(self.member)])
+
+        # Owners only
+        archive = reverse('board-archive', kwargs={"board_id": self.board.id})
+        self.client.post(archive)
+        self.assertFalse(Board.objects.get(id=self.board.id).archived)
+
+        self.client.force_login(self.board.author)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post(archive).status_code, 202)
+        self.assertTrue(Board.objects.get(id=self.board.id).archived)
+        self.assertTrue(Job.objects.filter(name='board.purge.purge_board', args=[self.board.id]).exists())
+
+        self.client.force_login(self.member)
+        self.assertEqual(self.client.get(url).context["title"], 'Error')
+        self.assertEqual(load_dashboard(self.member), [])
+        self.assertFalse(archive_board(self.board.id))
+
+    def test_purge_in_chunks(self):
+        kept = default_storage.save('kept.txt', ContentFile(b'shared'))
+        gone = default_storage.save('gone.txt', ContentFile(b'only here'))
+        card = Card.objects.filter(board=self.board).first()
+        Attachment.objects.create(board=self.board, card=card, author=self.member, file=kept)
+        Attachment.objects.create(board=self.board, card=card, author=self.member, file=gone)
+        other_card = Card.objects.get(board=self.other)
+        Attachment.objects.create(board=self.other, card=other_card, author=self.other.author, file=kept)
+        before = {model: model.objects.exclude(id__in=[]).count() for model in (Card, Comment, Reaction, Task)}
+
+        with self.captureOnCommitCallbacks(execute=True):
+            archive_board(self.board.id)
+
+        # A few chunks at a time, each a select and a delete (and its savepoint here) however big the board
+        with CaptureQueriesContext(connection) as queries:
+            self.assertFalse(purge(self.board.id, chunk_size=2, max_chunks=3))
+        self.assertLessEqual(len(queries), 3 * 4 + 1)
+        self.assertEqual(Reaction.objects.filter(comment__board=self.board).count(), 0)
+        self.assertTrue(Comment.objects.filter(board=self.board).exists())
+
+        # The job carries on where that left off, queueing itself again until the board is gone
+        with override_settings(BOARD_PURGE_CHUNK_SIZE=2, BOARD_PURGE_MAX_CHUNKS=2):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(run_pending(limit=1), 1)
+            self.assertTrue(Board.objects.filter(id=self.board.id).exists())
+            self.assertTrue(Job.objects.filter(name='board.purge.purge_board', args=[self.board.id],
+                status=Job.Status.PENDING).exists())
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertGreater(run_pending(), 1)
+        self.assertFalse(Board.objects.filter(id=self.board.id).exists())
+        self.assertFalse(Job.objects.exists())
+
+        for model in (List, Card, Comment, Task, Tag, CardTag, Attachment, BoardMember, BoardChange, SearchEntry):
+            self.assertFalse(model.objects.filter(board=self.board.id).exists(), model)
+        self.assertEqual(Card.objects.count(), before[Card] - 6)
+        self.assertEqual(Task.objects.count(), before[Task] - 12)
+        self.assertTrue(Board.objects.filter(id=self.other.id).exists())
+
+        self.assertTrue(default_storage.exists(kept))
+        self.assertFalse(default_storage.exists(gone))
+
+
+class ExportTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.board = make_board(lists=2, cards=3)
+        self.member = User.objects.create_user(username='member', password='password')
+        BoardMember.objects.create(board=self.board, member=self.member, access=BoardMember.Access.WRITE)
+        for card in Card.objects.filter(board=self.board):
+            comment = Comment.objects.create(board=self.board, card=card, author=self.member, comment='drill results')
+            Reaction.objects.create(comment=comment, author=self.board.author, reaction=Reaction.Reactions.LIKE)
+
+    def test_round_trip(self):
+        self.client.force_login(self.board.author)
+        response = self.client.get(reverse('board-export', kwargs={"board_id": self.board.id}))
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(json.loads(lines[0])["type"], 'board')
+
+        # Small chunks and batches give the same result as big ones
+        self.assertEqual(list(export_board(self.board.id, chunk_size=2)), [line + '\n' for line in lines])
+
+        importer = User.objects.create_user(username='importer', password='password')
+        with self.captureOnCommitCallbacks(execute=True):
+            board, counts = import_board(lines, importer, batch_size=2)
+
+        self.assertEqual(board.title, self.board.title)
+        self.assertEqual(counts["card"], 6)
+        self.assertEqual(board_contents(board), board_contents(self.board))
+
+        # The original owner is still known here so stays on as an admin, next to the importer
+        self.assertEqual(dict(BoardMember.objects.filter(board=board).values_list('member__username', 'access')), {
+            'importer': BoardMember.Access.OWNER,
+            self.board.author.username: BoardMember.Access.ADMIN,
+            'member': BoardMember.Access.WRITE,
+        })
+        self.assertTrue(search(importer, 'drill', board_id=board.id))
+        self.assertIn(board.id, [b["id"] for b in load_dashboard(self.member)])
+
+        # Importing again alongside it gets a new title
+        self.assertNotEqual(import_board(lines, importer)[0].title, board.title)
+
+    def test_unknown_people_become_owner(self):
+        lines = list(export_board(self.board.id))
+        User.objects.filter(username='member').delete()
+        importer = User.objects.create_user(username='importer', password='password')
+        board, _ = import_board(lines, importer)
+        self.assertEqual(set(Comment.objects.filter(board=board).values_list('author__username', flat=True)),
+            {'importer'})
+
+    def test_bad_imports(self):
+        importer = User.objects.create_user(username='importer', password='password')
+        lines = list(export_board(self.board.id))
+        boards = Board.objects.count()
+
+        for bad in ([], ['nonsense'], lines[1:], lines + ['{"type": "card", "list": 12345}'],
+                lines + ['{"type": "spaceship"}']):
+            with self.assertRaises(BoardImportError):
+                import_board(bad, importer)
+        self.assertEqual(Board.objects.count(), boards)
+
+    def test_errors_say_which_line(self):
+        importer = User.objects.create_user(username='importer', password='password')
+        lines = [line for line in export_board(self.board.id) if json.loads(line)["type"] != 'cardtag']
+        number = next(i for i, line in enumerate(lines, 1) if json.loads(line)["type"] == 'card')
+
+        # Blank lines still count, and the bad card is only built once its batch is full
+        bad = lines[:number - 1] + ['\n'] + [lines[number - 1].replace('"list": ', '"list": 1234')] + lines[number:]
+        with self.assertRaisesMessage(BoardImportError, "Line %s: list" % (number + 1)):
+            import_board(bad, importer, batch_size=4)
+
+    def test_integrity_errors_are_import_errors(self):
+        importer = User.objects.create_user(username='importer', password='password')
+        lines = list(export_board(self.board.id))
+        tag = next(i for i, line in enumerate(lines) if json.loads(line)["type"] == 'tag')
+        boards = Board.objects.count()
+
+        with self.assertRaisesMessage(BoardImportError, "Lines %s to %s" % (tag + 1, tag + 2)):
+            import_board(lines[:tag + 1] + lines[tag:], importer)
+        self.assertEqual(Board.objects.count(), boards)
+
+    def test_export_needs_admin(self):
+        self.client.force_login(self.member)
+        response = self.client.get(reverse('board-export', kwargs={"board_id": self.board.id}))
+        self.assertFalse(response.streaming)
+
+
+@override_settings(QUERY_BUDGET_RAISE=True)
+class CloneTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.board = make_board(lists=2, cards=3)
+        self.member = User.objects.create_user(username='member', password='password')
+        BoardMember.objects.create(board=self.board, member=self.member, access=BoardMember.Access.READ)
+        for card in Card.objects.filter(board=self.board):
+            comment = Comment.objects.create(board=self.board, card=card, author=self.member, comment='drill results')
+            Reaction.objects.create(comment=comment, author=self.board.author, reaction=Reaction.Reactions.LIKE)
+        self.url = reverse('board-clone', kwargs={"board_id": self.board.id})
+
+    def test_clone(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            board, counts = clone_board(self.board.id, self.member, batch_size=2)
+
+        self.assertEqual(board.title, self.board.title)
+        self.assertEqual((counts["card"], counts["task"], counts.get("comment")), (6, 12, None))
+        self.assertEqual(BoardMember.objects.get(board=board, member=self.member).access, BoardMember.Access.OWNER)
+
+        # The same lists, cards, tags, tasks and attachments (the same files) but all new rows, no comments
+        copied = board_contents(board)
+        without_comments = [(title, [card[:6] + ([],) + card[7:] for card in cards])
+            for title, cards in board_contents(self.board)]
+        self.assertEqual(copied, without_comments)
+        self.assertFalse(Card.objects.filter(board=board, id__in=Card.objects.filter(board=self.board)).exists())
+        self.assertFalse(Card.objects.filter(board=board, comment_count__gt=0).exists())
+        self.assertEqual(set(CardTag.objects.filter(board=board).values_list('tag__board', flat=True)), {board.id})
+
+        # Its search index points at its own cards, and the original's is untouched
+        results = search(self.member, 'card', board_id=board.id)
+        self.assertEqual(len(results), 6)
+        self.assertEqual({result["board_id"] for result in results}, {board.id})
+        self.assertFalse(search(self.member, 'drill', board_id=board.id))
+        self.assertEqual(len(search(self.board.author, 'card', board_id=self.board.id)), 6)
+
+        # Copying again gets a new title each time
+        again = clone_board(self.board.id, self.member)[0]
+        self.assertEqual(again.title, '%s (copy)' % self.board.title)
+        self.assertEqual(clone_board(self.board.id, self.member)[0].title, '%s (copy 2)' % self.board.title)
+
+    def test_clone_with_comments(self):
+        board, counts = clone_board(self.board.id, self.board.author, 'With comments', comments=True)
+        self.assertEqual(board.title, 'With comments')
+        self.assertEqual((counts["comment"], counts["reaction"]), (6, 6))
+        self.assertEqual(board_contents(board), board_contents(self.board))
+        self.assertEqual(len(search(self.board.author, 'drill', board_id=board.id)), 6)
+
+    def test_only_the_cloner_is_a_member(self):
+        board = clone_board(self.board.id, self.member)[0]
+        self.assertEqual(list(BoardMember.objects.filter(board=board).values_list('member', 'access')),
+            [(self.member.id, BoardMember.Access.OWNER)])
+
+        # The original's members can't see the copy
+        self.assertEqual(get_access(self.board.author, board.id), NO_ACCESS)
+        self.assertNotIn(board.id, [b["id"] for b in load_dashboard(self.board.author)])
+
+    def test_templates(self):
+        self.client.force_login(self.member)
+
+        # Readers can't copy an ordinary board, or make it a template
+        self.assertEqual(self.client.post(self.url, '{}', content_type='application/json').status_code, 403)
+        template_url = reverse('board-template', kwargs={"board_id": self.board.id})
+        self.client.post(template_url, {"template": True}, content_type='application/json')
+        self.assertFalse(Board.objects.get(id=self.board.id).is_template)
+
+        self.client.force_login(self.board.author)
+        response = self.client.post(template_url, {"template": True}, content_type='application/json')
+        self.assertEqual(response.json(), {"template": True})
+        self.assertTrue(Board.objects.get(id=self.board.id).is_template)
+
+        # Now they can start their own board from it
+        self.client.force_login(self.member)
+        response = self.client.post(self.url, {"title": 'Drills'}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        board = Board.objects.get(id=response.json()["board"])
+        self.assertEqual((board.title, board.author, board.is_template), ('Drills', self.member, False))
+        self.assertEqual(response.json()["counts"]["card"], 6)
+        self.assertContains(self.client.get(response.json()["url"]), 'Card 2')
+        self.assertIn(board.id, [b["id"] for b in load_dashboard(self.member)])
+
+        self.assertEqual(self.client.get(self.url).status_code, 405)
+        self.assertEqual(self.client.post(self.url, '[', content_type='application/json').status_code, 400)
+
+
+# The caches the site runs with, SessionTests swap them for a file based one of their own
+SITE_CACHES = site_settings.CACHES
+
+class SessionTests(BoardTestCase):
+
+    def setUp(self):
+        # Sessions are only written behind with a cache every process shares, a file based one is here
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        settings = override_settings(SESSION_WRITE_BEHIND_INTERVAL=60,
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}})
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        super().setUp()
+        self.user = User.objects.create_user(username='someone', password='password')
+        self.addCleanup(discard_sessions)
+
+    def login(self):
+        return self.client.post(reverse('login'), {"username": 'someone', "password": 'password'})
+
+    def test_login_only_touches_user(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertRedirects(self.login(), '/dashboard/', fetch_redirect_response=False)
+
+        # Looking the user up and setting last_login, no profile and no session row (yet)
+        tables = [q["sql"] for q in ctx.captured_queries if 'SAVEPOINT' not in q["sql"]]
+        self.assertEqual(len(tables), 2)
+        self.assertFalse(any('board_profile' in sql or 'django_session' in sql for sql in tables))
+        self.assertEqual(self.client.get(reverse('dashboard')).status_code, 200)
+
+    def test_profile_saved_when_changed(self):
+        user = User.objects.select_related('profile').get(id=self.user.id)
+        with CaptureQueriesContext(connection) as ctx:
+            user.save()
+        self.assertFalse(any('board_profile' in q["sql"] for q in ctx.captured_queries))
+
+        user.profile.bio = 'Drills things'
+        user.save()
+        self.assertEqual(Profile.objects.get(user=user).bio, 'Drills things')
+        self.assertEqual(user.profile.changed_fields(), [])
+
+    def test_written_behind(self):
+        self.login()
+        self.assertFalse(Session.objects.exists())
+
+        self.assertEqual(flush_sessions(), 1)
+        session = Session.objects.get()
+        self.assertEqual(session.session_key, self.client.cookies['sessionid'].value)
+
+        # Without the cache it comes from the database
+        cache.clear()
+        self.assertEqual(self.client.get(reverse('dashboard')).status_code, 200)
+        self.assertEqual(SessionStore(session.session_key)['_auth_user_id'], str(self.user.id))
+
+    def test_unwritten_session_survives_cache_clear(self):
+        self.login()
+        cache.clear()
+        self.assertEqual(SessionStore(self.client.cookies['sessionid'].value)['_auth_user_id'], str(self.user.id))
+
+    def test_logout_isnt_undone(self):
+        self.login()
+        key = self.client.cookies['sessionid'].value
+        flush_sessions()
+        data = Session.objects.get().session_data
+
+        self.client.logout()
+        self.assertFalse(Session.objects.exists())
+
+        # Another process still had a write queued for it
+        queue(key, data, timezone.now() + timedelta(days=1))
+        flush_sessions()
+        self.assertFalse(Session.objects.exists())
+        self.assertNotIn('_auth_user_id', SessionStore(key).load())
+
+    def test_logout_between_load_and_save(self):
+        self.login()
+        key = self.client.cookies['sessionid'].value
+
+        # Another request has it loaded when this one logs out, then saves it
+        other = SessionStore(key)
+        other['seen'] = True
+        self.client.logout()
+        with self.assertRaises(UpdateError):
+            other.save()
+
+        # Even if that request's write got into the cache before the logout did
+        cache.set(other.cache_key_prefix + key, dict(other.items()))
+        self.assertEqual(SessionStore(key).load(), {})
+        flush_sessions()
+        self.assertFalse(Session.objects.exists())
+
+    def test_flushed_on_a_timer(self):
+        self.login()
+        timer = sessions._timer
+        self.assertEqual(timer.interval, 60)
+        timer.cancel()
+
+        # What the timer thread runs, without a request to flush them
+        flush = timer.args[0]
+        flush()
+        self.assertEqual(Session.objects.get().session_key, self.client.cookies['sessionid'].value)
+        self.assertIsNone(sessions._timer)
+
+    def test_written_behind_as_shipped(self):
+        # BoardTestCase keeps sessions in locmem, the settings the site runs with have a shared cache for them
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        shipped = {**SITE_CACHES, 'sessions': {**SITE_CACHES['sessions'], 'LOCATION': location}}
+        with override_settings(CACHES=shipped, SESSION_CACHE_ALIAS='sessions'):
+            self.assertTrue(sessions.write_behind())
+
+    def test_written_through_without_a_shared_cache(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.login()
+            self.assertEqual(Session.objects.get().session_key, self.client.cookies['sessionid'].value)
+            self.assertEqual(flush_sessions(), 0)
+
+            self.client.logout()
+            self.assertFalse(Session.objects.exists())
+
+    def test_benchmark(self):
+        results = {(r["scale"], r["endpoint"]): r for r in
+            run_session_benchmark(requests=2, warmup=0, login_requests=2)["results"]}
+
+        self.assertLess(results[('board', 'login')]["queries"], results[('db', 'login')]["queries"])
+        self.assertEqual(results[('board', 'session_flush')]["requests"], 2)
+        # One fewer, the session (savepoints count here too, so not the absolute numbers)
+        self.assertEqual(results[('db', 'request')]["queries"] - results[('board', 'request')]["queries"], 1)
+        self.assertFalse(User.objects.filter(username='session-benchmark').exists())
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTests(BoardTestCase):
+    # There's no 'replica' database here, the views only say where their reads would go
+
+    def setUp(self):
+        super().setUp()
+        self.board = make_board()
+        self.user = self.board.author
+        self.factory = RequestFactory()
+
+    def request(self, view, method='get'):
+        request = getattr(self.factory, method)('/')
+        request.user = self.user
+        return ReplicaMiddleware(replica_reads(view))(request).content.decode()
+
+    def where(self, request):
+        return HttpResponse(router.db_for_read(Board))
+
+    def test_reads(self):
+        self.assertEqual(self.request(self.where), 'replica')
+        self.assertEqual(self.request(self.where, 'post'), 'default')
+
+    def test_reads_own_writes(self):
+        def write(request):
+            Board.objects.filter(id=self.board.id).update(description='Changed')
+            return self.where(request)
+
+        self.assertEqual(self.request(write), 'default')
+        self.assertEqual(self.request(self.where), 'default')
+        self.assertEqual(self.request(self.where, 'post'), 'default')
+
+        other = User.objects.create_user(username='other')
+        self.user = other
+        self.assertEqual(self.request(self.where), 'replica')
+
+    def test_access_change(self):
+        other = User.objects.create_user(username='other')
+        with self.captureOnCommitCallbacks(execute=True):
+            BoardMember.objects.create(board=self.board, member=other, access=BoardMember.Access.READ)
+
+        self.user = other
+        self.assertEqual(self.request(self.where), 'default')
+
+    def test_recently_written_board(self):
+        other = make_board('Other')
+        with self.captureOnCommitCallbacks(execute=True):
+            Card.objects.filter(board=self.board).update(title='Changed')
+            bump_board_version(self.board.id)
+        cache.delete('replica:written:user:%s' % self.user.id)
+
+        def build(request):
+            with up_to_date('board', [self.board.id]):
+                written = router.db_for_read(Board)
+            with up_to_date('board', [other.id]):
+                untouched = router.db_for_read(Board)
+            return HttpResponse('%s %s' % (written, untouched))
+
+        self.assertEqual(self.request(build), 'default replica')
+
+    def test_without_replicas(self):
+        with override_settings(DATABASE_REPLICAS=[]):
+            self.assertEqual(self.request(self.where), 'default')
+
+
+class TagFilterTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.board = make_board(lists=1, cards=5)
+        self.bug = Tag.objects.get(board=self.board)
+        self.urgent = Tag.objects.create(board=self.board, name='urgent', colour='ffaa00')
+        self.blocked = Tag.objects.create(board=self.board, name='Blocked', colour='000000')
+        self.cards = list(Card.objects.filter(board=self.board).order_by('location').values_list('id', flat=True))
+
+        # make_board tags every card bug, the last one loses it
+        CardTag.objects.filter(card=self.cards[4]).delete()
+        for card, tag in [(0, self.urgent), (1, self.urgent), (1, self.blocked), (2, self.blocked)]:
+            CardTag.objects.create(board=self.board, card_id=self.cards[card], tag=tag)
+
+    def matching(self, text):
+        return sorted(self.cards.index(card) for card in filter_cards(self.board.id, text, self.cards))
+
+    def test_parse(self):
+        self.assertEqual(parse('bug urgent OR NOT "in progress"'),
+            ('or', ('and', ('tag', 'bug'), ('tag', 'urgent')), ('not', ('tag', 'in progress'))))
+        self.assertEqual(parse('bug and (urgent or blocked)'),
+            ('and', ('tag', 'bug'), ('or', ('tag', 'urgent'), ('tag', 'blocked'))))
+
+        for text in ('', 'bug AND', '(bug', 'bug)', 'OR bug', '"bug', 'NOT ' * 60):
+            with self.assertRaises(TagFilterError, msg=text):
+                parse(text)
+
+    def test_filters(self):
+        self.assertEqual(self.matching('bug urgent NOT blocked'), [0])
+        self.assertEqual(self.matching('bug AND (urgent OR blocked)'), [0, 1, 2])
+        self.assertEqual(self.matching('NOT bug'), [4])
+        self.assertEqual(self.matching('not blocked'), [0, 3, 4])
+        self.assertEqual(self.matching('BLOCKED'), [1, 2])
+        self.assertEqual(self.matching('nothing'), [])
+        self.assertEqual(self.matching('NOT nothing'), [0, 1, 2, 3, 4])
+
+    def test_index_kept_and_updated_in_place(self):
+        with self.assertNumQueries(1):
+            index = get_tag_index(self.board.id)
+        with self.assertNumQueries(0):
+            self.assertIs(get_tag_index(self.board.id), index)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            CardTag.objects.create(board=self.board, card_id=self.cards[3], tag=self.urgent)
+            CardTag.objects.get(card=self.cards[1], tag=self.blocked).delete()
+
+        with self.assertNumQueries(0):
+            self.assertIs(get_tag_index(self.board.id), index)
+            self.assertEqual(self.matching('urgent NOT blocked'), [0, 1, 3])
+
+    def test_rebuilt_after_other_changes(self):
+        get_tag_index(self.board.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.urgent.name = 'soon'
+            self.urgent.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.matching('soon'), [0, 1])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_operations(self.board, [{"op": "tag", "card": self.cards[4], "tag": self.blocked.id}])
+        self.assertEqual(self.matching('blocked'), [1, 2, 4])
+
+    def test_views(self):
+        self.client.force_login(self.board.author)
+        url = reverse('board-api', kwargs={"board_id": self.board.id})
+
+        data = self.client.get(url, {"tags": 'urgent OR blocked'}).json()
+        self.assertEqual([card["id"] for card in data["lists"][0]["cards"]], self.cards[:3])
+        self.assertEqual(len(self.client.get(url).json()["lists"][0]["cards"]), 5)
+        self.assertEqual(self.client.get(url, {"tags": '(urgent'}).status_code, 400)
+
+        response = self.client.get(self.board.get_absolute_url(), {"tags": 'NOT bug'})
+        self.assertContains(response, 'Card 4')
+        self.assertNotContains(response, 'Card 0')
+
+
+class ActivityTests(BoardTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.board = make_board(lists=1, cards=2)
+        self.author = self.board.author
+        self.member = User.objects.create_user(username='member', password='password')
+        self.card = Card.objects.filter(board=self.board).order_by('location').first()
+
+    def verbs(self, board=None):
+        return list(Activity.objects.filter(board=board or self.board).order_by('id')
+            .values_list('verb', 'actor__username', 'text'))
+
+    def test_recorded_from_signals(self):
+        # make_board's cards, lists and tasks are all by the author
+        self.assertEqual(self.verbs()[:3], [(Activity.Verb.LIST_CREATED, None, 'List 0'),
+            (Activity.Verb.CARD_CREATED, self.author.username, 'Card 0'),
+            (Activity.Verb.TASK_ADDED, None, 'one')])
+        Activity.objects.all().delete()
+
+        with acting_as(self.member):
+            BoardMember.objects.create(board=self.board, member=self.member, access=BoardMember.Access.WRITE)
+            comment = Comment.objects.create(board=self.board, card=self.card, author=self.member, comment='x' * 100)
+            Reaction.objects.create(comment=comment, author=self.author, reaction=Reaction.Reactions.LIKE)
+            task = Task.objects.get(card=self.card, done=False)
+            task.done = True
+            task.save()
+            task.save()
+            done = List.objects.create(board=self.board, title='Done', location=GAP * 10)
+            move_card(self.card, to_list=done)
+            card_id = self.card.id
+            self.card.delete()
+
+        member = self.member.username
+        self.assertEqual(self.verbs(), [
+            (Activity.Verb.MEMBER_ADDED, member, member),
+            (Activity.Verb.COMMENTED, member, 'x' * 64),
+            # Reactions are done by the current user, the author of the thing is only a fallback
+            (Activity.Verb.REACTED, member, 'Like'),
+            (Activity.Verb.TASK_DONE, member, 'two'),
+            (Activity.Verb.LIST_CREATED, member, 'Done'),
+            (Activity.Verb.CARD_MOVED, member, 'Card 0'),
+            (Activity.Verb.CARD_DELETED, member, 'Card 0'),
+        ])
+        self.assertEqual(set(Activity.objects.values_list('object_id', flat=True)), {self.member.id, done.id, card_id})
+
+    def test_only_moves_and_archives_are_recorded(self):
+        other = List.objects.create(board=self.board, title='Done', location=GAP * 10)
+        Activity.objects.all().delete()
+
+        # Renaming, editing and reordering within the list aren't moves
+        self.card.title = 'Renamed'
+        self.card.save()
+        self.card.description = 'Edited'
+        self.card.save()
+        move_card(self.card, after=Card.objects.filter(board=self.board).order_by('-location').first())
+        self.assertEqual(self.verbs(), [])
+
+        move_card(self.card, to_list=other)
+        self.card.title = 'Renamed again'
+        self.card.save()
+        self.assertEqual(self.verbs(), [(Activity.Verb.CARD_MOVED, None, 'Renamed')])
+
+        # Archiving once, not every save of an archived card
+        Activity.objects.all().delete()
+        self.card.archived = True
+        self.card.save()
+        self.card.save()
+        stale = Card.objects.get(id=self.card.id)
+        stale.save()
+        self.assertEqual([verb for verb, _, _ in self.verbs()], [Activity.Verb.CARD_ARCHIVED])
+
+    def test_bulk_operations(self):
+        lst = List.objects.create(board=self.board, title='Done', location=GAP * 10)
+        cards = list(Card.objects.filter(board=self.board).order_by('location'))
+        task = Task.objects.filter(card=cards[1], done=False).first()
+        Activity.objects.all().delete()
+
+        self.client.force_login(self.author)
+        self.client.post(reverse('board-bulk', kwargs={"board_id": self.board.id}), json.dumps({"operations": [
+            {"op": "move", "card": cards[0].id, "list": lst.id},
+            {"op": "archive", "card": cards[1].id},
+            {"op": "task", "task": task.id, "done": True},
+            {"op": "add_task", "card": cards[1].id, "name": 'three'},
+        ]}), content_type='application/json')
+
+        author = self.author.username
+        self.assertEqual(self.verbs(), [(Activity.Verb.CARD_MOVED, author, 'Card 0'),
+            (Activity.Verb.CARD_ARCHIVED, author, 'Card 1'), (Activity.Verb.TASK_DONE, author, 'two'),
+            (Activity.Verb.TASK_ADDED, author, 'three')])
+
+    def test_feed(self):
+        theirs = make_board('Theirs', author=self.member)
+        make_board('Someone Elses')
+        BoardMember.objects.create(board=theirs, member=self.author, access=BoardMember.Access.READ)
+        mine = set(Activity.objects.filter(board__in=[self.board, theirs]).values_list('id', flat=True))
+
+        # Newest first across both boards, a page at a time
+        seen, cursor = [], None
+        while True:
+            page = user_feed(self.author, cursor, page_size=3)
+            seen += [event["id"] for event in page]
+            cursor = page.next
+            if cursor is None:
+                break
+        self.assertEqual(seen, sorted(mine, reverse=True))
+
+        recent = recent_activity(self.author)
+        self.assertEqual(recent[0]["board_title"], 'Theirs')
+        self.assertEqual((recent[0]["verb"], recent[0]["phrase"]), ('member_added', 'added the member'))
+
+        self.client.force_login(self.author)
+        data = self.client.get(reverse('activity'), {"limit": 2}).json()
+        self.assertEqual([event["id"] for event in data["results"]], seen[:2])
+        self.assertEqual(self.client.get(reverse('activity'), {"cursor": 'nonsense'}).status_code, 400)
+
+        response = self.client.get(reverse('dashboard'))
+        self.assertContains(response, 'added the member "author-Test Board"')
+
+        # One board's feed, with the rolled up days once it runs out
+        url = reverse('board-activity', kwargs={"board_id": theirs.id})
+        data = self.client.get(url).json()
+        self.assertEqual({event["board"] for event in data["results"]}, {theirs.id})
+        self.assertEqual(data["days"], [])
+        self.assertNotIn("days", self.client.get(url, {"limit": 1}).json())
+
+        self.client.force_login(self.member)
+        self.assertNotIn('"results"', self.client.get(reverse('board-activity', kwargs={"board_id": self.board.id}))
+            .content.decode())
+
+    def test_recent_activity_is_one_query(self):
+        for i in range(5):
+            Comment.objects.create(board=self.board, card=self.card, author=self.author, comment='%s' % i)
+        recent_activity(self.author)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(recent_activity(self.author)), 10)
+
+    def test_rollup(self):
+        now = timezone.now()
+        count = Activity.objects.filter(board=self.board).count()
+        old = list(Activity.objects.filter(board=self.board).order_by('id').values_list('id', flat=True)[:count - 2])
+        Activity.objects.filter(id__in=old[:3]).update(date_created=now - timedelta(days=40))
+        Activity.objects.filter(id__in=old[3:]).update(date_created=now - timedelta(days=35))
+
+        self.assertEqual(rollup_activity(chunk_size=2), (len(old), 0))
+        self.assertEqual(Activity.objects.filter(board=self.board).count(), 2)
+        days = ActivityDay.objects.filter(board=self.board)
+        self.assertEqual(sum(days.values_list('count', flat=True)), len(old))
+        self.assertEqual(set(days.values_list('day', flat=True)), {timezone.localdate(now - timedelta(days=40)),
+            timezone.localdate(now - timedelta(days=35))})
+
+        # Rolling up more adds onto the same days
+        Activity.objects.filter(board=self.board).update(date_created=now - timedelta(days=40))
+        rollup_activity()
+        self.assertEqual(sum(days.values_list('count', flat=True)), count)
+        self.assertFalse(Activity.objects.filter(board=self.board).exists())
+
+        self.client.force_login(self.author)
+        data = self.client.get(reverse('board-activity', kwargs={"board_id": self.board.id})).json()
+        self.assertEqual(data["results"], [])
+        self.assertEqual(sum(day["count"] for day in data["days"]), count)
+
+        # Days past the summary retention go
+        summaries = days.count()
+        self.assertEqual(rollup_activity(summaries_before=timezone.localdate())[1], summaries)
+        self.assertFalse(days.exists())
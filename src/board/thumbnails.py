@@ -0,0 +1,182 @@
+import hashlib
+import io
+import os
+import tempfile
+
+from PIL import Image, ImageOps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.http import FileResponse, HttpResponse, HttpResponseNotFound
+
+from .jobs import job, enqueue
+
+"""
+Image Thumbnails
+================
+
+Avatars and image attachments are stored at whatever size they were uploaded, so anything listing them gets smaller
+copies from here instead: a fixed set of sizes (SIZES, longest side in pixels), each as WebP and as JPEG for
+anything that can't show WebP.
+
+Derivatives are named after the SHA-256 of the original's content, thumbs/ab/<sha256>/<size>.<format>, so the same
+picture uploaded twice is only ever resized once, and a derivative never needs invalidating (different content is a
+different name).
+
+New uploads queue a job (see jobs.py and signals.py) so the request that uploaded the image never waits for it,
+THUMBNAIL_WORKERS limits how many are resized at once. Anything asked for before it's ready (or that was uploaded
+before any of this existed) is generated on the spot by the request asking for it.
+"""
+
+SIZES = getattr(settings, 'THUMBNAIL_SIZES', {"small": 64, "medium": 256, "large": 1024})
+FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+QUALITY = 80
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff'}
+
+DIGEST_TIMEOUT = 24 * 60 * 60
+
+def is_image(name):
+    return os.path.splitext(name or '')[1].lower() in IMAGE_EXTENSIONS
+
+def size_for(px):
+    """
+    The smallest size at least 'px' pixels across, or the largest there is.
+    """
+    fitting = [name for name, side in sorted(SIZES.items(), key=lambda s: s[1]) if side >= px]
+    return fitting[0] if fitting else max(SIZES, key=SIZES.get)
+
+def derivative_name(digest, size, fmt):
+    return 'thumbs/%s/%s/%s.%s' % (digest[:2], digest, size, fmt)
+
+def source_digest(name, sha256=''):
+    """
+    SHA-256 of a stored file, attachments already know theirs. Stored names never change content so it's cached.
+    """
+    if sha256:
+        return sha256
+
+    key = 'thumbs:digest:%s' % hashlib.md5(name.encode()).hexdigest()
+    digest = cache.get(key)
+    if digest is None:
+        digest = hashlib.sha256()
+        with default_storage.open(name, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        digest = digest.hexdigest()
+        cache.set(key, digest, DIGEST_TIMEOUT)
+    return digest
+
+def write(name, data):
+    """
+    Saves a derivative under exactly 'name', replacing the file in one go so a reader never sees half of it.
+    """
+    try:
+        target = default_storage.path(name)
+    except NotImplementedError:
+        default_storage.delete(name)
+        default_storage.save(name, ContentFile(data))
+        return
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(target))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(temp, target)
+
+def render(name, digest):
+    """
+    Generates every missing derivative of stored image 'name'. Returns False if it isn't an image Pillow can read
+    (or is unreasonably big).
+    """
+    wanted = [(size, fmt) for size in SIZES for fmt in FORMATS
+        if not default_storage.exists(derivative_name(digest, size, fmt))]
+    if not wanted:
+        return True
+
+    try:
+        with default_storage.open(name, 'rb') as f, Image.open(f) as image:
+            if image.width * image.height > getattr(settings, 'THUMBNAIL_MAX_PIXELS', 50 * 1000 * 1000):
+                return False
+
+            # Lets the JPEG decoder scale down as it decodes, much cheaper than decoding at full size
+            largest = max(SIZES[size] for size, _ in wanted)
+            image.draft('RGB', (largest, largest))
+            image = ImageOps.exif_transpose(image)
+            image.load()
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        return False
+
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+
+    # Largest first, each size is shrunk from the one before rather than from the original
+    for size in sorted({size for size, _ in wanted}, key=SIZES.get, reverse=True):
+        image.thumbnail((SIZES[size], SIZES[size]), Image.LANCZOS)
+        for fmt, (format, _) in FORMATS.items():
+            if (size, fmt) not in wanted:
+                continue
+
+            out = image
+            if format == 'JPEG' and image.mode == 'RGBA':
+                out = Image.new('RGB', image.size, (255, 255, 255))
+                out.paste(image, mask=image.getchannel('A'))
+
+            data = io.BytesIO()
+            out.save(data, format, quality=QUALITY)
+            write(derivative_name(digest, size, fmt), data.getvalue())
+
+    return True
+
+@job(concurrency=getattr(settings, 'THUMBNAIL_WORKERS', 2))
+def render_job(name, sha256=''):
+    render(name, source_digest(name, sha256))
+
+def schedule(name, sha256=''):
+    """
+    Queues the derivatives of an image to be generated in the background.
+    """
+    if is_image(name):
+        enqueue(render_job, name, sha256)
+
+def get_derivative(name, size, fmt, sha256=''):
+    """
+    Name of the 'size'/'fmt' derivative of stored image 'name', generating it right now if it isn't there yet.
+    None if there can't be one.
+    """
+    if not name or not is_image(name) or size not in SIZES or fmt not in FORMATS:
+        return None
+
+    try:
+        digest = source_digest(name, sha256)
+    except FileNotFoundError:
+        return None
+
+    derivative = derivative_name(digest, size, fmt)
+    if not default_storage.exists(derivative):
+        render(name, digest)
+    return derivative if default_storage.exists(derivative) else None
+
+def remove_derivatives(digest):
+    for size in SIZES:
+        for fmt in FORMATS:
+            default_storage.delete(derivative_name(digest, size, fmt))
+
+def serve_thumbnail(request, name, size, fmt, sha256=''):
+    """
+    Response for a derivative, derivatives never change so the ETag is all a client needs to revalidate.
+    """
+    derivative = get_derivative(name, size, fmt, sha256)
+    if derivative is None:
+        return HttpResponseNotFound()
+
+    etag = '"%s"' % derivative.split('/', 2)[2].replace('/', '-')
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponse(status=304)
+    else:
+        response = FileResponse(default_storage.open(derivative, 'rb'), content_type=FORMATS[fmt][1])
+
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, max-age=86400'
+    return response
@@ -1,15 +1,41 @@
+import json
+
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect, render
+from django.views.decorators.http import condition
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
 from django.contrib.auth.decorators import login_required
 import django.contrib.auth as auth
 
 from django.contrib.auth.models import *
 from .models import *
 from .forms import *
+from .cache import get_board_snapshot, get_board_json, get_board_version
+from .permissions import board_access_required, RANK
+from .bulk import apply_operations
+from .changes import get_changes
+from .search import search
+from .attachments import UploadError, start_upload, write_chunk, complete_upload, discard_upload, serve_attachment
+from .thumbnails import serve_thumbnail
+from .dashboard import load_dashboard
+from .instrumentation import query_budget
+from .databases import replica_reads
+from .pagination import CursorPaginator, InvalidCursor
+from .purge import archive_board
+from .export import export_board
+from .clone import clone_board
+from .tagfilter import TagFilterError, filter_cards, filter_lists
+from .activity import activity_page, daily_activity, recent_activity, user_feed
 
 # Create your views here.
 
 @login_required(login_url='/login/')
+@replica_reads
+@board_access_required(BoardMember.Access.READ)
+@query_budget(10)
 def board_view(request, board_id, *args, **kwargs): 
     """
     Board View
@@ -17,35 +43,459 @@ def board_view(request, board_id, *args, **kwargs):
 
     This is the main application of the website, where project management stuff happens. 
     Better description incoming once the page has been developed.
+
+    ?tags=... only shows the cards matching a tag filter, see tagfilter.py.
     """
     try:
-        board = Board.objects.get(id=board_id)
-        members = board.get_members()
-        lists = board.get_lists()
-        cards = board.get_cards()
-
-        # Just some debug text, this can be removed
-        print('\nBoard:\t%s\nUser:\t(%s,%s)\nMembers:%s\n' % (
-            board.get_absolute_url(),
-            request.user.id, 
-            request.user,
-            members.values_list('member', flat=True)))
-
-        # Show the website to users who are authenticated and a member of the board or a member of staff
-        if request.user.is_authenticated and (request.user == board.author or request.user.is_staff or request.user.id in members.values_list('member', flat=True)):
-            return render(request, "board.html", {
-                "title": board.title,
-                "board": board,
-                "members": members,
-                "lists": lists,
-                "cards": cards
-            })
+        # Access has already been checked by board_access_required (authors, members and staff)
+        snapshot = get_board_snapshot(board_id)
+        board = snapshot["board"]
+        tag_filter = request.GET.get('tags', '').strip()
+
+        lists = snapshot["lists"]
+        if tag_filter:
+            try:
+                lists = filter_lists(lists, filter_cards(board_id, tag_filter, card_ids(lists)))
+            except TagFilterError as e:
+                return error_view(request, "Invalid tag filter: %s" % e)
+
+        return render(request, "board.html", {
+            "title": board["title"],
+            "board": board,
+            "members": snapshot["members"],
+            "lists": lists,
+            "tag_filter": tag_filter,
+        })
 
     except ObjectDoesNotExist: 
         pass
     
     return error_view(request, "Board Not Found")
 
+def card_ids(lists):
+    return [card["id"] for l in lists for card in l["cards"]]
+
+def board_etag(request, board_id, *args, **kwargs):
+    return '"%s-%s"' % (board_id, get_board_version(board_id))
+
+@login_required(login_url='/login/')
+@replica_reads
+@board_access_required(BoardMember.Access.READ)
+@condition(etag_func=board_etag)
+@query_budget(10)
+def board_api_view(request, board_id, *args, **kwargs):
+    """
+    Board API View
+    --------------
+
+    Read-only JSON version of the board (lists, cards, tags, task progress and members). Responses carry an ETag
+    built from the board version, so clients polling an unchanged board get a 304 straight from the cache without
+    the board being loaded or serialised again. There's no Last-Modified, its one second precision would 304 a
+    client that fetched the board in the same second as a later write.
+
+    ?tags=... only includes the cards matching a tag filter, see tagfilter.py.
+    """
+    tag_filter = request.GET.get('tags', '').strip()
+    try:
+        if not tag_filter:
+            response = HttpResponse(get_board_json(board_id), content_type='application/json')
+        else:
+            snapshot = get_board_snapshot(board_id)
+            lists = filter_lists(snapshot["lists"], filter_cards(board_id, tag_filter, card_ids(snapshot["lists"])))
+            response = HttpResponse(DjangoJSONEncoder().encode({
+                "board": snapshot["board"],
+                "members": snapshot["members"],
+                "lists": lists,
+            }), content_type='application/json')
+    except ObjectDoesNotExist:
+        return JsonResponse({"error": "Board Not Found"}, status=404)
+    except TagFilterError as e:
+        return JsonResponse({"error": "Invalid tag filter: %s" % e}, status=400)
+
+    # Always revalidate, and never share between users
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ('Cookie', ))
+    return response
+
+@login_required(login_url='/login/')
+@replica_reads
+@board_access_required(BoardMember.Access.READ)
+@query_budget(12)
+def board_changes_view(request, board_id, *args, **kwargs):
+    """
+    Board Changes View
+    ------------------
+
+    GET /b/<board_id>/changes/?since=N returns every change after sequence number N, or a full snapshot if the
+    client is too far behind to catch up, see changes.py.
+    """
+    try:
+        since = int(request.GET.get('since', 0))
+    except ValueError:
+        return JsonResponse({"error": "'since' must be a number"}, status=400)
+
+    try:
+        return JsonResponse(get_changes(board_id, since))
+    except ObjectDoesNotExist:
+        return JsonResponse({"error": "Board Not Found"}, status=404)
+
+@login_required(login_url='/login/')
+@replica_reads
+@board_access_required(BoardMember.Access.READ)
+@query_budget(8)
+def board_search_view(request, board_id, *args, **kwargs):
+    """
+    Board Search View
+    -----------------
+
+    GET /b/<board_id>/search/?q=... returns the best matching cards on the board as JSON.
+    """
+    return JsonResponse({"results": search(request.user, request.GET.get('q', ''), board_id=board_id)})
+
+def page_size(request):
+    try:
+        return max(1, min(int(request.GET.get('limit', settings.PAGE_SIZE)), settings.PAGE_SIZE_MAX))
+    except ValueError:
+        return settings.PAGE_SIZE
+
+@login_required(login_url='/login/')
+@replica_reads
+@board_access_required(BoardMember.Access.READ)
+@query_budget(6)
+def card_comments_view(request, board_id, card_id, *args, **kwargs):
+    """
+    Card Comments View
+    ------------------
+
+    GET /b/<board_id>/cards/<card_id>/comments/?cursor=...&limit=... returns a page of a cards comments oldest
+    first, "next" is the cursor for the page after (null on the last page). See pagination.py.
+    """
+    comments = Comment.objects.filter(board=board_id, card=card_id).values('id', 'author', 'author__username',
+        'comment', 'like_count', 'dislike_count', 'checkmark_count', 'cross_count', 'date_created')
+    try:
+        page = CursorPaginator(comments, ('date_created', 'id'), page_size(request)).page(request.GET.get('cursor'))
+    except InvalidCursor as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    return JsonResponse({"results": page.items, "next": page.next})
+
+@login_required(login_url='/login/')
+@replica_reads
+@board_access_required(BoardMember.Access.READ)
+@query_budget(6)
+def list_cards_view(request, board_id, list_id, *args, **kwargs):
+    """
+    List Cards View
+    ---------------
+
+    GET /b/<board_id>/lists/<list_id>/cards/?cursor=...&limit=... returns a page of a lists cards in order, for lists
+    too long to send in one go. Same paging as card_comments_view.
+    """
+    cards = Card.objects.filter(board=board_id, list=list_id, archived=False).values('id', 'title', 'location',
+        'author', 'task_count', 'task_done_count', 'comment_count', 'attachment_count')
+    try:
+        page = CursorPaginator(cards, ('location', 'id'), page_size(request)).page(request.GET.get('cursor'))
+    except InvalidCursor as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    return JsonResponse({"results": page.items, "next": page.next})
+
+@login_required(login_url='/login/')
+@replica_reads
+@query_budget(8)
+def search_view(request, *args, **kwargs):
+    """
+    Search View
+    -----------
+
+    GET /search/?q=... searches every board the user can see.
+    """
+    return JsonResponse({"results": search(request.user, request.GET.get('q', ''))})
+
+@login_required(login_url='/login/')
+@replica_reads
+@query_budget(6)
+def activity_view(request, *args, **kwargs):
+    """
+    Activity View
+    -------------
+
+    GET /activity/?cursor=...&limit=... returns a page of what's happened on all of the users boards newest first,
+    see activity.py. Paged like card_comments_view.
+    """
+    try:
+        page = user_feed(request.user, request.GET.get('cursor'), page_size(request))
+    except InvalidCursor as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    return JsonResponse({"results": page.items, "next": page.next})
+
+@login_required(login_url='/login/')
+@replica_reads
+@board_access_required(BoardMember.Access.READ)
+@query_budget(6)
+def board_activity_view(request, board_id, *args, **kwargs):
+    """
+    Board Activity View
+    -------------------
+
+    GET /b/<board_id>/activity/?cursor=...&limit=... returns a page of the boards activity newest first. The last
+    page also has "days", daily counts for the time before that, from events that have been rolled up.
+    """
+    try:
+        page = activity_page([board_id], request.GET.get('cursor'), page_size(request))
+    except InvalidCursor as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    response = {"results": page.items, "next": page.next}
+    if page.next is None:
+        response["days"] = daily_activity(board_id)
+    return JsonResponse(response)
+
+@login_required(login_url='/login/')
+@board_access_required(BoardMember.Access.WRITE)
+def board_bulk_view(request, board_id, *args, **kwargs):
+    """
+    Board Bulk View
+    ---------------
+
+    POST a JSON body of {"operations": [...]} to apply a whole batch of card/tag/task changes to a board in one go,
+    see bulk.py for the operations. Responds with {"results": [...]}, one result per operation.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"error": "POST required"}, status=405)
+
+    try:
+        operations = json.loads(request.body)["operations"]
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({"error": "Expected a JSON body with an 'operations' list"}, status=400)
+
+    if not isinstance(operations, list):
+        return JsonResponse({"error": "Expected a JSON body with an 'operations' list"}, status=400)
+    if len(operations) > settings.BOARD_BULK_MAX_OPERATIONS:
+        return JsonResponse({"error": "Too many operations (max %s)" % settings.BOARD_BULK_MAX_OPERATIONS}, status=400)
+
+    board = Board.objects.get(id=board_id)
+    return JsonResponse({"results": apply_operations(board, operations)})
+
+@login_required(login_url='/login/')
+@board_access_required(BoardMember.Access.OWNER)
+@query_budget(16)
+def board_archive_view(request, board_id, *args, **kwargs):
+    """
+    Board Archive View
+    ------------------
+
+    POST archives the board, which takes it away from everyone straight away. Everything on it is deleted in the
+    background after that, see purge.py.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"error": "POST required"}, status=405)
+
+    archive_board(board_id)
+    return JsonResponse({"archived": True}, status=202)
+
+@login_required(login_url='/login/')
+@board_access_required(BoardMember.Access.ADMIN)
+@query_budget(6)
+def board_export_view(request, board_id, *args, **kwargs):
+    """
+    Board Export View
+    -----------------
+
+    Downloads the board as JSON Lines, streamed out as it's read so any size of board can be exported, see
+    export.py. 'manage.py import_board' reads it back in.
+    """
+    if not Board.objects.filter(id=board_id).exists():
+        return error_view(request, "Board Not Found")
+
+    response = StreamingHttpResponse(export_board(board_id), content_type='application/x-ndjson')
+    response['Content-Disposition'] = 'attachment; filename="board-%s.jsonl"' % board_id
+    return response
+
+@login_required(login_url='/login/')
+@board_access_required(BoardMember.Access.READ)
+def board_clone_view(request, board_id, *args, **kwargs):
+    """
+    Board Clone View
+    ----------------
+
+    POST {"title": optional, "comments": true to copy them too} copies the board into a new one owned by whoever
+    asked, see clone.py. Anyone who can read a template can start a board from it, other boards need admin access.
+    Responds with {"board": new id, "url", "counts": {row type: rows copied}}.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"error": "POST required"}, status=405)
+
+    try:
+        body = json.loads(request.body or '{}')
+        title = str(body["title"]).strip() if body.get("title") else None
+        comments = bool(body.get("comments", False))
+    except (ValueError, TypeError, AttributeError):
+        return JsonResponse({"error": "Expected a JSON body with an optional 'title' and 'comments'"}, status=400)
+
+    is_template = Board.objects.filter(id=board_id).values_list('is_template', flat=True).get()
+    if not is_template and RANK[request.board_access] < RANK[BoardMember.Access.ADMIN]:
+        return JsonResponse({"error": "Only admins can copy a board that isn't a template"}, status=403)
+
+    board, counts = clone_board(board_id, request.user, title, comments)
+    return JsonResponse({"board": board.id, "url": board.get_absolute_url(), "counts": counts}, status=201)
+
+@login_required(login_url='/login/')
+@board_access_required(BoardMember.Access.ADMIN)
+@query_budget(12)
+def board_template_view(request, board_id, *args, **kwargs):
+    """
+    Board Template View
+    -------------------
+
+    POST {"template": true/false} marks the board as a template (or not), for members to start new boards from.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"error": "POST required"}, status=405)
+
+    try:
+        is_template = json.loads(request.body)["template"]
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({"error": "Expected a JSON body with 'template'"}, status=400)
+
+    board = Board.objects.get(id=board_id)
+    board.is_template = bool(is_template)
+    board.save(update_fields=['is_template', 'date_modified'])
+    return JsonResponse({"template": board.is_template})
+
+@login_required(login_url='/login/')
+@board_access_required(BoardMember.Access.WRITE)
+@query_budget(10)
+def board_uploads_view(request, board_id, *args, **kwargs):
+    """
+    Board Uploads View
+    ------------------
+
+    POST {"card": id, "name": ..., "size": bytes, "sha256": optional hex digest} to start a resumable upload, responds
+    with {"id", "offset"}. Chunks then go to /b/<board_id>/uploads/<id>/, see board_upload_view.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"error": "POST required"}, status=405)
+
+    try:
+        body = json.loads(request.body)
+        card = Card.objects.get(id=int(body["card"]), board=board_id)
+        upload = start_upload(card.board, card, request.user, str(body["name"]), int(body["size"]),
+            str(body.get("sha256", "")).lower())
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({"error": "Expected a JSON body with 'card', 'name' and 'size'"}, status=400)
+    except ObjectDoesNotExist:
+        return JsonResponse({"error": "Card Not Found"}, status=404)
+    except UploadError as e:
+        return JsonResponse({"error": str(e)}, status=e.status)
+
+    return JsonResponse({"id": upload.id, "offset": upload.received}, status=201)
+
+@login_required(login_url='/login/')
+@board_access_required(BoardMember.Access.WRITE)
+@query_budget(10)
+def board_upload_view(request, board_id, upload_id, *args, **kwargs):
+    """
+    Board Upload View
+    -----------------
+
+    GET how far an upload has got ({"offset"}), PUT the next chunk with a 'Content-Range: bytes start-end/total'
+    header, or DELETE to give up on it.
+    """
+    upload = Upload.objects.filter(id=upload_id, board=board_id).first()
+    if upload is None:
+        return JsonResponse({"error": "Upload Not Found"}, status=404)
+
+    if request.method == 'GET':
+        return JsonResponse({"id": upload.id, "offset": upload.received, "size": upload.size})
+
+    if request.method == 'DELETE':
+        discard_upload(upload)
+        return HttpResponse(status=204)
+
+    if request.method != 'PUT':
+        return JsonResponse({"error": "GET, PUT or DELETE required"}, status=405)
+
+    try:
+        # The request is read as a stream, the chunk is never in memory all at once
+        upload = write_chunk(upload.id, request.headers.get('Content-Range'), request)
+    except UploadError as e:
+        upload.refresh_from_db()
+        return JsonResponse({"error": str(e), "offset": upload.received}, status=e.status)
+
+    return JsonResponse({"id": upload.id, "offset": upload.received, "size": upload.size})
+
+@login_required(login_url='/login/')
+@board_access_required(BoardMember.Access.WRITE)
+@query_budget(14)
+def board_upload_complete_view(request, board_id, upload_id, *args, **kwargs):
+    """
+    Board Upload Complete View
+    --------------------------
+
+    POST once every chunk is in to turn the upload into an attachment, responds with {"attachment", "sha256",
+    "deduplicated"} ("deduplicated" meaning the same content was already stored and is being shared).
+    """
+    if request.method != 'POST':
+        return JsonResponse({"error": "POST required"}, status=405)
+
+    if not Upload.objects.filter(id=upload_id, board=board_id).exists():
+        return JsonResponse({"error": "Upload Not Found"}, status=404)
+
+    try:
+        attachment, deduplicated = complete_upload(upload_id)
+    except UploadError as e:
+        return JsonResponse({"error": str(e)}, status=e.status)
+
+    return JsonResponse({"attachment": attachment.id, "sha256": attachment.sha256, "deduplicated": deduplicated},
+        status=201)
+
+@login_required(login_url='/login/')
+@board_access_required(BoardMember.Access.READ)
+@query_budget(6)
+def attachment_view(request, board_id, attachment_id, *args, **kwargs):
+    """
+    Attachment View
+    ---------------
+
+    Downloads an attachment, Range requests are supported so downloads can be resumed.
+    """
+    attachment = Attachment.objects.filter(id=attachment_id, board=board_id).first()
+    if attachment is None:
+        return error_view(request, "Attachment Not Found")
+
+    try:
+        return serve_attachment(request, attachment)
+    except UploadError as e:
+        response = HttpResponse(str(e), status=e.status, content_type='text/plain')
+        response['Content-Range'] = 'bytes */%s' % attachment.size
+        return response
+
+@login_required(login_url='/login/')
+@board_access_required(BoardMember.Access.READ)
+@query_budget(6)
+def attachment_thumbnail_view(request, board_id, attachment_id, size, fmt, *args, **kwargs):
+    """
+    Attachment Thumbnail View
+    -------------------------
+
+    A resized copy of an image attachment, generated on the spot if the background workers haven't got to it yet.
+    See thumbnails.py for the sizes and formats.
+    """
+    attachment = Attachment.objects.filter(id=attachment_id, board=board_id).values_list('file', 'sha256').first()
+    if attachment is None:
+        return HttpResponse(status=404)
+    return serve_thumbnail(request, attachment[0], size, fmt, attachment[1])
+
+@login_required(login_url='/login/')
+@query_budget(6)
+def avatar_view(request, user_id, size, fmt, *args, **kwargs):
+    """
+    Avatar View
+    -----------
+
+    A resized copy of a users avatar.
+    """
+    avatar = Profile.objects.filter(user=user_id).values_list('avatar', flat=True).first()
+    return serve_thumbnail(request, avatar, size, fmt)
+
 
 def home_view(request, *args, **kwargs):
     """
@@ -72,6 +522,8 @@ def error_view(request, message, *args, **kwargs):
     })
 
 @login_required(login_url='/login/')
+@replica_reads
+@query_budget(9)
 def dashboard_view(request, *args, **kwargs):
     """
     Dashboard View
@@ -80,9 +532,13 @@ def dashboard_view(request, *args, **kwargs):
     This is the dashboard for the logged in user, we can probably add functionality for admins
     by using the is_superuser stuff etc. They should have access to the board they are a member of
     as well as the option of changing portions of their profile.   
+
+    Boards come from load_dashboard, see dashboard.py, and recent activity from activity.py.
     """
     return render(request, "dashboard.html", {
-        "title": "Dashboard"
+        "title": "Dashboard",
+        "boards": load_dashboard(request.user),
+        "activity": recent_activity(request.user),
     })
 
 def login_view(request, *args, **kwargs):
@@ -0,0 +1,145 @@
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Max
+
+from .models import *
+from .ordering import GAP
+from .search import reindex_cards
+
+"""
+Synthetic Workloads
+===================
+
+Fills the database with made up users and boards, for benchmarks (see benchmark.py) and for trying things out at
+a realistic size. Everything is written with bulk inserts in one transaction, so even the large scale only takes
+seconds, and the counters, search index and activity are filled in as if it had all come in through the site.
+
+Rows are given their primary keys up front (carrying on from the current highest) so the rows that depend on them
+can be built without reading anything back, which MySQL's bulk inserts can't do. Don't generate into a database
+something else is writing to at the same time.
+
+Every generated user's password is 'password'.
+"""
+
+SCALES = {
+    "small":  {"users": 20, "boards": 10, "lists": 4, "cards": 10, "members": 5},
+    "medium": {"users": 200, "boards": 100, "lists": 6, "cards": 25, "members": 10},
+    "large":  {"users": 1000, "boards": 400, "lists": 8, "cards": 50, "members": 20},
+}
+
+PASSWORD = 'password'
+
+WORDS = ('report sample drill core assay geology survey permit tenement budget review field site map logging '
+    'safety rig crew access road water fuel camp client invoice lab results update plan quote').split()
+
+ORDER = (User, Profile, Board, BoardMember, Tag, List, Card, CardTag, Task, Comment, Reaction, Activity)
+
+class Writer:
+    """
+    Buffers unsaved rows by model and bulk inserts them, parents before children.
+    """
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.rows = {model: [] for model in ORDER}
+        self.ids = {model: (model.objects.aggregate(top=Max('pk'))['top'] or 0) for model in ORDER}
+        self.written = {model.__name__: 0 for model in ORDER}
+
+    def add(self, instance):
+        model = type(instance)
+        self.ids[model] += 1
+        instance.pk = self.ids[model]
+        self.rows[model].append(instance)
+        return instance
+
+    def pending(self):
+        return sum(len(rows) for rows in self.rows.values())
+
+    def flush(self):
+        for model in ORDER:
+            if self.rows[model]:
+                model.objects.bulk_create(self.rows[model], batch_size=self.batch_size)
+                self.written[model.__name__] += len(self.rows[model])
+                self.rows[model] = []
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+def generate_workload(users=20, boards=10, lists=4, cards=10, tags=5, tasks=3, comments=2, reactions=1, members=5,
+        seed=0, prefix='load', index=True, batch_size=1000):
+    """
+    Generate Workload
+    -----------------
+
+    'users' users and 'boards' boards, each board with 'members' members (its author included), 'tags' tags and
+    'lists' lists of 'cards' cards. Each card gets up to two tags, 'tasks' tasks (some done) and 'comments' comments
+    with 'reactions' reactions each. The same seed always builds the same data.
+
+    Returns {"users": [user ids], "boards": [board ids], "rows": {model name: rows written}}.
+    """
+    rng = random.Random(seed)
+    writer = Writer(batch_size)
+    password = make_password(PASSWORD)
+    members = max(1, min(members, users))
+    reactions = min(reactions, members)
+
+    with transaction.atomic():
+        people = [writer.add(User(username='%s-user-%s' % (prefix, n), password=password)) for n in range(users)]
+        for user in people:
+            writer.add(Profile(user=user))
+
+        board_ids = []
+        card_ids = []
+        for n in range(boards):
+            team = rng.sample(people, members)
+            board = writer.add(Board(title='%s board %s' % (prefix, n), author=team[0], description=sentence(rng, 8)))
+            board_ids.append(board.id)
+
+            writer.add(BoardMember(board=board, member=team[0], access=BoardMember.Access.OWNER))
+            for member in team[1:]:
+                writer.add(BoardMember(board=board, member=member, access=rng.choice(
+                    [BoardMember.Access.READ, BoardMember.Access.WRITE, BoardMember.Access.ADMIN])))
+
+            board_tags = [writer.add(Tag(board=board, name='%s-%s' % (rng.choice(WORDS), t),
+                colour='%06x' % rng.randrange(0x1000000))) for t in range(tags)]
+
+            for l in range(lists):
+                lst = writer.add(List(board=board, title=sentence(rng, 2), location=(l + 1) * GAP))
+
+                for c in range(cards):
+                    done = rng.randint(0, tasks)
+                    card = writer.add(Card(board=board, list=lst, author=rng.choice(team), location=(c + 1) * GAP,
+                        title=sentence(rng, 4), description=sentence(rng, 20),
+                        task_count=tasks, task_done_count=done, comment_count=comments))
+                    card_ids.append(card.id)
+                    writer.add(Activity(board=board, actor=card.author, verb=Activity.Verb.CARD_CREATED,
+                        object_id=card.id, text=card.title[:64]))
+
+                    for tag in rng.sample(board_tags, min(len(board_tags), rng.randint(0, 2))):
+                        writer.add(CardTag(board=board, card=card, tag=tag))
+                    for t in range(tasks):
+                        writer.add(Task(board=board, card=card, name=sentence(rng, 2)[:25], done=t < done))
+
+                    for _ in range(comments):
+                        comment = writer.add(Comment(board=board, card=card, author=rng.choice(team),
+                            comment=sentence(rng, 12)))
+                        writer.add(Activity(board=board, actor=comment.author, verb=Activity.Verb.COMMENTED,
+                            object_id=card.id, text=comment.comment[:64]))
+                        for reactor in rng.sample(team, reactions):
+                            reaction = writer.add(Reaction(comment=comment, author=reactor,
+                                reaction=rng.choice(Reaction.Reactions.values)))
+                            field = '%s_count' % Reaction.Reactions(reaction.reaction).name.lower()
+                            setattr(comment, field, getattr(comment, field) + 1)
+
+            if writer.pending() >= batch_size * 10:
+                writer.flush()
+
+        writer.flush()
+
+        if index:
+            for start in range(0, len(card_ids), batch_size):
+                reindex_cards(card_ids[start:start + batch_size])
+
+    return {"users": [user.id for user in people], "boards": board_ids, "rows": writer.written}
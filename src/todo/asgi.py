@@ -13,4 +13,10 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'todo.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Live board events (/b/<board_id>/events/) are served outside of Django's request cycle, everything else
+# goes through to Django as normal. Has to come after get_asgi_application() so the apps are loaded.
+from board.realtime import BoardEventsApp
+
+application = BoardEventsApp(django_application)
@@ -0,0 +1,31 @@
+"""
+Settings for trying read replicas locally, two SQLite files stand in for the MySQL primary and replica:
+
+    python manage.py migrate --settings=todo.replica_settings
+    cp primary.sqlite3 replica.sqlite3
+    python manage.py runserver --settings=todo.replica_settings
+
+Nothing replicates between them, copying the primary over the replica again is the replica catching up. Until it
+does, writes show up for whoever made them (and on boards written in the last DATABASE_REPLICA_LAG seconds) but
+not for anyone else reading through a replica.
+
+The tests pass under these settings too (python manage.py test board --settings=todo.replica_settings), their reads
+stay on the primary apart from the routing tests, see BoardTestCase.
+"""
+
+from .settings import *
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'primary.sqlite3'),
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'replica.sqlite3'),
+        # Tests read the replica through the primary's test database
+        'TEST': {'MIRROR': 'default'},
+    },
+}
+
+DATABASE_REPLICAS = ['replica']
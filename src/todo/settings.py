@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
+from datetime import timedelta
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -42,11 +43,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so it counts the queries of everything below it (see board/instrumentation.py)
+    'board.instrumentation.QueryInstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'board.databases.ReplicaMiddleware',
+    'board.activity.ActivityMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -55,7 +60,8 @@ ROOT_URLCONF = 'todo.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates that also times rendering for the Server-Timing header
+        'BACKEND': 'board.instrumentation.InstrumentedTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -86,10 +92,133 @@ DATABASES = {
         'PORT': '3306',
         'OPTIONS': {
             'init_command': "SET sql_mode='STRICT_TRANS_TABLES'"
-        }
+        },
+        # Keep connections open between requests, checked they're still alive at the start of each (see
+        # board/databases.py)
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Read replicas, aliases in DATABASES the board, dashboard and search pages may read from (see board/databases.py).
+# Someone who's just written, and boards just written to, stay on the primary for DATABASE_REPLICA_LAG seconds.
+DATABASE_ROUTERS = ['board.databases.ReplicaRouter']
+DATABASE_REPLICAS = []
+DATABASE_REPLICA_LAG = 5
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+
+CACHES = {
+    # Local memory is fine for a single process (and for tests), point this at memcached/redis when deploying
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'pmdb',
+        # The default (300) doesn't go far with per-board snapshots, versions and dashboard summaries
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    # Sessions need a cache every process shares to be written behind (see below), files do for processes on one
+    # machine. Across machines point this at memcached/redis too
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'sessions'),
+        # One file per session, the default (300) would start throwing sessions away at 300 people logged in
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+
+# Sessions are read from the cache and written to the database behind it (see board/sessions.py), once the oldest
+# unwritten session has waited SESSION_WRITE_BEHIND_INTERVAL seconds or SESSION_WRITE_BEHIND_BATCH are waiting.
+# Only with a cache every process shares (the 'sessions' one above), with a per-process one like locmem they're
+# written straight through like cached_db
+SESSION_ENGINE = 'board.sessions'
+SESSION_CACHE_ALIAS = 'sessions'
+SESSION_WRITE_BEHIND_INTERVAL = 5
+SESSION_WRITE_BEHIND_BATCH = 100
+
+# How long (seconds) a board snapshot is kept, writes to a board invalidate it straight away regardless
+BOARD_SNAPSHOT_TIMEOUT = 60 * 60
+
+# How long (seconds) a users board access map is kept, membership changes invalidate it straight away
+BOARD_ACCESS_TIMEOUT = 60 * 60
+
+# Most operations accepted in one request to the bulk card endpoint
+BOARD_BULK_MAX_OPERATIONS = 5000
+
+# Archived boards are purged in the background (see board/purge.py), this many rows per transaction and at most
+# BOARD_PURGE_MAX_CHUNKS transactions per job before it queues itself to carry on
+BOARD_PURGE_CHUNK_SIZE = 1000
+BOARD_PURGE_MAX_CHUNKS = 100
+
+# Tag filter indexes (see board/tagfilter.py) kept in memory per process, for this many boards
+BOARD_TAG_INDEXES = 200
+
+# Cursor paginated endpoints (see board/pagination.py), rows per page unless ?limit= asks for fewer/more up to the max
+PAGE_SIZE = 50
+PAGE_SIZE_MAX = 200
+
+# Live board events (see board/realtime.py), the in-memory broker only reaches clients connected to the same process
+BOARD_EVENTS_BROKER = 'board.realtime.InMemoryBroker'
+BOARD_EVENTS_KEEPALIVE = 15
+
+# Board change log (see board/changes.py), clients further behind than BOARD_CHANGES_MAX get a full snapshot instead.
+# 'manage.py compact_board_changes' drops changes older than the retention, keeping at least the last MAX per board.
+BOARD_CHANGES_MAX = 500
+BOARD_CHANGES_RETENTION = timedelta(days=30)
+
+# Activity feeds (see board/activity.py), 'manage.py rollup_activity' rolls events older than the retention up into
+# daily counts per board, and drops daily counts older than the summary retention
+BOARD_ACTIVITY_RETENTION = timedelta(days=30)
+BOARD_ACTIVITY_SUMMARY_RETENTION = timedelta(days=365)
+
+# Attachments (see board/attachments.py). Chunks of resumable uploads are written to ATTACHMENT_UPLOAD_DIR and moved
+# into MEDIA_ROOT when complete, so keep the two on the same filesystem. Set ATTACHMENT_SENDFILE_HEADER (e.g.
+# 'X-Accel-Redirect' with ATTACHMENT_SENDFILE_PREFIX '/protected/') to have the web server send downloads itself.
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+MEDIA_URL = '/media/'
+ATTACHMENT_UPLOAD_DIR = os.path.join(MEDIA_ROOT, 'uploads')
+ATTACHMENT_MAX_CHUNK_SIZE = 16 * 1024 * 1024
+ATTACHMENT_MAX_FILE_SIZE = 1024 * 1024 * 1024
+ATTACHMENT_SENDFILE_HEADER = None
+ATTACHMENT_SENDFILE_PREFIX = ''
+
+# Avatar and image attachment thumbnails (see board/thumbnails.py), longest side in pixels. New images are resized
+# by background jobs, at most THUMBNAIL_WORKERS at once. Anything bigger than THUMBNAIL_MAX_PIXELS is never opened.
+THUMBNAIL_SIZES = {"small": 64, "medium": 256, "large": 1024}
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_MAX_PIXELS = 50 * 1000 * 1000
+
+# Background jobs (see board/jobs.py), run by 'manage.py run_jobs'. Failed jobs are retried after JOBS_BACKOFF
+# seconds, doubling each time up to JOBS_MAX_BACKOFF. Jobs running longer than JOBS_TIMEOUT are assumed dead.
+JOBS_BACKOFF = 10
+JOBS_MAX_BACKOFF = 60 * 60
+JOBS_TIMEOUT = 15 * 60
+
+# Request instrumentation (see board/instrumentation.py), every request logs a line of timings and query counts to
+# 'board.performance'. Views over their query budget log a warning, or raise with QUERY_BUDGET_RAISE (tests).
+QUERY_BUDGET_RAISE = False
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'board.performance': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
+# Never hold an uploaded file in memory, spool anything posted the normal way straight to disk
+FILE_UPLOAD_HANDLERS = ['django.core.files.uploadhandler.TemporaryFileUploadHandler']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
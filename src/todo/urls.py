@@ -25,7 +25,26 @@ urlpatterns = [
     path('login/', login_view, name = "login"),
     path('register/', registration_view, name = "register"),
     path('dashboard/', dashboard_view, name = 'dashboard'),
+    path('search/', search_view, name = 'search'),
+    path('activity/', activity_view, name = 'activity'),
     path('b/<int:board_id>/', board_view, name = "board-main"),
+    path('b/<int:board_id>/api/', board_api_view, name = "board-api"),
+    path('b/<int:board_id>/changes/', board_changes_view, name = "board-changes"),
+    path('b/<int:board_id>/search/', board_search_view, name = "board-search"),
+    path('b/<int:board_id>/activity/', board_activity_view, name = "board-activity"),
+    path('b/<int:board_id>/bulk/', board_bulk_view, name = "board-bulk"),
+    path('b/<int:board_id>/archive/', board_archive_view, name = "board-archive"),
+    path('b/<int:board_id>/export/', board_export_view, name = "board-export"),
+    path('b/<int:board_id>/clone/', board_clone_view, name = "board-clone"),
+    path('b/<int:board_id>/template/', board_template_view, name = "board-template"),
+    path('b/<int:board_id>/cards/<int:card_id>/comments/', card_comments_view, name = "card-comments"),
+    path('b/<int:board_id>/lists/<int:list_id>/cards/', list_cards_view, name = "list-cards"),
+    path('b/<int:board_id>/uploads/', board_uploads_view, name = "board-uploads"),
+    path('b/<int:board_id>/uploads/<uuid:upload_id>/', board_upload_view, name = "board-upload"),
+    path('b/<int:board_id>/uploads/<uuid:upload_id>/complete/', board_upload_complete_view, name = "board-upload-complete"),
+    path('b/<int:board_id>/attachments/<int:attachment_id>/', attachment_view, name = "attachment"),
+    path('b/<int:board_id>/attachments/<int:attachment_id>/<slug:size>.<slug:fmt>', attachment_thumbnail_view, name = "attachment-thumbnail"),
+    path('u/<int:user_id>/avatar/<slug:size>.<slug:fmt>', avatar_view, name = "avatar"),
     path('admin/', admin.site.urls)
 ]
 